@@ -1,140 +1,200 @@
 import os
 import numpy as np
-import matplotlib.pyplot as plt
 from astropy.io import fits
 from scipy.signal import find_peaks
-from scipy.optimize import curve_fit
 from scipy.ndimage import gaussian_filter1d
 import pandas as pd
 from datetime import datetime, timedelta
-from collections import defaultdict
 import json
-from matplotlib.patches import Circle
-import matplotlib
-matplotlib.use('Agg')
-from matplotlib.colors import LinearSegmentedColormap
-
-def integrate_fits_files(fits_filepaths, output_dir):
-    # Ensure the output directory exists
-    os.makedirs(output_dir, exist_ok=True)
-
-    # Prepare cumulative counts by channel
-    cumulative_counts_by_channel = defaultdict(float)
-    total_exposure_time = 0
-    # Initialize variables for bounding box
-    min_v0_lat, min_v1_lat, min_v2_lat, min_v3_lat = float('inf'), float('inf'), float('inf'), float('inf')
-    max_v0_lat, max_v1_lat, max_v2_lat, max_v3_lat = float('-inf'), float('-inf'), float('-inf'), float('-inf')
-    min_v0_lon, min_v1_lon, min_v2_lon, min_v3_lon = float('inf'), float('inf'), float('inf'), float('inf')
-    max_v0_lon, max_v1_lon, max_v2_lon, max_v3_lon = float('-inf'), float('-inf'), float('-inf'), float('-inf')
-
-    for fits_file in fits_filepaths:
-        with fits.open(fits_file) as hdul:
-            data = hdul[1].data
-            header = hdul[1].header
-
-            if data is not None:
-                counts_data = data['COUNTS']
-                channel_data = data['CHANNEL']
-                exposure_time = header.get('EXPOSURE', 0)
-
-                # Add exposure time for the group
-                total_exposure_time += exposure_time
-
-                # Update cumulative counts
-                for channel, count in zip(channel_data, counts_data):
-                    cumulative_counts_by_channel[channel] += float(count)
-
-                # Update min and max values for latitudes and longitudes
-                latitudes = [
-                    header.get('V0_LAT'), header.get('V1_LAT'),
-                    header.get('V2_LAT'), header.get('V3_LAT')
-                ]
-                longitudes = [
-                    header.get('V0_LON'), header.get('V1_LON'),
-                    header.get('V2_LON'), header.get('V3_LON')
-                ]
-
-                min_v0_lat = min(min_v0_lat, float(latitudes[0]))
-                min_v1_lat = min(min_v1_lat, float(latitudes[1]))
-                min_v2_lat = min(min_v2_lat, float(latitudes[2]))
-                min_v3_lat = min(min_v3_lat, float(latitudes[3]))
-                max_v0_lat = max(max_v0_lat, float(latitudes[0]))
-                max_v1_lat = max(max_v1_lat, float(latitudes[1]))
-                max_v2_lat = max(max_v2_lat, float(latitudes[2]))
-                max_v3_lat = max(max_v3_lat, float(latitudes[3]))
-
-                min_v0_lon = min(min_v0_lon, float(longitudes[0]))
-                min_v1_lon = min(min_v1_lon, float(longitudes[1]))
-                min_v2_lon = min(min_v2_lon, float(longitudes[2]))
-                min_v3_lon = min(min_v3_lon, float(longitudes[3]))
-                max_v0_lon = max(max_v0_lon, float(longitudes[0]))
-                max_v1_lon = max(max_v1_lon, float(longitudes[1]))
-                max_v2_lon = max(max_v2_lon, float(longitudes[2]))
-                max_v3_lon = max(max_v3_lon, float(longitudes[3]))
+from pha2 import FOOTPRINT_KEYS, GEOMETRY_KEYS, iter_pha2_spectra
+from peak_fitting import fit_gaussians, peak_windows
+from line_templates import fit_line_fluxes
+from background_library import get_background_library, read_background
+from rasterizer import EquirectangularRaster, FootprintCoverage, NAMED_COLORS, apply_colormap, colormap_lut
+from footprint_geometry import planar_parts, spherical_centroid
+
+# K-alpha line energies in keV, by atomic number
+K_ALPHA_LINES = {
+    8: 0.525,   # Oxygen
+    11: 1.040,  # Sodium
+    12: 1.253,  # Magnesium
+    13: 1.486,  # Aluminum
+    14: 1.739,  # Silicon
+    20: 3.691,  # Calcium
+    22: 4.510,  # Titanium
+    26: 6.403   # Iron
+}
+
+def integrate_fits_files(fits_filepaths, output_dir, header_index=None, cube=None, pha2_writer=None):
+    # header_index (optional): a FitsHeaderIndex (scripts/fits_index.py) whose rows are
+    # used for EXPOSURE, the footprint vertices and the geometry angles, so they match
+    # the metadata the files were selected by; files it does not hold fall back to their
+    # own header. Every file is still opened for its counts, so the index saves no reads here.
+    # cube (optional): a SpectralCube (scripts/spectral_cube.py) or a time slice of one;
+    # its spectra are integrated directly and fits_filepaths is ignored
+    # pha2_writer (optional): a pha2.PHA2Writer; the integrated spectrum is appended to it
+    # as one row instead of being written to its own file, and the row index is returned
+    # fits_filepaths may hold file objects (e.g. uploads read into io.BytesIO) with a
+    # .name in place of paths. With output_dir None nothing is written: the integrated
+    # spectrum is returned as a read_spectrum dict, ready for Extract_data.
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    if cube is not None:
+        if len(cube) == 0:
+            raise ValueError("The spectral cube (or time slice) holds no spectra to integrate")
+        counts_stack = cube.counts
+        n_valid = len(cube)
+        channels = np.arange(counts_stack.shape[1])
+        exposure_times = cube.meta['EXPOSURE'].tolist()
+        latitudes, longitudes = cube.footprints()
+        geometry = {key: cube.meta[key].tolist() for key in GEOMETRY_KEYS}
+        start_time = cube.meta['start_time'][0].astype(datetime)
+        end_time = cube.meta['end_time'][-1].astype(datetime)
+    else:
+        # Preallocate one row of counts per file and the four footprint vertices per file
+        counts_stack = None
+        channels = None
+        latitudes = np.empty((len(fits_filepaths), 4), dtype=np.float64)
+        longitudes = np.empty((len(fits_filepaths), 4), dtype=np.float64)
+        exposure_times = []
+        geometry = {key: [] for key in GEOMETRY_KEYS}
+        n_valid = 0
+
+        for fits_file in fits_filepaths:
+            with fits.open(fits_file) as hdul:
+                data = hdul[1].data
+                header = None
+                if header_index is not None and isinstance(fits_file, (str, os.PathLike)):
+                    header = header_index.get(fits_file)
+                if header is None:
+                    header = hdul[1].header
+
+                if data is not None:
+                    if counts_stack is None:
+                        channels = np.array(data['CHANNEL'])
+                        counts_stack = np.empty((len(fits_filepaths), len(channels)), dtype=np.float64)
+                    elif len(data['CHANNEL']) != len(channels):
+                        raise ValueError(f"{fits_file} has {len(data['CHANNEL'])} channels, expected {len(channels)}")
+
+                    counts_stack[n_valid] = data['COUNTS']
+                    exposure_times.append(header.get('EXPOSURE', 0))
+                    latitudes[n_valid] = [header.get(f'V{i}_LAT') for i in range(4)]
+                    longitudes[n_valid] = [header.get(f'V{i}_LON') for i in range(4)]
+                    for key in GEOMETRY_KEYS:
+                        geometry[key].append(header.get(key))
+                    n_valid += 1
+
+        first_file_name = os.path.basename(_source_name(fits_filepaths[0]))
+        start_time_str = first_file_name.split('.')[0].split('_')[3]
+        start_time = datetime.strptime(start_time_str, '%Y%m%dT%H%M%S%f')
+        last_file_name = os.path.basename(_source_name(fits_filepaths[-1]))
+        end_time_str = last_file_name.split('.')[0].split('_')[4]
+        end_time = datetime.strptime(end_time_str, '%Y%m%dT%H%M%S%f')
+
+    # Reduce all files at once: summed spectrum and per-vertex footprint bounds
+    if counts_stack is None:
+        channels = np.array([], dtype=np.int64)
+        summed_counts = np.array([], dtype=np.float64)
+    else:
+        summed_counts = counts_stack[:n_valid].sum(axis=0, dtype=np.float64)
+    total_exposure_time = sum(exposure_times)
+    min_lat, max_lat = latitudes[:n_valid].min(axis=0, initial=np.inf), latitudes[:n_valid].max(axis=0, initial=-np.inf)
+    min_lon, max_lon = longitudes[:n_valid].min(axis=0, initial=np.inf), longitudes[:n_valid].max(axis=0, initial=-np.inf)
 
     # Prepare data for the FITS file
-    channels = list(cumulative_counts_by_channel.keys())
-    summed_counts = list(cumulative_counts_by_channel.values())
-    energy_list = [channel * 0.0135 for channel in channels]
+    energy_list = channels * 0.0135
 
     # Define the output FITS filename
-    first_file_name = os.path.basename(fits_filepaths[0])
-    start_time_str = first_file_name.split('.')[0].split('_')[3]
-    start_time = datetime.strptime(start_time_str, '%Y%m%dT%H%M%S%f')
-    output_fits_file = os.path.join(output_dir, f"integrated_fits_{start_time.strftime('%Y%m%dT%H%M%S')}.fits")
+    output_name = f"integrated_fits_{start_time.strftime('%Y%m%dT%H%M%S')}"
+    footprint = {
+        'V0_LAT': float(max_lat[0]), 'V1_LAT': float(min_lat[1]), 'V2_LAT': float(min_lat[2]), 'V3_LAT': float(max_lat[3]),
+        'V0_LON': float(max_lon[0]), 'V1_LON': float(min_lon[1]), 'V2_LON': float(min_lon[2]), 'V3_LON': float(max_lon[3]),
+    }
+    if output_dir is None:
+        # Same values as read back from the file, whose SUMMED_COUNTS column is float32
+        return {'NAME': output_name, 'START_TIME': start_time.isoformat(timespec='milliseconds'),
+                'CHANNEL': channels, 'COUNTS': summed_counts.astype(np.float32), 'EXPOSURE': total_exposure_time,
+                **footprint}
+    output_fits_file = os.path.join(output_dir, f"{output_name}.fits")
+
+    if pha2_writer is not None:
+        # Mean geometry of the integrated files; angles no file has are stored as NaN
+        mean_geometry = {}
+        for key, values in geometry.items():
+            values = np.array([value for value in values if value is not None], dtype=np.float64)
+            if np.isfinite(values).any():
+                mean_geometry[key] = float(np.nanmean(values))
+        return pha2_writer.append(output_name, summed_counts, total_exposure_time,
+                                  start_time=start_time.isoformat(timespec='milliseconds'),
+                                  end_time=end_time.isoformat(timespec='milliseconds'),
+                                  **footprint, **mean_geometry)
 
     # Write the integrated FITS file
     hdu = fits.PrimaryHDU()
     columns = [
-        fits.Column(name='CHANNEL', format='J', array=np.array(channels)),
-        fits.Column(name='ENERGY', format='E', array=np.array(energy_list)),
-        fits.Column(name='SUMMED_COUNTS', format='E', array=np.array(summed_counts)),
+        fits.Column(name='CHANNEL', format='J', array=channels),
+        fits.Column(name='ENERGY', format='E', array=energy_list),
+        fits.Column(name='SUMMED_COUNTS', format='E', array=summed_counts),
     ]
     table_hdu = fits.BinTableHDU.from_columns(columns)
 
     # Add parameters to the header of the FITS file
     table_hdu.header['EXPOSURE'] = total_exposure_time
-    table_hdu.header['V0_LAT'] = max_v0_lat
-    table_hdu.header['V1_LAT'] = min_v1_lat
-    table_hdu.header['V2_LAT'] = min_v2_lat
-    table_hdu.header['V3_LAT'] = max_v3_lat
-    table_hdu.header['V0_LON'] = max_v0_lon
-    table_hdu.header['V1_LON'] = min_v1_lon
-    table_hdu.header['V2_LON'] = min_v2_lon
-    table_hdu.header['V3_LON'] = max_v3_lon
+    for key, value in footprint.items():
+        table_hdu.header[key] = value
 
     hdul = fits.HDUList([hdu, table_hdu])
     hdul.writeto(output_fits_file, overwrite=True)
 
     return output_fits_file
 
-def Extract_data(spectrum_file,background_dir,background_file=None,):
-    if background_file==None:
-        month = os.path.basename(spectrum_file).split('fits_')[1][4:6]
-        for i in os.listdir(background_dir):
-            if(i.split('.')[0].split('_')[-1] == month):
-                background_file = os.path.join(background_dir,i)
+def _source_name(source):
+    """File name of a FITS source: a path, or a file object carrying its name."""
+    return source if isinstance(source, (str, os.PathLike)) else source.name
+
+def read_spectrum(spectrum_file):
+    """Reads an integrated FITS file into the dict layout of the rows yielded by pha2.iter_pha2_spectra."""
+    if isinstance(spectrum_file, dict):
+        return spectrum_file
+    with fits.open(spectrum_file) as hdul:
+        spectrum_data = hdul[1].data
+        header = hdul[1].header  # Assuming relevant data is in the second HDU
+        spectrum = {
+            'NAME': spectrum_file,
+            'START_TIME': '',
+            'CHANNEL': np.array(spectrum_data['CHANNEL']),
+            'COUNTS': np.array(spectrum_data['SUMMED_COUNTS']),
+            'EXPOSURE': header['EXPOSURE'],
+        }
+        for key in FOOTPRINT_KEYS:
+            spectrum[key] = header[key]
+    return spectrum
+
+def load_background(spectrum, background_dir, background_file=None):
+    """Sliced background counts for a spectrum: background_file (a path or file object) if given, else the month's background_dir file."""
+    backgrounds = get_background_library(background_dir)
+    if background_file is not None and not isinstance(background_file, (str, os.PathLike)):
+        # An uploaded background held in memory: read it for this spectrum only
+        return read_background(background_file)
+    if background_file:
+        return backgrounds.from_file(background_file)
+    return backgrounds.for_spectrum(spectrum)
+
+def Extract_data(spectrum_file,background_dir,background_file=None,diagnostics=None):
+    # spectrum_file is either the path of an integrated FITS file or a row dict
+    # yielded by pha2.iter_pha2_spectra. Nothing is plotted here; pass a
+    # fit_diagnostics.FitDiagnostics to record the fits and plot them later.
+    spectrum = read_spectrum(spectrum_file)
+    record_fits = diagnostics is not None and diagnostics.wants(spectrum['NAME'])
+    background_counts = load_background(spectrum, background_dir, background_file)
     
-    k_alpha_lines = {
-        8: 0.525,   # Oxygen
-        11: 1.040,  # Sodium
-        12: 1.253,  # Magnesium
-        13: 1.486,  # Aluminum
-        14: 1.739,  # Silicon
-        20: 3.691,  # Calcium
-        22: 4.510,  # Titanium
-        26: 6.403   # Iron
-    }
+    k_alpha_lines = K_ALPHA_LINES
 
-    def gaussian(x, A, mu, sigma):
-        return A * np.exp(-0.5 * ((x - mu) / sigma) ** 2)
-        
-    def load_spectrum_data(fits_file, background_file=None):
-        with fits.open(fits_file) as hdul:
-            spectrum_data = hdul[1].data
-            channels = spectrum_data['CHANNEL']
-            counts = spectrum_data['SUMMED_COUNTS']
-            time = hdul[1].header['EXPOSURE']
+    def load_spectrum_data(spectrum, background_counts=None):
+        channels = spectrum['CHANNEL']
+        counts = spectrum['COUNTS']
+        time = spectrum['EXPOSURE']
             
         energy = np.array([13.58 * c / 1000 for c in channels])
         counts = np.array([c / time for c in counts])
@@ -144,11 +204,7 @@ def Extract_data(spectrum_file,background_dir,background_file=None,):
         energy = energy[valid_indices]
         counts = counts[valid_indices]
 
-        if background_file:
-            with fits.open(background_file) as bkg_hdul:
-                background_data = bkg_hdul[1].data
-            background_counts = background_data['MEAN_COUNTS'] 
-            background_counts = background_counts[37:299]
+        if background_counts is not None:
             corrected_counts =counts - background_counts
         # plt.plot(energy,corrected_counts)
         return energy, corrected_counts, counts, background_counts
@@ -165,42 +221,26 @@ def Extract_data(spectrum_file,background_dir,background_file=None,):
             prominence=threshold*0.5
         )
         
+        # Fit every peak window of the spectrum at once
+        energy_windows, counts_windows, window_masks, initial_guesses = peak_windows(energy, smoothed_counts, peaks)
+        fitted_params, converged = fit_gaussians(energy_windows, counts_windows, initial_guesses, window_masks)
+
         peaks_info = []
+        fits_found, failed_peaks = [], []
         
-        for peak in peaks:
-            window_size = 10
-            start = max(0, peak - window_size)
-            end = min(len(energy), peak + window_size)
-            
-            energy_window = energy[start:end]
-            counts_window = smoothed_counts[start:end]
-            
-            initial_guess = [
-                np.max(counts_window), 
-                energy[peak], 
-                0.1
-            ]
-            
-            try:
-                popt, _ = curve_fit(
-                    gaussian, 
-                    energy_window, 
-                    counts_window, 
-                    p0=initial_guess
-                )
-                
-                A, mu, sigma = popt
-                peaks_info.append((mu, sigma, A))
-                
-                fitted_curve = gaussian(energy_window, *popt)
-                plt.plot(energy_window, fitted_curve, 
-                         label=f'Peak at {mu:.2f} keV', 
-                         linestyle='--')
-                plt.axvline(mu, color='red', linestyle=':', alpha=0.7)
-            
-            except RuntimeError:
+        for peak, popt, fit_ok, energy_window, window_mask in zip(peaks, fitted_params, converged, energy_windows, window_masks):
+            if not fit_ok:
                 print(f"Fitting failed for peak at {energy[peak]} keV")
-        
+                failed_peaks.append(energy[peak])
+                continue
+
+            A, mu, sigma = popt
+            peaks_info.append((mu, sigma, A))
+            if record_fits:
+                fits_found.append((energy_window[window_mask], popt))
+
+        if record_fits:
+            diagnostics.record(spectrum['NAME'], energy, counts, smoothed_counts, fits_found, failed_peaks)
         return peaks_info
 
     def match_peaks_to_elements(peaks_info, k_alpha_lines, tolerance=0.2):
@@ -221,22 +261,21 @@ def Extract_data(spectrum_file,background_dir,background_file=None,):
         
         return matched_elements
 
-    energy, counts,real_, back = load_spectrum_data(spectrum_file, background_file)
+    energy, counts,real_, back = load_spectrum_data(spectrum, background_counts)
     peaks_info = identify_peaks(energy, counts)
     matched_elements = match_peaks_to_elements(peaks_info, k_alpha_lines)
 
-    with fits.open(spectrum_file) as hdul:
-        header = hdul[1].header  # Assuming relevant data is in the second HDU
+    header = spectrum
 
-        # Extract coordinates from the FITS header
-        v0_lat = header['V0_LAT']
-        v1_lat = header['V1_LAT']
-        v2_lat = header['V2_LAT']
-        v3_lat = header['V3_LAT']
-        v0_lon = header['V0_LON']
-        v1_lon = header['V1_LON']
-        v2_lon = header['V2_LON']
-        v3_lon = header['V3_LON']
+    # Extract coordinates from the FITS header
+    v0_lat = header['V0_LAT']
+    v1_lat = header['V1_LAT']
+    v2_lat = header['V2_LAT']
+    v3_lat = header['V3_LAT']
+    v0_lon = header['V0_LON']
+    v1_lon = header['V1_LON']
+    v2_lon = header['V2_LON']
+    v3_lon = header['V3_LON']
 
     # Extract raw fluxes for required elements, assigning 0 if not present
     raw_fluxes = {
@@ -273,7 +312,7 @@ def Extract_data(spectrum_file,background_dir,background_file=None,):
 
     # Append results for this FITS file
     result = {
-        "fits_file": spectrum_file,
+        "fits_file": spectrum['NAME'],
         "V0_LAT": v0_lat,
         "V1_LAT": v1_lat,
         "V2_LAT": v2_lat,
@@ -294,16 +333,76 @@ def Extract_data(spectrum_file,background_dir,background_file=None,):
 
     return result
 
-def get_heatmap(json_data):
-    lat_range = (-90, 90)
-    lon_range = (-180, 180)
-    img_width = 10726  # Desired width of the output image in pixels
-    img_height = 5360  # Desired height of the output image in pixels
-
-    # Load data from the CSV file
-    # csv_file = '/home/user/Desktop/INTER_IIT/csv/2020/Catalogue_3_2020 copy.csv'  # Update with the actual CSV file path
-    # df = pd.read_csv(csv_file)
-
+def Extract_data_table(pha2_file, background_dir, background_file=None, diagnostics=None):
+    """Runs Extract_data on every row of a PHA type II file, opening the file once."""
+    return [Extract_data(row, background_dir, background_file, diagnostics) for row in iter_pha2_spectra(pha2_file)]
+
+def Extract_data_templates(spectrum_files, background_dir, background_file=None, line_sigma=0.06, continuum_degree=2):
+    """
+    Fixed-line alternative to Extract_data for a batch of spectra.
+
+    Instead of smoothing, peak finding and one nonlinear fit per peak, every
+    background-corrected spectrum is modelled as a non-negative sum of Gaussian
+    templates at the K_ALPHA_LINES energies plus a Legendre continuum, and all
+    spectra are solved together by line_templates.fit_line_fluxes.
+
+    Returns one dict per spectrum with the same keys as Extract_data. The
+    "_uncer" values are the 1-sigma ratio uncertainties propagated from the fit
+    (-1 where the ratio is 0, as in Extract_data). All spectra must share one
+    CHANNEL grid; a spectrum with a different one raises ValueError.
+    """
+    spectra = [read_spectrum(spectrum_file) for spectrum_file in spectrum_files]
+    if not spectra:
+        return []
+
+    # All spectra are fitted on one energy grid, taken from the first spectrum
+    channels = np.asarray(spectra[0]['CHANNEL'])
+    valid_indices = (channels >= 37) & (channels < 299)
+    energy = 13.58 * channels[valid_indices] / 1000
+    rates = []
+    for spectrum in spectra:
+        if not np.array_equal(spectrum['CHANNEL'], channels):
+            raise ValueError(f"Spectrum {spectrum['NAME']} has a different CHANNEL grid than {spectra[0]['NAME']}")
+        background_counts = load_background(spectrum, background_dir, background_file)
+        rates.append(spectrum['COUNTS'][valid_indices] / spectrum['EXPOSURE'] - background_counts)
+
+    atomic_numbers = list(K_ALPHA_LINES)
+    fluxes, flux_errors = fit_line_fluxes(energy, np.array(rates), [K_ALPHA_LINES[z] for z in atomic_numbers],
+                                          line_sigma, continuum_degree)
+
+    si = atomic_numbers.index(14)
+    ratio_elements = {"Na/Si": 11, "Al/Si": 13, "Mg/Si": 12, "Ca/Si": 20}
+    results = []
+    for spectrum, flux, flux_error in zip(spectra, fluxes, flux_errors):
+        result = {"fits_file": spectrum['NAME']}
+        for key in FOOTPRINT_KEYS:
+            result[key] = spectrum[key]
+        uncertainties = {}
+        for ratio, atomic_num in ratio_elements.items():
+            element = atomic_numbers.index(atomic_num)
+            if flux[si] != 0 and flux[element]:
+                result[ratio] = flux[element] / flux[si]
+                uncertainties[f"{ratio}_uncer"] = result[ratio] * np.hypot(flux_error[element] / flux[element],
+                                                                           flux_error[si] / flux[si])
+            else:
+                result[ratio] = 0
+                uncertainties[f"{ratio}_uncer"] = -1
+        result.update(uncertainties)
+        results.append(result)
+    return results
+
+def get_heatmap(json_data, output_dir='Heatmaps'):
+    """
+    Renders one transparent equirectangular PNG per ratio of json_data into output_dir.
+
+    json_data holds the V0..V3 LAT/LON footprint and the ratios of one spectrum
+    (a result of Extract_data) or array-valued columns of many. Footprints are
+    filled with the turbo color of their ratio on a (0, 2) scale, split at the
+    antimeridian and capped at the poles, and each spherical centroid gets a
+    ratio-coloured ring. The geometry is rasterized once into a
+    FootprintCoverage shared by the four ratios, which are colored into an RGBA
+    array covering the full lat/lon range and encoded as PNG once each.
+    """
     # List of ratios to plot
     ratios = ["Na/Si", "Al/Si", "Mg/Si", "Ca/Si"]
     manual_ranges = {
@@ -319,76 +418,84 @@ def get_heatmap(json_data):
             "Mg/Si": 'green',
             "Na/Si": 'white',
         }
-    # Iterate over each ratio and create a heatmap
+    circle_radius = 7  # degrees
+    circle_line_width = 3 / 72 * 1000  # 3 pt at the 1000 dpi of the old pyplot figures, in pixels
+
+    lats = np.column_stack([np.atleast_1d(json_data[f"V{i}_LAT"]) for i in range(4)]).astype(np.float64)
+    lons = np.column_stack([np.atleast_1d(json_data[f"V{i}_LON"]) for i in range(4)]).astype(np.float64)
+    # Centroids on the sphere, which the mean of the vertices is not across 180 or around a pole
+    centroid_lons, centroid_lats = spherical_centroid(lons, lats)
+    part_lons, part_lats, owners = planar_parts(lons, lats)
+
+    # The footprints and rings are rasterized once; only their colors change per ratio
+    coverage = FootprintCoverage(EquirectangularRaster(), part_lons, part_lats, centroid_lons, centroid_lats,
+                                 circle_radius, circle_line_width, owners=owners)
+    lut = colormap_lut('turbo')
     for ratio in ratios:
-        # Set the DPI to get the exact pixel size
-        dpi = 1000  # Higher DPI for better quality
-
-        # Calculate figsize (in inches) for the desired pixel dimensions
-        figsize = (img_width / dpi, img_height / dpi)  # Convert pixel dimensions to inches
-
-        # Create a transparent figure with the specified dimensions
-        fig, ax = plt.subplots(figsize=figsize, dpi=dpi)
-        ax.set_facecolor('none')  # Transparent background
-
-        # Configure the plot axes to match the lat/lon range
-        ax.set_xlim(lon_range)
-        ax.set_ylim(lat_range)
-        ax.axis('off')  # Remove axes, labels, and ticks
-
         # Use the manual range if specified, otherwise fallback to automatic
+        ratio_values = np.atleast_1d(json_data[ratio]).astype(np.float64)
         if ratio in manual_ranges:
             min_val, max_val = manual_ranges[ratio]
         else:
-            min_val, max_val = json_data[ratio].min(), json_data[ratio].max()
-        norm = plt.Normalize(min_val, max_val)  # Normalize based on manual or automatic range         
+            min_val, max_val = ratio_values.min(), ratio_values.max()
 
-        # ]
-        # cmap = LinearSegmentedColormap.from_list('custom_cmap', colors)
-        cmap = plt.cm.turbo  # Choose a colormap
+        coverage.render(apply_colormap(ratio_values, min_val, max_val, lut), NAMED_COLORS[colors[ratio]])
 
-        # Iterate over each row in the CSV to extract coordinates and plot the heatmap
-        # Extract the coordinates from the CSV row
-        v0_lat, v1_lat, v2_lat, v3_lat = json_data["V0_LAT"], json_data["V1_LAT"], json_data["V2_LAT"], json_data["V3_LAT"]
-        v0_lon, v1_lon, v2_lon, v3_lon = json_data["V0_LON"], json_data["V1_LON"], json_data["V2_LON"], json_data["V3_LON"]
-        
-        # Coordinates for the bounding box
-        bounding_box_lons = [v0_lon, v1_lon, v2_lon, v3_lon, v0_lon]
-        bounding_box_lats = [v0_lat, v1_lat, v2_lat, v3_lat, v0_lat]
-        
-        # Get the ratio value for the current row
-        ratio_value = json_data[ratio]
-        centroid_lat = (json_data["V0_LAT"] + json_data["V1_LAT"] + json_data["V2_LAT"] + json_data["V3_LAT"]) / 4
-        centroid_lon = (json_data["V0_LON"] + json_data["V1_LON"] + json_data["V2_LON"] + json_data["V3_LON"]) / 4
-        
-        # Plot the filled polygon representing the bounding box with a color based on the ratio value
-        ax.fill(bounding_box_lons, bounding_box_lats, color=cmap(norm(ratio_value)), linewidth=0)
-        circle = Circle(
-            (centroid_lon, centroid_lat),  # Centroid coordinates (lon, lat)
-            radius=7,                    # Radius of the circle
-            edgecolor=colors[ratio],               # Border color
-            linewidth=3,                   # Border width
-            fill=False                     # Ensure the circle is not filled
-        )
-        ax.add_patch(circle)
-        # Save the plot with the specified dimensions and a transparent background
-        output_path = rf'Heatmaps/Heatmap_{ratio.replace("/", "_")}.png'
+        output_path = os.path.join(output_dir, f'Heatmap_{ratio.replace("/", "_")}.png')
         heatmap[ratio] = output_path
-        plt.savefig(output_path, transparent=True, bbox_inches='tight', pad_inches=0)
-        plt.close(fig)
+        coverage.raster.save_png(output_path)
     return heatmap
 
 
-def workflow(fits_dir, background_dir, output_dir, background_file):    
-    directory_data = os.listdir(fits_dir)
-    fits_file = []
-    for file in directory_data:
-        if(file.endswith('.fits')):
-            fits_file.append(os.path.join(fits_dir,file))    
-    summed_spectrum = integrate_fits_files(fits_file, output_dir)
-
+# Stages workflow reports through its progress callback, in order
+WORKFLOW_STAGES = ('integrating', 'fitting', 'rendering', 'tiling')
+# Part of the result cache key: bump it whenever a change alters what workflow produces
+WORKFLOW_VERSION = 1
+
+def workflow(fits_dir, background_dir, output_dir, background_file, tile_pyramid=None, heatmap_dir='Heatmaps',
+             progress=None, cache=None):
+    # fits_dir is a directory of FITS files, or the FITS sources themselves (paths or
+    # named file objects such as uploads in io.BytesIO), which are then processed
+    # without touching the disk; output_dir None keeps the integrated spectrum in memory
+    # progress (optional): called with each of WORKFLOW_STAGES as the workflow enters it
+    # cache (optional): a result_cache.ResultCache; inputs seen before return the cached
+    # heatmaps at once, and their footprint, already in tile_pyramid, is not added again
+    progress = progress or (lambda stage: None)
+    if isinstance(fits_dir, (str, os.PathLike)):
+        directory_data = os.listdir(fits_dir)
+        fits_file = []
+        for file in directory_data:
+            if(file.endswith('.fits')):
+                fits_file.append(os.path.join(fits_dir,file))    
+    else:
+        fits_file = [source for source in fits_dir if _source_name(source).endswith('.fits')]
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.key(fits_file, background_dir, background_file, {'workflow': WORKFLOW_VERSION})
+        entry = cache.get(cache_key)
+        if entry is not None:
+            return dict(entry['heatmaps'])
+
+    progress('integrating')
+    summed_spectrum = read_spectrum(integrate_fits_files(fits_file, output_dir))
+    return process_spectrum(summed_spectrum, background_dir, background_file, tile_pyramid, heatmap_dir, progress,
+                            cache, cache_key)
+
+def process_spectrum(summed_spectrum, background_dir, background_file, tile_pyramid=None, heatmap_dir='Heatmaps',
+                     progress=None, cache=None, cache_key=None):
+    # The stages of workflow after integration, for a spectrum integrated elsewhere
+    # (e.g. an upload_sessions.SpectrumAccumulator): fit, render, cache under cache_key, tile
+    progress = progress or (lambda stage: None)
+    progress('fitting')
     json_data = Extract_data(summed_spectrum, background_dir, background_file)    
-    heatmap_dict = get_heatmap(json_data) 
+    progress('rendering')
+    os.makedirs(heatmap_dir, exist_ok=True)
+    heatmap_dict = get_heatmap(json_data, heatmap_dir)
+    if cache is not None and cache_key is not None:
+        heatmap_dict = dict(cache.put(cache_key, summed_spectrum, json_data, heatmap_dict)['heatmaps'])
+    if tile_pyramid is not None:
+        # Re-render only the map tiles the new footprint falls on
+        progress('tiling')
+        tile_pyramid.update(json_data)
     print(heatmap_dict)
-    return heatmap_dict   
-
+    return heatmap_dict
@@ -1,12 +1,26 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
 import os
 from werkzeug.utils import secure_filename
-from Heatmap_overlay_generator import workflow
-import base64
+from Heatmap_overlay_generator import workflow, process_spectrum, WORKFLOW_STAGES, WORKFLOW_VERSION
+from jobs import JobQueue, QueueFull
+from result_cache import ResultCache
+from upload_sessions import UploadSessions, UnreadableUpload, UploadTooLarge
+from background_library import get_background_library
+from tiles import TilePyramid, RATIOS
+from equal_area_bins import EqualAreaBins
+import io
+import glob
+import tempfile
 
 app = Flask(__name__)
 CORS(app)
+tile_pyramid = None
+empty_tile = None
+ratio_bins = None
+job_queue = None
+result_cache = None
+upload_sessions = None
 
 
 @app.route("/get", methods=["GET"])
@@ -25,35 +39,196 @@ def handle_post():
             return jsonify({"error": "No files part in the request"}), 400
 
         files = request.files.getlist("files")
-        saved_files = []
-        bkg_filename = None
-        for file in files:
-            if file.filename == "":
-                return jsonify({"error": "No selected file"}), 400
-            if file:
-                filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config["UPLOAD_FOLDER"], filename))
-                saved_files.append(filename)
+        if any(file.filename == "" for file in files):
+            return jsonify({"error": "No selected file"}), 400
+        # The uploads are processed from memory: nothing is saved next to other requests' files
+        fits_sources = [read_upload(file) for file in files]
         bkg_file = request.files.get("backgroundFile", None)
-        if bkg_file:
-            bkg_filename = secure_filename(bkg_file.filename)
-            bkg_file.save(os.path.join(app.config["UPLOAD_FOLDER"], bkg_filename))
-            saved_files.append(bkg_filename)
+        bkg_source = read_upload(bkg_file) if bkg_file else None
 
-
-        heatmap_dict = workflow(app.config['UPLOAD_FOLDER'], app.config["BG_FOLDER"], app.config["OUTPUT"], bkg_filename)    
-        for key, filepath in heatmap_dict.items():
-            with open(filepath, "rb") as image_file:
-                encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-                heatmap_dict[key] = encoded_string
-
-        response = {"message": "Success", "heatmap_images": [heatmap_dict]}
-        
-        return jsonify(response)
+        job = job_queue.submit(run_upload_job, fits_sources, bkg_source, stages=WORKFLOW_STAGES)
+        return jsonify({"message": "Queued", "job_id": job.id, "status_url": f"/jobs/{job.id}",
+                        "files": [source.name for source in fits_sources]}), 202
+    except QueueFull as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
         print(f"Error: {e}")
         return jsonify({"error": str(e)}), 500
 
+def read_upload(file):
+    """An uploaded file as an io.BytesIO named after it, which astropy reads like a file on disk."""
+    source = io.BytesIO(file.read())
+    source.name = secure_filename(file.filename)
+    return source
+
+def run_upload_job(fits_sources, bkg_source, progress):
+    """The work of one upload, run by the job queue: the result is what /upload used to return."""
+    # Scratch space of this job only (the heatmap PNGs), removed as soon as the job ends
+    with tempfile.TemporaryDirectory(dir=app.config["UPLOAD_FOLDER"]) as workspace:
+        return upload_result(workflow(fits_sources, app.config["BG_FOLDER"], None, bkg_source,
+                                      tile_pyramid, workspace, progress, result_cache))
+
+def upload_result(heatmap_dict):
+    """
+    The result of an upload job: the URL of each heatmap and, when tiles are kept, the tile URL template.
+
+    The heatmaps are those of the result cache entry, served by /heatmaps, so
+    the job result stays a few hundred bytes whatever the size of the images.
+    The URLs last as long as the entry: once evicted, they answer 404.
+    """
+    if result_cache is None:
+        raise RuntimeError("Heatmaps are served from the result cache, which is not configured")
+    for ratio, filepath in heatmap_dict.items():
+        heatmap_dict[ratio] = f"/heatmaps/{result_cache.key_of(filepath)}/{ratio.replace('/', '_')}.png"
+
+    result = {"message": "Success", "heatmap_images": [heatmap_dict]}
+    if tile_pyramid is not None:
+        result["tile_url"] = f"/tiles/{{ratio}}/{{z}}/{{x}}/{{y}}.{tile_pyramid.image_format}"
+    return result
+
+@app.route("/uploads", methods=["POST"])
+def handle_upload_init():
+    # Opens a chunked upload: {"files": [{"name", "size"}, ...], "background": {"name", "size"} (optional)}
+    body = request.get_json(silent=True) or {}
+    try:
+        files = [(secure_filename(f["name"]), int(f["size"])) for f in body.get("files", [])]
+        background = body.get("background")
+        if background:
+            background = (secure_filename(background["name"]), int(background["size"]))
+        session = upload_sessions.create(files, background or None)
+    except UploadTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": f"Bad upload declaration: {e}"}), 400
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 503
+    return jsonify({"session_id": session.id, "status_url": f"/uploads/{session.id}",
+                    "chunk_url": f"/uploads/{session.id}/files/{{name}}?offset={{offset}}",
+                    "files": [name for name, _ in files],
+                    "background": background[0] if background else None}), 201
+
+@app.route("/uploads/<session_id>", methods=["GET"])
+def handle_upload_status(session_id):
+    # Bytes received per file, to resume an interrupted upload
+    session = upload_sessions.get(session_id)
+    if session is None:
+        return jsonify({"error": "No such upload session"}), 404
+    return jsonify(session.status())
+
+@app.route("/uploads/<session_id>/files/<name>", methods=["PUT"])
+def handle_upload_chunk(session_id, name):
+    # Raw bytes of a file from ?offset=; ?background=1 for the background file
+    session = upload_sessions.get(session_id)
+    if session is None:
+        return jsonify({"error": "No such upload session"}), 404
+    offset = request.args.get("offset", 0, type=int)
+    try:
+        state = session.append(secure_filename(name), offset, request.get_data(),
+                               background=request.args.get("background") == "1")
+    except KeyError:
+        return jsonify({"error": f"{name} was not declared"}), 404
+    except UnreadableUpload as e:
+        # Not a CLASS L1 file: the client should give up on it rather than resend it
+        return jsonify({"error": str(e), "session": session.status()}), 422
+    except ValueError as e:
+        return jsonify({"error": str(e), "session": session.status()}), 409
+    return jsonify(state)
+
+@app.route("/uploads/<session_id>/finalize", methods=["POST"])
+def handle_upload_finalize(session_id):
+    # Every file is integrated already: queue the fit and render stages only
+    session = upload_sessions.get(session_id)
+    if session is None:
+        return jsonify({"error": "No such upload session"}), 404
+    try:
+        spectrum, bkg_source, digests, bkg_digest = session.finalize()
+        cache_key = result_cache.key_from_digests(digests, app.config["BG_FOLDER"], bkg_digest,
+                                                  {'workflow': WORKFLOW_VERSION})
+        job = job_queue.submit(run_session_job, spectrum, bkg_source, cache_key,
+                               stages=WORKFLOW_STAGES[1:])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 409
+    except QueueFull as e:
+        return jsonify({"error": str(e)}), 503
+    upload_sessions.close(session_id)
+    return jsonify({"message": "Queued", "job_id": job.id, "status_url": f"/jobs/{job.id}"}), 202
+
+def run_session_job(spectrum, bkg_source, cache_key, progress):
+    """Fit and render of a finalized upload session, through the result cache like run_upload_job."""
+    entry = result_cache.get(cache_key)
+    if entry is not None:
+        return upload_result(dict(entry['heatmaps']))
+    with tempfile.TemporaryDirectory(dir=app.config["UPLOAD_FOLDER"]) as workspace:
+        return upload_result(process_spectrum(spectrum, app.config["BG_FOLDER"], bkg_source, tile_pyramid,
+                                              workspace, progress, result_cache, cache_key))
+
+@app.route("/heatmaps/<key>/<ratio>.png", methods=["GET"])
+def handle_heatmap(key, ratio):
+    # A heatmap of an upload result, e.g. /heatmaps/<key>/Mg_Si.png
+    image = result_cache.heatmap(key, ratio.replace("_", "/"))
+    if image is None:
+        return jsonify({"error": "No such heatmap: it may have been evicted from the result cache, "
+                                 "upload the files again"}), 404
+    # The entry of a key only ever holds the same images: cache for long, revalidate by ETag
+    return send_file(image, mimetype="image/png", conditional=True, etag=f"{key}-{ratio}",
+                     max_age=app.config["HEATMAP_MAX_AGE"])
+
+@app.route("/cache", methods=["GET"])
+def handle_cache():
+    # Hit/miss counts and size of the result cache, for monitoring
+    return jsonify(result_cache.stats())
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def handle_job(job_id):
+    # Status and per-stage progress of an upload; the result once it is done
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "No such job"}), 404
+    return jsonify(job.to_dict())
+
+@app.route("/tiles/<ratio>/<int:z>/<int:x>/<int:y>.<ext>", methods=["GET"])
+def handle_tile(ratio, z, x, y, ext):
+    # ratio is written with an underscore, e.g. /tiles/Na_Si/3/10/2.png
+    global empty_tile
+    if tile_pyramid is None or ratio.replace("_", "/") not in RATIOS or ext != tile_pyramid.image_format or not 0 <= z <= tile_pyramid.max_zoom \
+            or not 0 <= x < 2 ** (z + 1) or not 0 <= y < 2 ** z:
+        return jsonify({"error": "No such tile"}), 404
+    mimetype = f"image/{ext}"
+    path = tile_pyramid.tile_path(ratio, z, x, y)
+    if os.path.exists(path):
+        # Tiles change when new footprints land on them: cache briefly, then revalidate by ETag
+        return send_file(os.path.abspath(path), mimetype=mimetype, conditional=True, etag=True,
+                         max_age=app.config["TILE_MAX_AGE"])
+    # Nothing has been mapped here yet: one shared transparent tile
+    if empty_tile is None:
+        empty_tile = tile_pyramid.empty_tile()
+    return send_file(io.BytesIO(empty_tile), mimetype=mimetype, etag="empty-tile", conditional=True,
+                     max_age=app.config["TILE_MAX_AGE"])
+
+@app.route("/bins/<ratio>", methods=["GET"])
+def handle_bins(ratio):
+    # Binned ratio statistics of a region, e.g. /bins/Mg_Si?resolution=2&lon_min=-30&lon_max=30
+    ratio = ratio.replace("_", "/")
+    if ratio not in RATIOS:
+        return jsonify({"error": "No such ratio"}), 404
+    level = request.args.get("level", type=int)
+    if level is not None and not 0 <= level <= ratio_bins.max_level:
+        return jsonify({"error": f"level must be between 0 and {ratio_bins.max_level}"}), 400
+    table = ratio_bins.query(ratio, level,
+                             (request.args.get("lon_min", -180, type=float), request.args.get("lon_max", 180, type=float)),
+                             (request.args.get("lat_min", -90, type=float), request.args.get("lat_max", 90, type=float)),
+                             request.args.get("resolution", type=float))
+    return jsonify({"ratio": ratio, "pixels": table.to_dict(orient="records")})
+
+@app.route("/bins/<ratio>/<int:level>.png", methods=["GET"])
+def handle_bins_map(ratio, level):
+    if ratio.replace("_", "/") not in RATIOS or not 0 <= level <= ratio_bins.max_level:
+        return jsonify({"error": "No such map"}), 404
+    path = os.path.join(app.config["BIN_MAPS"], f"{ratio}_{level}.png")
+    if not os.path.exists(path):
+        ratio_bins.render(ratio.replace("_", "/"), level, path)
+    return send_file(os.path.abspath(path), mimetype="image/png", conditional=True, etag=True)
+
 @app.errorhandler(Exception)
 def handle_exception(e):
     print(f"Error: {e}")
@@ -65,10 +240,32 @@ if __name__ == "__main__":
         UPLOAD_FOLDER = 'uploads'
         app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
         app.config['BG_FOLDER'] = 'background_month'
-        app.config['OUTPUT'] = 'integrated_files'
         os.makedirs(UPLOAD_FOLDER, exist_ok=True) 
         os.makedirs(app.config['BG_FOLDER'], exist_ok=True)
-        os.makedirs(app.config['OUTPUT'], exist_ok=True)
+        # Read every monthly background once, before serving requests
+        get_background_library(app.config['BG_FOLDER'])
+        app.config['TILES'] = 'tiles'
+        app.config['TILE_MAX_AGE'] = 60
+        tile_pyramid = TilePyramid(app.config['TILES'])
+        app.config['JOB_WORKERS'] = 2
+        app.config['MAX_PENDING_JOBS'] = 8
+        job_queue = JobQueue(app.config['JOB_WORKERS'], app.config['MAX_PENDING_JOBS'])
+        app.config['RESULT_CACHE'] = 'result_cache'
+        app.config['RESULT_CACHE_BYTES'] = 1 << 30
+        result_cache = ResultCache(app.config['RESULT_CACHE'], app.config['RESULT_CACHE_BYTES'])
+        app.config['HEATMAP_MAX_AGE'] = 86400
+        # Largest file a chunked upload may declare; its bytes are held in memory until complete
+        app.config['MAX_UPLOAD_FILE_BYTES'] = 64 << 20
+        upload_sessions = UploadSessions(max_file_bytes=app.config['MAX_UPLOAD_FILE_BYTES'])
+        # Equal-area ratio statistics of the catalogues, binned once and kept with the rendered maps
+        app.config['BINS'] = 'bins.npz'
+        app.config['BIN_MAPS'] = 'bin_maps'
+        os.makedirs(app.config['BIN_MAPS'], exist_ok=True)
+        if os.path.exists(app.config['BINS']):
+            ratio_bins = EqualAreaBins.load(app.config['BINS'])
+        else:
+            ratio_bins = EqualAreaBins.from_catalogues(sorted(glob.glob('../Frontend/public/2021/*.csv')))
+            ratio_bins.save(app.config['BINS'])
 
         app.run(debug=True, host="0.0.0.0", port=5000)
         
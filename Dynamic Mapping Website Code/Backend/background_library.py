@@ -0,0 +1,101 @@
+import os
+import re
+import numpy as np
+from astropy.io import fits
+
+# Channels used by Extract_data: 37..298, i.e. MEAN_COUNTS[37:299]
+FIRST_CHANNEL = 37
+LAST_CHANNEL = 299
+
+_BACKGROUND_NAME = re.compile(r'_(\d{4})_(\d{2})\.fits$')
+
+def read_background(source):
+    """Sliced MEAN_COUNTS of a background file, from a path or a file object (e.g. an upload held in memory)."""
+    with fits.open(source) as bkg_hdul:
+        background_counts = np.array(bkg_hdul[1].data['MEAN_COUNTS'][FIRST_CHANNEL:LAST_CHANNEL], dtype=np.float32)
+    background_counts.flags.writeable = False
+    return background_counts
+
+class BackgroundLibrary:
+    """
+    All monthly backgrounds of a background_month directory, read once and indexed by (year, month).
+
+    Every background is stored already sliced to the Extract_data channel range,
+    so looking one up for a spectrum is a dict access. Backgrounds given
+    explicitly by path (e.g. an uploaded backgroundFile) are kept as well, up
+    to max_files of them, and read again whenever the file changes.
+
+    Use get_background_library() to share one instance per process between the
+    batch scripts and the web workers.
+    """
+
+    def __init__(self, background_dir, max_files=32):
+        self.background_dir = background_dir
+        self.max_files = max_files
+        self.channels = np.arange(FIRST_CHANNEL, LAST_CHANNEL)
+        self.energy = 13.58 * self.channels / 1000
+        self.backgrounds = {}
+        self.files = {}
+        self._by_month = {}
+        self._by_path = {}
+        for filename in sorted(os.listdir(background_dir)):
+            match = _BACKGROUND_NAME.search(filename)
+            if match is None:
+                continue
+            year, month = int(match.group(1)), int(match.group(2))
+            path = os.path.join(background_dir, filename)
+            self.backgrounds[(year, month)] = self.from_file(path)
+            self.files[(year, month)] = path
+            # Spectra of a year without a background use the latest year with that month
+            self._by_month[month] = (year, month)
+
+    def __len__(self):
+        return len(self.backgrounds)
+
+    def __contains__(self, year_month):
+        return year_month in self.backgrounds
+
+    def from_file(self, path):
+        """Returns the sliced MEAN_COUNTS of a background file, read again only when its size or mtime changed."""
+        key = os.path.abspath(path)
+        stat = os.stat(key)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        cached = self._by_path.pop(key, None)
+        if cached is None or cached[0] != signature:
+            cached = (signature, read_background(key))
+        # Most recently used last; the least recently used file is forgotten beyond max_files
+        self._by_path[key] = cached
+        while len(self._by_path) > self.max_files:
+            del self._by_path[next(iter(self._by_path))]
+        return cached[1]
+
+    def lookup(self, year, month):
+        """Returns the background of (year, month), falling back to the same month of another year, or None."""
+        year_month = (year, month)
+        if year_month not in self.backgrounds:
+            year_month = self._by_month.get(month)
+        return self.backgrounds.get(year_month)
+
+    def for_spectrum(self, spectrum):
+        """Returns the background for a spectrum dict of Heatmap_overlay_generator.read_spectrum, or None."""
+        year, month = spectrum_year_month(spectrum)
+        return self.lookup(year, month)
+
+
+def spectrum_year_month(spectrum):
+    """(year, month) of a spectrum, from START_TIME or else from its integrated_fits_YYYYmmddTHHMMSS name."""
+    if spectrum.get('START_TIME'):
+        timestamp = spectrum['START_TIME']
+        return int(timestamp[0:4]), int(timestamp[5:7])
+    timestamp = os.path.basename(spectrum['NAME']).split('fits_')[1]
+    return int(timestamp[0:4]), int(timestamp[4:6])
+
+
+_libraries = {}
+
+def get_background_library(background_dir):
+    """Returns the process-wide BackgroundLibrary of background_dir, loading it on first use."""
+    key = os.path.abspath(background_dir)
+    if key not in _libraries:
+        _libraries[key] = BackgroundLibrary(background_dir)
+    return _libraries[key]
@@ -0,0 +1,184 @@
+import os
+import csv
+import argparse
+from datetime import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pha2 import FOOTPRINT_KEYS, is_pha2_file, read_pha2_index, read_pha2_rows
+from background_library import get_background_library
+from Heatmap_overlay_generator import Extract_data, Extract_data_templates
+
+RATIO_KEYS = ['Na/Si', 'Al/Si', 'Mg/Si', 'Ca/Si']
+
+# Columns of the ratio catalogues, e.g. Frontend/public/xrf_ratios_nov2021.csv
+CATALOGUE_COLUMNS = (['start_time'] + FOOTPRINT_KEYS + RATIO_KEYS +
+                     [f'{ratio}_uncer' for ratio in RATIO_KEYS])
+
+def catalogue_time(spectrum_name, start_time=''):
+    """Catalogue start_time (YYYYmmddTHHMMSS) from an ISO START_TIME or an integrated_fits_YYYYmmddTHHMMSS name."""
+    if start_time:
+        return datetime.fromisoformat(start_time).strftime('%Y%m%dT%H%M%S')
+    return os.path.basename(spectrum_name).split('fits_')[1][:15]
+
+def list_spectra(inputs):
+    """
+    Lists the spectra of integrated FITS files, PHA type II tables and directories of either, in time order.
+
+    Returns (start_time, source, row) tuples: source is a file path and row is
+    None for an integrated file, or the row index within a PHA type II table.
+    Only the table index (NAME, START_TIME) is read, never the spectra.
+    """
+    spectra = []
+    for path in inputs:
+        if os.path.isdir(path):
+            paths = sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(('.fits', '.pha')))
+        else:
+            paths = [path]
+        for spectrum_path in paths:
+            if is_pha2_file(spectrum_path):
+                for row, (name, start_time) in enumerate(read_pha2_index(spectrum_path)):
+                    spectra.append((catalogue_time(name, start_time), spectrum_path, row))
+            elif os.path.basename(spectrum_path).startswith('integrated_fits_'):
+                spectra.append((catalogue_time(spectrum_path), spectrum_path, None))
+    spectra.sort(key=lambda spectrum: spectrum[0])
+    return spectra
+
+def _init_worker(background_dir):
+    # Worker-local background cache: every monthly background is read once per process
+    get_background_library(background_dir)
+
+def _load_chunk(chunk):
+    """
+    Reads the spectra of a chunk, opening each PHA type II table once for all of its rows.
+
+    A table that cannot be read gives its exception in place of each of its spectra.
+    """
+    table_rows = {}
+    for _, source, row in chunk:
+        if row is not None:
+            table_rows.setdefault(source, []).append(row)
+    loaded = {}
+    for source, rows in table_rows.items():
+        try:
+            loaded[source] = dict(zip(rows, read_pha2_rows(source, rows)))
+        except Exception as e:
+            loaded[source] = {row: e for row in rows}
+    return [source if row is None else loaded[source][row] for _, source, row in chunk]
+
+def _spectrum_label(source, row):
+    return source if row is None else f"{source}[{row}]"
+
+def _extract_chunk(chunk, background_dir, background_file, method):
+    """
+    Worker: runs the extraction on a chunk of spectra.
+
+    Returns its catalogue rows, in chunk order, and (spectrum, error) pairs of
+    the spectra whose extraction failed, which have no row: one bad spectrum
+    does not cost the rest of its chunk.
+    """
+    spectra = _load_chunk(chunk)
+    results = [None] * len(spectra)
+    failures = []
+    readable = [i for i, spectrum in enumerate(spectra) if not isinstance(spectrum, Exception)]
+    if method == 'templates':
+        # Templates are fitted a chunk at a time; spectra are only fitted alone when that fails
+        try:
+            for i, result in zip(readable, Extract_data_templates([spectra[i] for i in readable],
+                                                                  background_dir, background_file)):
+                results[i] = result
+        except Exception:
+            for i in readable:
+                try:
+                    results[i] = Extract_data_templates([spectra[i]], background_dir, background_file)[0]
+                except Exception as e:
+                    spectra[i] = e
+    else:
+        for i in readable:
+            try:
+                results[i] = Extract_data(spectra[i], background_dir, background_file)
+            except Exception as e:
+                spectra[i] = e
+
+    rows = []
+    for (start_time, source, row), spectrum, result in zip(chunk, spectra, results):
+        if isinstance(spectrum, Exception):
+            failures.append((_spectrum_label(source, row), f"{type(spectrum).__name__}: {spectrum}"))
+            continue
+        try:
+            rows.append([start_time] + [float(result[key]) for key in CATALOGUE_COLUMNS[1:]])
+        except Exception as e:
+            failures.append((_spectrum_label(source, row), f"{type(e).__name__}: {e}"))
+    return rows, failures
+
+def build_catalogue(inputs, output_csv, background_dir, background_file=None, processes=None, chunk_size=64,
+                    method='peaks'):
+    """
+    Extracts the ratios of every spectrum of inputs on a process pool and writes them as a catalogue CSV.
+
+    Spectra are submitted in time-ordered chunks of chunk_size, with at most two
+    chunks per worker in flight; finished chunks are written in submission order,
+    so the CSV is in time order and memory stays bounded however many spectra
+    there are. Each worker loads the background library once at start-up.
+    Spectra whose extraction fails are reported and left out of the catalogue.
+
+    Parameters:
+    - inputs (list): Integrated FITS files, PHA type II tables, or directories of them.
+    - output_csv (str): Path of the catalogue, with the CATALOGUE_COLUMNS columns.
+    - background_dir (str): The background_month directory.
+    - background_file (str, optional): One background for every spectrum instead of the monthly ones.
+    - processes (int, optional): Number of worker processes, defaults to the number of cores.
+    - chunk_size (int): Spectra per task.
+    - method (str): 'peaks' for Extract_data, 'templates' for Extract_data_templates.
+
+    Returns the number of spectra written.
+    """
+    if method not in ('peaks', 'templates'):
+        raise ValueError(f"Unknown extraction method: {method}")
+    spectra = list_spectra(inputs)
+    chunks = (spectra[i:i + chunk_size] for i in range(0, len(spectra), chunk_size))
+
+    processes = processes or os.cpu_count()
+    n_spectra = 0
+    n_failed = 0
+
+    def write_chunk(future):
+        nonlocal n_spectra, n_failed
+        rows, failures = future.result()
+        csv_writer.writerows(rows)
+        n_spectra += len(rows)
+        for spectrum, error in failures:
+            print(f"Skipping {spectrum}: {error}")
+        n_failed += len(failures)
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=(background_dir,)) as executor, \
+            open(output_csv, mode='w', newline='') as csvfile:
+        csv_writer = csv.writer(csvfile)
+        csv_writer.writerow(CATALOGUE_COLUMNS)
+        max_in_flight = 2 * processes
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_extract_chunk, chunk, background_dir, background_file, method))
+            if len(pending) >= max_in_flight:
+                write_chunk(pending.popleft())
+        while pending:
+            write_chunk(pending.popleft())
+    if n_failed:
+        print(f"{n_failed} spectra could not be extracted and were skipped.")
+    return n_spectra
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a ratio catalogue CSV from integrated spectra.")
+    parser.add_argument('inputs', nargs='+', help="Integrated FITS files, PHA type II tables or directories of them")
+    parser.add_argument('-o', '--output', required=True, help="Catalogue CSV to write")
+    parser.add_argument('--background-dir', default='background_month')
+    parser.add_argument('--background-file', default=None)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=64)
+    parser.add_argument('--method', choices=['peaks', 'templates'], default='peaks')
+    args = parser.parse_args()
+
+    n_spectra = build_catalogue(args.inputs, args.output, args.background_dir, args.background_file,
+                                args.processes, args.chunk_size, args.method)
+    print(f"Processing complete. {n_spectra} spectra saved to {args.output}.")
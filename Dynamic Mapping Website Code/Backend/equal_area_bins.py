@@ -0,0 +1,274 @@
+import numpy as np
+import pandas as pd
+from footprint_geometry import spherical_centroid
+from rasterizer import EquirectangularRaster, apply_colormap, colormap_lut
+
+RATIOS = ["Na/Si", "Al/Si", "Mg/Si", "Ca/Si"]
+STATISTICS = ('pixels', 'weight', 'mean', 'm2', 'count')
+
+# Column offset and ring-phase of each of the 12 base pixels of the nested HEALPix scheme
+_FACE_ROW = np.array([2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4])
+_FACE_PHASE = np.array([1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7])
+
+def _spread_bits(values):
+    """Moves bit i of values to bit 2i (the Morton interleave of one coordinate)."""
+    values = np.asarray(values, dtype=np.int64)
+    spread = np.zeros_like(values)
+    for bit in range(31):
+        spread |= ((values >> bit) & 1) << (2 * bit)
+    return spread
+
+def _compact_bits(values):
+    """Inverse of _spread_bits: gathers bits 0, 2, 4, ... of values."""
+    values = np.asarray(values, dtype=np.int64)
+    compact = np.zeros_like(values)
+    for bit in range(31):
+        compact |= ((values >> (2 * bit)) & 1) << bit
+    return compact
+
+def n_pixels(level):
+    """Number of pixels of a level: 12 * 4**level, all of the same area."""
+    return 12 * 4 ** level
+
+def lonlat_to_pixel(lons, lats, level):
+    """
+    Nested HEALPix index at level (nside = 2**level) of the pixel holding each lon/lat in degrees.
+
+    In the nested scheme the pixel of level l - 1 containing pixel p of level l
+    is p // 4, so a pixel's children are the 4 consecutive indices 4p .. 4p + 3.
+    """
+    nside = 2 ** level
+    lons = np.asarray(lons, dtype=np.float64)
+    z = np.sin(np.radians(np.asarray(lats, dtype=np.float64)))
+    tt = np.mod(lons, 360.0) / 90.0  # in [0, 4)
+    za = np.abs(z)
+
+    # Equatorial belt (|z| <= 2/3): pixel boundaries are lines in (tt, z)
+    temp1 = nside * (0.5 + tt)
+    temp2 = nside * z * 0.75
+    jp = (temp1 - temp2).astype(np.int64)
+    jm = (temp1 + temp2).astype(np.int64)
+    ifp, ifm = jp // nside, jm // nside
+    face_eq = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix_eq = jm & (nside - 1)
+    iy_eq = nside - (jp & (nside - 1)) - 1
+
+    # Polar caps: the same in (tt, sqrt(1 - |z|))
+    ntt = np.minimum(tt.astype(np.int64), 3)
+    tp = tt - ntt
+    tmp = nside * np.sqrt(3 * (1 - za))
+    jp_pol = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+    jm_pol = np.minimum(((1 - tp) * tmp).astype(np.int64), nside - 1)
+    north = z >= 0
+    face_pol = np.where(north, ntt, ntt + 8)
+    ix_pol = np.where(north, nside - jm_pol - 1, jp_pol)
+    iy_pol = np.where(north, nside - jp_pol - 1, jm_pol)
+
+    equatorial = za <= 2 / 3
+    face = np.where(equatorial, face_eq, face_pol)
+    ix = np.where(equatorial, ix_eq, ix_pol)
+    iy = np.where(equatorial, iy_eq, iy_pol)
+    return face * nside * nside + _spread_bits(ix) + (_spread_bits(iy) << 1)
+
+def pixel_to_lonlat(pixels, level):
+    """(lon, lat) in degrees of the centres of nested pixels of a level, lon in [-180, 180)."""
+    nside = 2 ** level
+    pixels = np.asarray(pixels, dtype=np.int64)
+    face = pixels // (nside * nside)
+    within = pixels % (nside * nside)
+    ix = _compact_bits(within)
+    iy = _compact_bits(within >> 1)
+
+    ring = _FACE_ROW[face] * nside - ix - iy - 1  # 1 .. 4 nside - 1, from the north pole
+    north_cap = ring < nside
+    south_cap = ring > 3 * nside
+    n_ring = np.where(north_cap, ring, np.where(south_cap, 4 * nside - ring, nside))
+    z = np.where(north_cap, 1 - n_ring ** 2 / (3.0 * nside ** 2),
+                 np.where(south_cap, n_ring ** 2 / (3.0 * nside ** 2) - 1, (2 * nside - ring) * 2 / (3.0 * nside)))
+    shift = np.where(north_cap | south_cap, 0, (ring - nside) & 1)
+    jp = (_FACE_PHASE[face] * n_ring + ix - iy + 1 + shift) // 2
+    jp = np.where(jp > 4 * nside, jp - 4 * nside, np.where(jp < 1, jp + 4 * nside, jp))
+    lons = (jp - (shift + 1) * 0.5) * 90.0 / n_ring
+    return (lons + 180) % 360 - 180, np.degrees(np.arcsin(z))
+
+def level_for_resolution(degrees, max_level):
+    """The coarsest level whose pixels are at most degrees across, capped at max_level."""
+    # Pixels of level l are sqrt(4 pi / 12) / 2**l radians (about 58.6 / 2**l degrees) across
+    level = int(np.ceil(np.log2(np.degrees(np.sqrt(np.pi / 3)) / degrees)))
+    return int(np.clip(level, 0, max_level))
+
+def merge_statistics(pixels, weight, mean, m2, count):
+    """
+    Combines statistics of repeated pixel indices into one row per pixel.
+
+    weight is the summed weight, mean the weighted mean and m2 the weighted sum
+    of squared deviations from it; groups are merged with Chan's parallel
+    formulas, which stay accurate where the sum-of-squares form cancels.
+    """
+    if len(pixels) == 0:
+        return pixels, weight, mean, m2, count
+    order = np.argsort(pixels, kind='stable')
+    pixels, weight, mean, m2, count = pixels[order], weight[order], mean[order], m2[order], count[order]
+    starts = np.flatnonzero(np.r_[True, pixels[1:] != pixels[:-1]])
+    group_weight = np.add.reduceat(weight, starts)
+    group_mean = np.add.reduceat(weight * mean, starts) / group_weight
+    deviation = mean - np.repeat(group_mean, np.diff(np.r_[starts, len(pixels)]))
+    group_m2 = np.add.reduceat(m2 + weight * deviation ** 2, starts)
+    return pixels[starts], group_weight, group_mean, group_m2, np.add.reduceat(count, starts)
+
+
+class EqualAreaBins:
+    """
+    Ratio statistics binned on a hierarchical equal-area (nested HEALPix) pixelization.
+
+    Every footprint is binned at its spherical centroid in the finest level
+    (max_level, nside = 2**max_level). For each ratio and each level 0..max_level
+    the occupied pixels keep the uncertainty-weighted mean, the weighted
+    variance and the number of footprints, so maps and region queries at any
+    zoom read a precomputed level instead of the raw footprints. Coarser levels
+    are merged from the finest one: pixel p has parent p // 4.
+
+    Footprints without a ratio (ratio 0 with _uncer -1) are skipped. Weights are
+    1 / max(_uncer, min_uncertainty) ** 2, as in GlobalMosaic's inverse_variance.
+
+    Usage:
+        bins = EqualAreaBins.from_catalogues(glob.glob('2021/*.csv'))
+        bins.save('bins.npz')
+        table = bins.query('Mg/Si', level=5, lon_range=(-30, 30), lat_range=(-20, 20))
+    """
+
+    def __init__(self, max_level=8, min_uncertainty=1e-6):
+        self.max_level = max_level
+        self.min_uncertainty = min_uncertainty
+        empty = {name: np.zeros(0, dtype=np.int64 if name in ('pixels', 'count') else np.float64)
+                 for name in STATISTICS}
+        # levels[ratio][level] -> {'pixels', 'weight', 'mean', 'm2', 'count'} arrays, sorted by pixel
+        self.levels = {ratio: [dict(empty) for _ in range(max_level + 1)] for ratio in RATIOS}
+
+    @classmethod
+    def from_catalogues(cls, csv_paths, max_level=8, min_uncertainty=1e-6):
+        bins = cls(max_level, min_uncertainty)
+        for csv_path in csv_paths:
+            bins.add_catalogue(csv_path)
+        return bins
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as store:
+            bins = cls(int(store['max_level']), float(store['min_uncertainty']))
+            for ratio in RATIOS:
+                for level in range(bins.max_level + 1):
+                    bins.levels[ratio][level] = {name: store[f"{ratio.replace('/', '_')}_{level}_{name}"]
+                                                 for name in STATISTICS}
+        return bins
+
+    def save(self, path):
+        arrays = {f"{ratio.replace('/', '_')}_{level}_{name}": stats[name]
+                  for ratio in RATIOS for level, stats in enumerate(self.levels[ratio]) for name in STATISTICS}
+        np.savez(path, max_level=self.max_level, min_uncertainty=self.min_uncertainty, **arrays)
+
+    def add(self, results):
+        """
+        Bins footprints: one Extract_data result, a list of them, or array-valued columns
+        (e.g. a catalogue DataFrame). Returns the number of footprints added per ratio.
+        """
+        if isinstance(results, list):
+            if not results:
+                return {ratio: 0 for ratio in RATIOS}
+            results = {key: [result[key] for result in results] for key in results[0]}
+        lats = np.column_stack([np.atleast_1d(results[f"V{i}_LAT"]) for i in range(4)]).astype(np.float64)
+        lons = np.column_stack([np.atleast_1d(results[f"V{i}_LON"]) for i in range(4)]).astype(np.float64)
+        pixels = lonlat_to_pixel(*spherical_centroid(lons, lats), self.max_level)
+
+        added = {}
+        for ratio in RATIOS:
+            if ratio not in results:
+                added[ratio] = 0
+                continue
+            values = np.atleast_1d(results[ratio]).astype(np.float64)
+            uncertainties = np.atleast_1d(results.get(f"{ratio}_uncer", np.zeros_like(values))).astype(np.float64)
+            valid = np.isfinite(values) & ~((values == 0) & (uncertainties == -1))
+            weights = 1 / np.maximum(np.abs(uncertainties[valid]), self.min_uncertainty) ** 2
+
+            finest = self.levels[ratio][self.max_level]
+            merged = merge_statistics(np.concatenate([finest['pixels'], pixels[valid]]),
+                                      np.concatenate([finest['weight'], weights]),
+                                      np.concatenate([finest['mean'], values[valid]]),
+                                      np.concatenate([finest['m2'], np.zeros(valid.sum())]),
+                                      np.concatenate([finest['count'], np.ones(valid.sum(), dtype=np.int64)]))
+            self.levels[ratio][self.max_level] = dict(zip(STATISTICS, merged))
+            self._rebuild_levels(ratio)
+            added[ratio] = int(valid.sum())
+        return added
+
+    def add_catalogue(self, csv_path):
+        """Bins the footprints of a ratio catalogue CSV; single-ratio catalogues only add that ratio."""
+        return self.add({column: values.to_numpy() for column, values in pd.read_csv(csv_path).items()})
+
+    def _rebuild_levels(self, ratio):
+        for level in range(self.max_level - 1, -1, -1):
+            child = self.levels[ratio][level + 1]
+            merged = merge_statistics(child['pixels'] // 4, child['weight'], child['mean'], child['m2'], child['count'])
+            self.levels[ratio][level] = dict(zip(STATISTICS, merged))
+
+    def statistics(self, ratio, level):
+        """DataFrame of the occupied pixels of a level: pixel, lon, lat (centre), mean, variance, error, count."""
+        stats = self.levels[ratio][level]
+        lons, lats = pixel_to_lonlat(stats['pixels'], level)
+        return pd.DataFrame({
+            'pixel': stats['pixels'],
+            'lon': lons,
+            'lat': lats,
+            'mean': stats['mean'],
+            'variance': stats['m2'] / stats['weight'],     # weighted spread of the ratios in the pixel
+            'error': 1 / np.sqrt(stats['weight']),         # uncertainty of the weighted mean
+            'count': stats['count'],
+        })
+
+    def query(self, ratio, level=None, lon_range=(-180, 180), lat_range=(-90, 90), resolution=None):
+        """
+        Statistics of the pixels of a level whose centre lies in a lon/lat box.
+
+        Pass level, or resolution (degrees) to pick the coarsest level at least
+        that fine. lon_range may wrap across 180 (lon_range[1] < lon_range[0]).
+        """
+        if level is None:
+            level = self.max_level if resolution is None else level_for_resolution(resolution, self.max_level)
+        if not 0 <= level <= self.max_level:
+            raise ValueError(f"level must be between 0 and {self.max_level}")
+        table = self.statistics(ratio, level)
+        lon_offset = (table['lon'] - lon_range[0]) % 360
+        width = 360 if lon_range[1] - lon_range[0] >= 360 else (lon_range[1] - lon_range[0]) % 360
+        inside = (lon_offset <= width) & (table['lat'] >= lat_range[0]) & (table['lat'] <= lat_range[1])
+        return table[inside].reset_index(drop=True)
+
+    def query_point(self, ratio, lon, lat, level=None):
+        """Statistics of the pixel of a level holding lon/lat, or None if nothing was binned there."""
+        level = self.max_level if level is None else level
+        stats = self.levels[ratio][level]
+        pixel = lonlat_to_pixel(lon, lat, level)
+        position = np.searchsorted(stats['pixels'], pixel)
+        if position == len(stats['pixels']) or stats['pixels'][position] != pixel:
+            return None
+        return {'pixel': int(pixel), 'mean': float(stats['mean'][position]),
+                'variance': float(stats['m2'][position] / stats['weight'][position]),
+                'error': float(1 / np.sqrt(stats['weight'][position])), 'count': int(stats['count'][position])}
+
+    def mean_map(self, ratio, level, width=2048, height=1024):
+        """Equirectangular (height, width) map of the weighted means of a level, NaN where nothing was binned."""
+        raster = EquirectangularRaster(width, height)
+        lons = raster.lon_range[0] + (np.arange(width) + 0.5) / raster.pixels_per_lon
+        lats = raster.lat_range[1] - (np.arange(height) + 0.5) / raster.pixels_per_lat
+        pixels = lonlat_to_pixel(lons[None, :], lats[:, None], level)
+        stats = self.levels[ratio][level]
+        if len(stats['pixels']) == 0:
+            return np.full((height, width), np.nan)
+        position = np.minimum(np.searchsorted(stats['pixels'], pixels), len(stats['pixels']) - 1)
+        return np.where(stats['pixels'][position] == pixels, stats['mean'][position], np.nan)
+
+    def render(self, ratio, level, output, width=2048, height=1024, vmin=0, vmax=2):
+        """Writes the mean map of a level as a turbo-colored transparent PNG over the full lat/lon range."""
+        raster = EquirectangularRaster(width, height)
+        raster.rgba[...] = apply_colormap(self.mean_map(ratio, level, width, height), vmin, vmax, colormap_lut('turbo'))
+        raster.save_png(output)
+        return output
@@ -0,0 +1,74 @@
+import os
+import numpy as np
+from peak_fitting import gaussian
+
+class FitDiagnostics:
+    """
+    Opt-in record of the peak fits made by Extract_data, plotted only on request.
+
+    Extraction never plots by itself. Passing an instance as
+    Extract_data(..., diagnostics=diagnostics) keeps the corrected and smoothed
+    spectrum and the converged Gaussian fits of the spectra named in `spectra`
+    (paths, basenames or PHA-II row names; every spectrum if None). render()
+    draws one recorded spectrum on its own Figure, without touching pyplot's
+    global state, so it is safe in the Flask process and in workers.
+
+    Usage:
+        diagnostics = FitDiagnostics(['integrated_fits_20200201T000000.fits'])
+        Extract_data(spectrum_file, background_dir, diagnostics=diagnostics)
+        diagnostics.render('integrated_fits_20200201T000000.fits', 'fits.png')
+    """
+
+    def __init__(self, spectra=None):
+        self.spectra = None if spectra is None else {str(name) for name in spectra}
+        self.records = {}
+
+    def wants(self, name):
+        """True if fits of the spectrum called name should be recorded."""
+        if self.spectra is None:
+            return True
+        name = str(name)
+        return name in self.spectra or os.path.basename(name) in self.spectra
+
+    def record(self, name, energy, corrected_counts, smoothed_counts, fits, failed_peaks=()):
+        """Stores the spectrum and its fits; fits holds (energy_window, (A, mu, sigma)) per converged peak."""
+        if not self.wants(name):
+            return
+        self.records[str(name)] = {
+            'energy': np.array(energy),
+            'corrected_counts': np.array(corrected_counts),
+            'smoothed_counts': np.array(smoothed_counts),
+            'fits': [(np.array(energy_window), tuple(float(p) for p in popt)) for energy_window, popt in fits],
+            'failed_peaks': [float(e) for e in failed_peaks],
+        }
+
+    def _find(self, name):
+        name = str(name)
+        if name in self.records:
+            return self.records[name]
+        for recorded_name, record in self.records.items():
+            if os.path.basename(recorded_name) == name:
+                return record
+        raise KeyError(f"No fits recorded for {name}")
+
+    def render(self, name, output_path=None):
+        """Plots a recorded spectrum with its fitted peaks. Saves it to output_path if given and returns the Figure."""
+        from matplotlib.figure import Figure
+
+        record = self._find(name)
+        fig = Figure(figsize=(10, 6))
+        ax = fig.add_subplot()
+        ax.plot(record['energy'], record['corrected_counts'], label='Corrected counts')
+        ax.plot(record['energy'], record['smoothed_counts'], label='Smoothed counts')
+        for energy_window, (A, mu, sigma) in record['fits']:
+            ax.plot(energy_window, gaussian(energy_window, A, mu, sigma),
+                    label=f'Peak at {mu:.2f} keV',
+                    linestyle='--')
+            ax.axvline(mu, color='red', linestyle=':', alpha=0.7)
+        ax.set_xlabel('Energy (keV)')
+        ax.set_ylabel('Counts/s')
+        ax.set_title(os.path.basename(str(name)))
+        ax.legend()
+        if output_path is not None:
+            fig.savefig(output_path)
+        return fig
@@ -0,0 +1,205 @@
+import os
+import numpy as np
+import pandas as pd
+from rasterizer import EquirectangularGrid
+from footprint_geometry import unwrap_longitudes, footprint_bounds, planar_parts, spherical_area
+
+RATIOS = ["Na/Si", "Al/Si", "Mg/Si", "Ca/Si"]
+LAT_COLUMNS = [f"V{i}_LAT" for i in range(4)]
+LON_COLUMNS = [f"V{i}_LON" for i in range(4)]
+
+def polygon_area(lons, lats):
+    """Planar shoelace area in square degrees of every footprint, the polygon_area of the catalogues."""
+    lons = np.atleast_2d(np.asarray(lons, dtype=np.float64))
+    lats = np.atleast_2d(np.asarray(lats, dtype=np.float64))
+    return 0.5 * np.abs(np.sum(lons * np.roll(lats, -1, axis=1) - np.roll(lons, -1, axis=1) * lats, axis=1))
+
+
+class FootprintIndex:
+    """
+    Grid hash of footprint bounding boxes for bbox and point queries.
+
+    The sphere is cut into cell_size-degree lat/lon cells and every footprint
+    is listed under each cell its bounding box touches. Bounding boxes come
+    from footprint_bounds, so footprints crossing the antimeridian are listed
+    on both sides of it and footprints around a pole in every cell of its cap.
+    The cell lists are stored as one sorted array with per-cell offsets.
+    """
+
+    def __init__(self, lons, lats, cell_size=1.0):
+        self.lons = np.atleast_2d(np.asarray(lons, dtype=np.float64))
+        self.lats = np.atleast_2d(np.asarray(lats, dtype=np.float64))
+        self.cell_size = cell_size
+        self.n_lon_cells = int(np.ceil(360 / cell_size))
+        self.n_lat_cells = int(np.ceil(180 / cell_size))
+        self.lon_min, self.lon_max, self.lat_min, self.lat_max = footprint_bounds(self.lons, self.lats)
+
+        col0 = np.floor((self.lon_min + 180) / cell_size).astype(np.int64)
+        col1 = np.floor((self.lon_max + 180) / cell_size).astype(np.int64)
+        col1 = np.minimum(col1, col0 + self.n_lon_cells - 1)
+        row0 = self._lat_row(self.lat_min)
+        row1 = self._lat_row(self.lat_max)
+
+        # Expand every footprint into the (row, col) cells of its bounding box at once
+        n_cols = col1 - col0 + 1
+        n_rows = row1 - row0 + 1
+        n_cells = n_cols * n_rows
+        footprint_ids = np.repeat(np.arange(len(self.lons)), n_cells)
+        within = np.arange(n_cells.sum()) - np.repeat(np.cumsum(n_cells) - n_cells, n_cells)
+        rows = np.repeat(row0, n_cells) + within // np.repeat(n_cols, n_cells)
+        cols = (np.repeat(col0, n_cells) + within % np.repeat(n_cols, n_cells)) % self.n_lon_cells
+        cell_ids = rows * self.n_lon_cells + cols
+
+        order = np.argsort(cell_ids, kind='stable')
+        self.footprint_ids = footprint_ids[order]
+        self.cell_offsets = np.searchsorted(cell_ids[order], np.arange(self.n_lat_cells * self.n_lon_cells + 1))
+
+    def __len__(self):
+        return len(self.lons)
+
+    def _lat_row(self, lat):
+        return np.clip(np.floor((np.asarray(lat) + 90) / self.cell_size).astype(np.int64), 0, self.n_lat_cells - 1)
+
+    def _candidates(self, rows, cols):
+        cells = (rows[:, None] * self.n_lon_cells + cols[None, :]).ravel()
+        starts, stops = self.cell_offsets[cells], self.cell_offsets[cells + 1]
+        lengths = stops - starts
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return np.unique(self.footprint_ids[positions])
+
+    def query_bbox(self, lon_min, lon_max, lat_min, lat_max):
+        """Indices of the footprints whose bounding box overlaps the box; lon_max < lon_min wraps across 180."""
+        width = 360.0 if lon_max - lon_min >= 360 else (lon_max - lon_min) % 360
+        lon_min = (lon_min + 180) % 360 - 180
+        lon_max = lon_min + width
+        col0 = int(np.floor((lon_min + 180) / self.cell_size))
+        col1 = int(np.floor((lon_max + 180) / self.cell_size))
+        cols = np.arange(col0, min(col1, col0 + self.n_lon_cells - 1) + 1) % self.n_lon_cells
+        rows = np.arange(self._lat_row(lat_min), self._lat_row(lat_max) + 1)
+        candidates = self._candidates(rows, cols)
+
+        # Exact bounding-box test, comparing longitudes modulo 360
+        c_min, c_max = self.lon_min[candidates], self.lon_max[candidates]
+        lon_overlap = np.zeros(len(candidates), dtype=bool)
+        for offset in (-360, 0, 360):
+            lon_overlap |= (c_min + offset <= lon_max) & (c_max + offset >= lon_min)
+        lat_overlap = (self.lat_min[candidates] <= lat_max) & (self.lat_max[candidates] >= lat_min)
+        return candidates[lon_overlap & lat_overlap]
+
+    def query_point(self, lon, lat):
+        """Indices of the footprints that contain the point, by the even-odd rule in unwrapped lon/lat."""
+        lon = (lon + 180) % 360 - 180
+        col = int(np.floor((lon + 180) / self.cell_size)) % self.n_lon_cells
+        candidates = self._candidates(np.array([self._lat_row(lat)]), np.array([col]))
+        if len(candidates) == 0:
+            return candidates
+        unwrapped, winding = unwrap_longitudes(self.lons[candidates])
+        lats = self.lats[candidates]
+        # Bring every footprint next to the point's longitude
+        unwrapped = unwrapped - np.round((unwrapped.mean(axis=1, keepdims=True) - lon) / 360) * 360
+
+        polar = np.abs(winding) > 180
+        inside = np.zeros(len(candidates), dtype=bool)
+        if (~polar).any():
+            x, y = unwrapped[~polar], lats[~polar]
+            x_end, y_end = np.roll(x, -1, axis=1), np.roll(y, -1, axis=1)
+            crosses = (y <= lat) != (y_end <= lat)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_cross = x + (lat - y) / (y_end - y) * (x_end - x)
+            inside[~polar] = ((crosses & (x_cross < lon)).sum(axis=1) % 2) == 1
+        if polar.any():
+            # A footprint around a pole holds the point if the point is poleward of its
+            # boundary at the point's longitude
+            for i in np.nonzero(polar)[0]:
+                boundary_lons = np.append(unwrapped[i], unwrapped[i, 0] + winding[i])
+                boundary_lats = np.append(lats[i], lats[i, 0])
+                order = np.argsort(boundary_lons)
+                point_lon = (lon - boundary_lons.min()) % 360 + boundary_lons.min()
+                boundary_lat = np.interp(point_lon, boundary_lons[order], boundary_lats[order])
+                inside[i] = lat >= boundary_lat if lats[i].mean() > 0 else lat <= boundary_lat
+        return candidates[inside]
+
+
+class FootprintCatalogue:
+    """
+    A ratio catalogue (e.g. xrf_ratios_nov2021.csv) with a FootprintIndex over its footprints.
+
+    Usage:
+        catalogue = FootprintCatalogue.from_csv('xrf_ratios_nov2021.csv')
+        catalogue.write_unoverlapped('2021', 11)   # 2021/Catalogue_11_unoverlaped_Na_Si.csv, ...
+    """
+
+    def __init__(self, table, cell_size=1.0):
+        self.table = table.reset_index(drop=True)
+        self.lons = self.table[LON_COLUMNS].to_numpy(dtype=np.float64)
+        self.lats = self.table[LAT_COLUMNS].to_numpy(dtype=np.float64)
+        self.index = FootprintIndex(self.lons, self.lats, cell_size)
+
+    @classmethod
+    def from_csv(cls, csv_path, cell_size=1.0):
+        return cls(pd.read_csv(csv_path), cell_size)
+
+    def __len__(self):
+        return len(self.table)
+
+    def query_bbox(self, lon_min, lon_max, lat_min, lat_max):
+        """Rows whose footprint bounding box overlaps the box."""
+        return self.table.iloc[self.index.query_bbox(lon_min, lon_max, lat_min, lat_max)]
+
+    def query_point(self, lon, lat):
+        """Rows whose footprint contains the point."""
+        return self.table.iloc[self.index.query_point(lon, lat)]
+
+    def unoverlap(self, ratio, max_overlap=0.1, resolution=0.1, detected_only=True):
+        """
+        Picks a set of footprints that barely overlap, preferring the best measured.
+
+        Footprints with a detected ratio are visited from the smallest {ratio}_uncer
+        up (larger footprints on the sphere first on ties), followed, unless detected_only, by
+        the undetected ones (ratio 0, _uncer -1). Each is kept if at most
+        max_overlap of its area is already covered by kept footprints. Coverage
+        is tracked on a resolution-degree occupancy grid, drawing footprints
+        split at the antimeridian and capped at the poles by planar_parts, so
+        each footprint costs only its own pixels and the pass is linear in the
+        catalogue size.
+
+        Returns a table in the Catalogue_*_unoverlaped_* layout: the V0..V3 LAT/LON
+        columns, the ratio, its _uncer and polygon_area, largest footprints first.
+        """
+        uncer = f"{ratio}_uncer"
+        values = self.table[ratio].to_numpy(dtype=np.float64)
+        uncertainties = self.table[uncer].to_numpy(dtype=np.float64)
+        areas = polygon_area(self.lons, self.lats)
+        sphere_areas = spherical_area(self.lons, self.lats)
+        detected = (values != 0) & (uncertainties != -1) & np.isfinite(values)
+        candidates = np.nonzero(detected | (not detected_only))[0]
+        candidates = candidates[np.lexsort((-sphere_areas[candidates],
+                                            np.where(detected[candidates], uncertainties[candidates], 0),
+                                            ~detected[candidates]))]
+
+        grid = EquirectangularGrid(int(round(360 / resolution)), int(round(180 / resolution)))
+        occupied = np.zeros((grid.height, grid.width), dtype=bool)
+        part_lons, part_lats, owners = planar_parts(self.lons[candidates], self.lats[candidates])
+        kept = []
+        masks = grid.footprint_masks(part_lons, part_lats, owners, len(candidates))
+        for footprint, (rows, cols, mask) in zip(candidates, masks):
+            pixels = mask.sum()
+            if pixels == 0:
+                continue
+            if occupied[rows, cols][mask].sum() <= max_overlap * pixels:
+                occupied[rows, cols][mask] = True
+                kept.append(footprint)
+
+        kept = np.array(kept, dtype=np.int64)
+        result = self.table.iloc[kept][LAT_COLUMNS + LON_COLUMNS + [ratio, uncer]].copy()
+        result['polygon_area'] = areas[kept]
+        return result.sort_values('polygon_area', ascending=False, kind='stable').reset_index(drop=True)
+
+    def write_unoverlapped(self, output_dir, catalogue_number, ratios=RATIOS, **kwargs):
+        """Writes {output_dir}/Catalogue_{n}_unoverlaped_{Na_Si}.csv for every ratio. Returns the paths."""
+        paths = []
+        for ratio in ratios:
+            path = os.path.join(output_dir, f"Catalogue_{catalogue_number}_unoverlaped_{ratio.replace('/', '_')}.csv")
+            self.unoverlap(ratio, **kwargs).to_csv(path, index=False)
+            paths.append(path)
+        return paths
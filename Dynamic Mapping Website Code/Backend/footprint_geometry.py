@@ -0,0 +1,227 @@
+import numpy as np
+
+MOON_RADIUS_KM = 1737.4
+
+def to_unit_vectors(lons, lats):
+    """Unit vectors (..., 3) of lon/lat in degrees."""
+    lon = np.radians(np.asarray(lons, dtype=np.float64))
+    lat = np.radians(np.asarray(lats, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)], axis=-1)
+
+def to_lonlat(vectors):
+    """lon/lat in degrees of (..., 3) vectors, which need not be normalized."""
+    vectors = np.asarray(vectors, dtype=np.float64)
+    lons = np.degrees(np.arctan2(vectors[..., 1], vectors[..., 0]))
+    lats = np.degrees(np.arctan2(vectors[..., 2], np.hypot(vectors[..., 0], vectors[..., 1])))
+    return lons, lats
+
+def unwrap_longitudes(lons):
+    """
+    Makes the longitudes of each footprint continuous across +-180.
+
+    Every vertex is moved by a multiple of 360 so that it is within 180 degrees
+    of the previous one. Returns (unwrapped lons, winding), where winding is
+    the total longitude turned around the footprint: +-360 for a footprint
+    that encloses a pole, 0 otherwise.
+    """
+    lons = np.atleast_2d(np.asarray(lons, dtype=np.float64))
+    steps = np.diff(lons, axis=1)
+    steps = (steps + 180) % 360 - 180
+    unwrapped = np.concatenate([lons[:, :1], lons[:, :1] + np.cumsum(steps, axis=1)], axis=1)
+    closing = (lons[:, 0] - lons[:, -1] + 180) % 360 - 180
+    winding = steps.sum(axis=1) + closing
+    return unwrapped, winding
+
+def encloses_pole(lons):
+    """+1 / -1 / 0 per footprint: the footprint winds around a pole (sign of the winding) or not."""
+    _, winding = unwrap_longitudes(lons)
+    return np.where(np.abs(winding) > 180, np.sign(winding), 0).astype(np.int64)
+
+def footprint_bounds(lons, lats):
+    """
+    (lon_min, lon_max, lat_min, lat_max) of every footprint, aware of the antimeridian and the poles.
+
+    lon_min is in [-180, 180) and lon_max may exceed 180 for footprints that
+    cross the antimeridian. Footprints around a pole span all longitudes and
+    extend to that pole.
+    """
+    lats = np.atleast_2d(np.asarray(lats, dtype=np.float64))
+    unwrapped, winding = unwrap_longitudes(lons)
+    lon_min = unwrapped.min(axis=1)
+    lon_max = unwrapped.max(axis=1)
+    shift = np.floor((lon_min + 180) / 360) * 360
+    lon_min, lon_max = lon_min - shift, lon_max - shift
+    lat_min = lats.min(axis=1)
+    lat_max = lats.max(axis=1)
+
+    polar = np.abs(winding) > 180
+    north = polar & (lats.mean(axis=1) > 0)
+    lon_min[polar], lon_max[polar] = -180.0, 180.0
+    lat_max[north] = 90.0
+    lat_min[polar & ~north] = -90.0
+    return lon_min, lon_max, lat_min, lat_max
+
+def _fan_triangles(vectors):
+    """Signed spherical excess (n, k - 2) and vertex-sum directions (n, k - 2, 3) of the fan triangles of each polygon."""
+    a = vectors[:, :1, :]
+    b = vectors[:, 1:-1, :]
+    c = vectors[:, 2:, :]
+    triple = np.einsum('nkj,nkj->nk', np.broadcast_to(a, b.shape), np.cross(b, c))
+    denominator = (1 + np.einsum('nkj,nkj->nk', np.broadcast_to(a, b.shape), b)
+                   + np.einsum('nkj,nkj->nk', b, c)
+                   + np.einsum('nkj,nkj->nk', c, np.broadcast_to(a, c.shape)))
+    excess = 2 * np.arctan2(triple, denominator)
+    return excess, a + b + c
+
+def spherical_area(lons, lats, radius=MOON_RADIUS_KM):
+    """
+    Area of every footprint with great-circle edges, in km^2 on a sphere of radius km (steradians for radius 1).
+
+    Computed from the signed spherical excess of the triangles fanned from the
+    first vertex, so it is exact across the antimeridian and around the poles.
+    """
+    vectors = to_unit_vectors(np.atleast_2d(lons), np.atleast_2d(lats))
+    excess, _ = _fan_triangles(vectors)
+    return np.abs(excess.sum(axis=1)) * radius ** 2
+
+def spherical_centroid(lons, lats):
+    """
+    (lon, lat) of the centroid of every footprint on the sphere.
+
+    The area-weighted mean of the fan triangle centroids, as a direction, so
+    it is correct across the antimeridian and for footprints over a pole where
+    the mean of the vertex coordinates is not.
+    """
+    vectors = to_unit_vectors(np.atleast_2d(lons), np.atleast_2d(lats))
+    excess, directions = _fan_triangles(vectors)
+    norms = np.linalg.norm(directions, axis=-1, keepdims=True)
+    # Clockwise footprints have negative excess everywhere: weigh by the excess relative to the total
+    orientation = np.where(excess.sum(axis=1) < 0, -1.0, 1.0)
+    centroid = np.einsum('nk,nkj->nj', excess * orientation[:, None], directions / np.where(norms > 0, norms, 1))
+    # Degenerate (zero-area) footprints fall back to the mean vertex direction
+    degenerate = np.linalg.norm(centroid, axis=1) < 1e-15
+    centroid[degenerate] = vectors[degenerate].sum(axis=1)
+    return to_lonlat(centroid)
+
+def _pad_polygons(points, valid):
+    """Packs the valid points of every row to the front, repeating the last valid point as padding."""
+    order = np.argsort(~valid, axis=1, kind='stable')
+    packed = np.take_along_axis(points, order[:, :, None], axis=1)
+    n_valid = valid.sum(axis=1)
+    last = np.take_along_axis(packed, np.maximum(n_valid - 1, 0)[:, None, None], axis=1)
+    padding = np.arange(points.shape[1])[None, :] >= n_valid[:, None]
+    return np.where(padding[:, :, None], last, packed), n_valid
+
+def clip_longitude(lons, lats, limit, keep_below=True):
+    """
+    Clips planar lon/lat polygons to lon <= limit (or >= limit) with Sutherland-Hodgman, for all polygons at once.
+
+    Returns (lons, lats, n_vertices) with 2k vertex columns; rows with fewer
+    vertices repeat their last one, which the even-odd fill ignores.
+    """
+    lons = np.atleast_2d(lons)
+    lats = np.atleast_2d(lats)
+    next_lons, next_lats = np.roll(lons, -1, axis=1), np.roll(lats, -1, axis=1)
+    inside = lons <= limit if keep_below else lons >= limit
+    next_inside = np.roll(inside, -1, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (limit - lons) / (next_lons - lons)
+        cross_lats = lats + t * (next_lats - lats)
+
+    # Every edge emits its start vertex if inside, then the crossing if it leaves or enters
+    points = np.stack([np.stack([lons, lats], axis=-1),
+                       np.stack([np.full_like(lons, limit), cross_lats], axis=-1)], axis=2)
+    valid = np.stack([inside, inside != next_inside], axis=2)
+    n = len(lons)
+    packed, n_valid = _pad_polygons(points.reshape(n, -1, 2), valid.reshape(n, -1))
+    return packed[:, :, 0], packed[:, :, 1], n_valid
+
+def great_circle_points(lons, lats, segments):
+    """
+    Splits every edge of every footprint into segments pieces along its great circle.
+
+    Returns (lons, lats) with k * segments vertices per footprint, the
+    original vertices at every segments-th column.
+    """
+    vectors = to_unit_vectors(np.atleast_2d(lons), np.atleast_2d(lats))
+    starts = vectors[:, :, None, :]
+    ends = np.roll(vectors, -1, axis=1)[:, :, None, :]
+    angle = np.arccos(np.clip(np.einsum('nkj,nkj->nk', vectors, ends[:, :, 0, :]), -1, 1))[:, :, None, None]
+    t = (np.arange(segments) / segments)[None, None, :, None]
+    # Spherical linear interpolation, which tends to the straight chord for zero-length edges
+    with np.errstate(divide='ignore', invalid='ignore'):
+        start_weight = np.where(angle > 1e-12, np.sin((1 - t) * angle) / np.sin(angle), 1 - t)
+        end_weight = np.where(angle > 1e-12, np.sin(t * angle) / np.sin(angle), t)
+    points = start_weight * starts + end_weight * ends
+    return to_lonlat(points.reshape(len(vectors), -1, 3))
+
+def planar_parts(lons, lats, max_lon_span=10.0, segments=16):
+    """
+    Splits footprints into polygons drawable on a flat lon [-180, 180] x lat [-90, 90] map.
+
+    Footprints crossing the antimeridian are cut in two at +-180, and a
+    footprint around a pole becomes the cap between its boundary and the pole,
+    cut at +-180 as well. The rasterizer draws edges straight in lon/lat, which
+    is far from the great circle for footprints around a pole or wider than
+    max_lon_span degrees of longitude, so the edges of those are split into
+    segments pieces along their great circles first.
+
+    Returns (part_lons, part_lats, owners): (m, k) vertex arrays of the parts,
+    padded by repeating the last vertex, and the footprint index of each part.
+    """
+    lons = np.atleast_2d(np.asarray(lons, dtype=np.float64))
+    lats = np.atleast_2d(np.asarray(lats, dtype=np.float64))
+    unwrapped, winding = unwrap_longitudes(lons)
+    polar = np.abs(winding) > 180
+    curved = polar | (unwrapped.max(axis=1) - unwrapped.min(axis=1) > max_lon_span)
+    if curved.any() and segments > 1:
+        dense_lons, dense_lats = great_circle_points(lons[curved], lats[curved], segments)
+        dense_unwrapped, _ = unwrap_longitudes(dense_lons)
+        pad = dense_lons.shape[1] - lons.shape[1]
+        unwrapped = np.concatenate([unwrapped, np.repeat(unwrapped[:, -1:], pad, axis=1)], axis=1)
+        lats = np.concatenate([lats, np.repeat(lats[:, -1:], pad, axis=1)], axis=1)
+        # Keep the start of each densified footprint where it was before unwrapping
+        unwrapped[curved] = dense_unwrapped - dense_unwrapped[:, :1] + unwrapped[curved, :1]
+        lats[curved] = dense_lats
+    n, k = unwrapped.shape
+
+    # Pole caps: the boundary, unwrapped over 360 degrees, closed along the pole
+    width = k + 3
+    part_lons = np.empty((n, width))
+    part_lats = np.empty((n, width))
+    part_lons[:, :k], part_lats[:, :k] = unwrapped, lats
+    part_lons[:, k:], part_lats[:, k:] = unwrapped[:, -1:], lats[:, -1:]
+    if polar.any():
+        pole_lat = np.where(lats[polar].mean(axis=1) > 0, 90.0, -90.0)
+        closing_lon = unwrapped[polar, 0] + winding[polar]
+        part_lons[polar, k] = closing_lon
+        part_lats[polar, k] = lats[polar, 0]
+        part_lons[polar, k + 1] = closing_lon
+        part_lats[polar, k + 1] = pole_lat
+        part_lons[polar, k + 2] = unwrapped[polar, 0]
+        part_lats[polar, k + 2] = pole_lat
+
+    # Shift every polygon so that it starts in [-180, 180), then cut what lies beyond 180
+    part_lons -= np.floor((part_lons.min(axis=1, keepdims=True) + 180) / 360) * 360
+    crossing = part_lons.max(axis=1) > 180
+    owners = np.arange(n)
+    if not crossing.any():
+        return part_lons, part_lats, owners
+
+    west_lons, west_lats, _ = clip_longitude(part_lons[crossing], part_lats[crossing], 180, keep_below=True)
+    east_lons, east_lats, _ = clip_longitude(part_lons[crossing] - 360, part_lats[crossing], -180, keep_below=False)
+    whole_lons, whole_lats = part_lons[~crossing], part_lats[~crossing]
+    pad = west_lons.shape[1] - width
+    whole_lons = np.concatenate([whole_lons, np.repeat(whole_lons[:, -1:], pad, axis=1)], axis=1)
+    whole_lats = np.concatenate([whole_lats, np.repeat(whole_lats[:, -1:], pad, axis=1)], axis=1)
+
+    part_lons = np.concatenate([whole_lons, west_lons, east_lons])
+    part_lats = np.concatenate([whole_lats, west_lats, east_lats])
+    owners = np.concatenate([owners[~crossing], owners[crossing], owners[crossing]])
+    order = np.argsort(owners, kind='stable')
+    return part_lons[order], part_lats[order], owners[order]
+
+def part_bounds(part_lons, part_lats):
+    """Plain (lon_min, lon_max, lat_min, lat_max) of planar parts from planar_parts."""
+    return part_lons.min(axis=1), part_lons.max(axis=1), part_lats.min(axis=1), part_lats.max(axis=1)
@@ -0,0 +1,126 @@
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFull(RuntimeError):
+    """Raised by JobQueue.submit when max_pending jobs are already queued or running."""
+
+
+class Job:
+    """
+    One queued call and its state: queued -> running -> done | failed.
+
+    stages names the steps the call reports through its progress callback;
+    progress is the fraction of them already finished.
+    """
+
+    def __init__(self, stages=()):
+        self.id = uuid.uuid4().hex
+        self.status = 'queued'
+        self.stages = list(stages)
+        self.stage = None
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def set_stage(self, stage):
+        """The progress callback handed to the job function: the job has entered stage."""
+        self.stage = stage
+        if stage in self.stages:
+            self.progress = self.stages.index(stage) / len(self.stages)
+
+    def to_dict(self, with_result=True):
+        data = {
+            "id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "stages": self.stages,
+            "progress": self.progress,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+        if self.status == 'failed':
+            data["error"] = self.error
+        if with_result and self.status == 'done':
+            data["result"] = self.result
+        return data
+
+
+class JobQueue:
+    """
+    Bounded in-process job queue: a pool of max_workers threads runs the jobs.
+
+    At most max_pending jobs may be queued or running; submit() raises
+    QueueFull beyond that, so a burst of uploads cannot pile up unbounded
+    work. The state of the last keep_finished finished jobs is kept for
+    status queries, older ones are forgotten. Only the last keep_results of
+    them keep their result, so finished jobs do not pin their outputs in
+    memory; older done jobs report a result of None.
+
+    Usage:
+        queue = JobQueue(max_workers=2)
+        job = queue.submit(workflow, fits_dir, ..., stages=WORKFLOW_STAGES)
+        queue.get(job.id).to_dict()
+    """
+
+    def __init__(self, max_workers=2, max_pending=8, keep_finished=100, keep_results=8):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.max_pending = max_pending
+        self.keep_finished = keep_finished
+        self.keep_results = keep_results
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, function, *args, stages=(), **kwargs):
+        """
+        Queues function(*args, progress=job.set_stage, **kwargs) and returns its Job.
+
+        The function's return value becomes job.result, an exception marks the
+        job failed with its message as job.error.
+        """
+        job = Job(stages)
+        with self.lock:
+            pending = sum(1 for queued in self.jobs.values() if queued.status in ('queued', 'running'))
+            if pending >= self.max_pending:
+                raise QueueFull(f"{pending} jobs are already queued or running")
+            self.jobs[job.id] = job
+            self._forget_finished()
+        self.executor.submit(self._run, job, function, args, kwargs)
+        return job
+
+    def _run(self, job, function, args, kwargs):
+        job.status = 'running'
+        job.started = time.time()
+        try:
+            job.result = function(*args, progress=job.set_stage, **kwargs)
+            job.progress = 1.0
+            job.status = 'done'
+        except Exception as e:
+            traceback.print_exc()
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            job.finished = time.time()
+
+    def _forget_finished(self):
+        finished = [job for job in self.jobs.values() if job.status in ('done', 'failed')]
+        for job in finished[:max(len(finished) - self.keep_finished, 0)]:
+            del self.jobs[job.id]
+        for job in finished[:max(len(finished) - self.keep_results, 0)]:
+            job.result = None
+
+    def get(self, job_id):
+        """The Job with job_id, or None if it is unknown or was forgotten."""
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
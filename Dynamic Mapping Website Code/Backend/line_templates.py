@@ -0,0 +1,97 @@
+import numpy as np
+from scipy.optimize import nnls
+
+def line_design(energy, line_energies, line_sigma):
+    """(n_energy x n_lines) Gaussian line templates of unit peak height at fixed energies."""
+    line_energies = np.asarray(line_energies, dtype=np.float64)
+    return np.exp(-0.5 * ((energy[:, None] - line_energies[None, :]) / line_sigma) ** 2)
+
+def continuum_design(energy, degree):
+    """(n_energy x degree + 1) Legendre polynomial continuum basis over the energy range."""
+    scaled = 2 * (energy - energy.min()) / (energy.max() - energy.min()) - 1
+    return np.polynomial.legendre.legvander(scaled, degree)
+
+def _solve_active_sets(design, spectra, active):
+    """Least-squares coefficients of each spectrum using only its active columns, one solve per distinct active set."""
+    coefficients = np.zeros(active.shape)
+    patterns, inverse = np.unique(active, axis=0, return_inverse=True)
+    for pattern_index, pattern in enumerate(patterns):
+        if not pattern.any():
+            continue
+        rows = np.nonzero(inverse.ravel() == pattern_index)[0]
+        solution = spectra[rows] @ np.linalg.pinv(design[:, pattern]).T
+        coefficients[np.ix_(rows, np.nonzero(pattern)[0])] = solution
+    return coefficients
+
+def batched_nnls(design, spectra, tol=1e-10):
+    """
+    Solves min ||design @ a - y|| with a >= 0 for every row y of spectra, sharing one design matrix.
+
+    Spectra are solved together by active set: negative coefficients are dropped
+    and every group of spectra with the same active set is re-solved with one
+    pseudo-inverse. Spectra whose result fails the NNLS optimality check fall
+    back to scipy.optimize.nnls, so the result is always the exact NNLS solution.
+    """
+    n_columns = design.shape[1]
+    active = np.ones((len(spectra), n_columns), dtype=bool)
+    for _ in range(n_columns + 1):
+        coefficients = _solve_active_sets(design, spectra, active)
+        negative = coefficients < 0
+        if not negative.any():
+            break
+        active &= ~negative
+    coefficients = np.clip(coefficients, 0, None)
+
+    # Optimality: no inactive column may still reduce the residual
+    gradient = (spectra - coefficients @ design.T) @ design
+    scale = tol * np.maximum(np.abs(spectra).max(axis=1, initial=0), 1) * np.abs(design).sum(axis=0).max()
+    not_optimal = ((gradient > scale[:, None]) & ~active).any(axis=1)
+    for row in np.nonzero(not_optimal)[0]:
+        coefficients[row], _ = nnls(design, spectra[row])
+    return coefficients
+
+def fit_line_fluxes(energy, spectra, line_energies, line_sigma=0.06, continuum_degree=2):
+    """
+    Fits every spectrum as a non-negative sum of fixed-position Gaussian lines plus a free polynomial continuum.
+
+    The continuum is projected out of the design and of all spectra with one
+    matrix product, and the line amplitudes are then solved by batched_nnls.
+
+    Parameters:
+    - energy (ndarray): Shared energy grid in keV.
+    - spectra (ndarray): (n_spectra x n_energy) background-corrected count rates.
+    - line_energies (list): Line centroids in keV.
+    - line_sigma (float): Gaussian width of every line template in keV.
+    - continuum_degree (int): Degree of the Legendre continuum.
+
+    Returns:
+    - fluxes (ndarray): (n_spectra x n_lines) line fluxes, amplitude * sqrt(2 pi) * line_sigma.
+    - flux_errors (ndarray): (n_spectra x n_lines) 1-sigma flux uncertainties from the
+      least-squares covariance of the lines with non-zero flux, 0 elsewhere.
+    """
+    energy = np.asarray(energy, dtype=np.float64)
+    spectra = np.atleast_2d(np.asarray(spectra, dtype=np.float64))
+    lines = line_design(energy, line_energies, line_sigma)
+    basis, _ = np.linalg.qr(continuum_design(energy, continuum_degree))
+
+    projected_lines = lines - basis @ (basis.T @ lines)
+    projected_spectra = spectra - (spectra @ basis) @ basis.T
+    amplitudes = batched_nnls(projected_lines, projected_spectra)
+
+    # Amplitude uncertainties from the residual variance and the active columns only
+    residuals = projected_spectra - amplitudes @ projected_lines.T
+    active = amplitudes > 0
+    dof = np.maximum(len(energy) - basis.shape[1] - active.sum(axis=1), 1)
+    variance = np.sum(residuals ** 2, axis=1) / dof
+    amplitude_errors = np.zeros_like(amplitudes)
+    patterns, inverse = np.unique(active, axis=0, return_inverse=True)
+    for pattern_index, pattern in enumerate(patterns):
+        if not pattern.any():
+            continue
+        rows = np.nonzero(inverse.ravel() == pattern_index)[0]
+        design = projected_lines[:, pattern]
+        covariance_diag = np.diag(np.linalg.pinv(design.T @ design))
+        amplitude_errors[np.ix_(rows, np.nonzero(pattern)[0])] = np.sqrt(variance[rows, None] * covariance_diag[None, :])
+
+    norm = np.sqrt(2 * np.pi) * line_sigma
+    return amplitudes * norm, amplitude_errors * norm
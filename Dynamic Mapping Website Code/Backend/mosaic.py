@@ -0,0 +1,214 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+from rasterizer import EquirectangularGrid, EquirectangularRaster, apply_colormap, colormap_lut
+from footprint_geometry import planar_parts
+
+RATIOS = ["Na/Si", "Al/Si", "Mg/Si", "Ca/Si"]
+FOOTPRINT_COLUMNS = ([f"V{i}_{axis}" for i in range(4) for axis in ('LAT', 'LON')] + RATIOS
+                     + [f"{ratio}_uncer" for ratio in RATIOS])
+
+class GlobalMosaic:
+    """
+    Persistent global ratio maps accumulated footprint by footprint.
+
+    For every ratio, mosaic_dir holds three memory-mapped equirectangular grids:
+    <Mg_Si>_sum.npy (weighted sum of the ratio), <Mg_Si>_weight.npy (sum of the
+    weights) and <Mg_Si>_count.npy (number of footprints). Adding a footprint
+    only touches the pixels it covers, and mean() is one division over the grid.
+
+    Footprints without a ratio (ratio 0 with _uncer -1, as Extract_data reports
+    undetected lines) are not added. With weighting='inverse_variance' each
+    footprint is weighted by 1 / max(_uncer, min_uncertainty) ** 2, otherwise by 1.
+
+    The footprint columns of every added catalogue are kept in
+    mosaic_dir/catalogues/, so a catalogue that changed on disk is subtracted
+    before being added again, and the grids can be rebuilt from scratch. The
+    manifest is marked dirty while the grids are being changed and records a
+    catalogue only once they are flushed: a mosaic left dirty by an
+    interrupted update is rebuilt when it is opened. Footprints passed to
+    add() directly are not recorded, so a rebuild drops them.
+
+    Usage:
+        mosaic = GlobalMosaic('mosaic')
+        for csv_path in sorted(glob.glob('2021/*.csv')):
+            mosaic.add_catalogue(csv_path)
+        mg_si = mosaic.mean('Mg/Si')
+    """
+
+    def __init__(self, mosaic_dir, width=3600, height=1800, weighting='uniform', min_uncertainty=1e-6):
+        if weighting not in ('uniform', 'inverse_variance'):
+            raise ValueError(f"Unknown weighting: {weighting}")
+        self.mosaic_dir = mosaic_dir
+        self.grid = EquirectangularGrid(width, height)
+        self.weighting = weighting
+        self.min_uncertainty = min_uncertainty
+        os.makedirs(mosaic_dir, exist_ok=True)
+
+        self.manifest_path = os.path.join(mosaic_dir, 'manifest.json')
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+            if (self.manifest['width'], self.manifest['height'], self.manifest['weighting']) != (width, height, weighting):
+                raise ValueError(f"{mosaic_dir} holds a {self.manifest['width']}x{self.manifest['height']} "
+                                 f"{self.manifest['weighting']} mosaic")
+            if any(not isinstance(entry, dict) for entry in self.manifest['catalogues'].values()):
+                raise ValueError(f"{mosaic_dir} was built without its catalogue rows; rebuild it in a new directory")
+        else:
+            self.manifest = {'width': width, 'height': height, 'weighting': weighting, 'catalogues': {}, 'dirty': False}
+        self.rows_dir = os.path.join(mosaic_dir, 'catalogues')
+        os.makedirs(self.rows_dir, exist_ok=True)
+
+        self.sums, self.weights, self.counts = {}, {}, {}
+        for ratio in RATIOS:
+            self.sums[ratio] = self._open_grid(ratio, 'sum', np.float64)
+            self.weights[ratio] = self._open_grid(ratio, 'weight', np.float64)
+            self.counts[ratio] = self._open_grid(ratio, 'count', np.uint32)
+        if self.manifest.get('dirty'):
+            self.rebuild()
+
+    def _open_grid(self, ratio, name, dtype):
+        path = os.path.join(self.mosaic_dir, f"{ratio.replace('/', '_')}_{name}.npy")
+        if os.path.exists(path):
+            return open_memmap(path, mode='r+')
+        return open_memmap(path, mode='w+', dtype=dtype, shape=(self.grid.height, self.grid.width))
+
+    def add(self, results):
+        """
+        Adds footprints: one Extract_data result, a list of them, or array-valued columns
+        (e.g. a catalogue DataFrame). Returns the number of footprints added per ratio.
+        """
+        return self._accumulate(results, 1)
+
+    def _accumulate(self, results, sign):
+        """Adds (sign 1) or removes (sign -1) footprints from the grids."""
+        if isinstance(results, list):
+            if not results:
+                return {ratio: 0 for ratio in RATIOS}
+            results = {key: [result[key] for result in results] for key in results[0]}
+        lats = np.column_stack([np.atleast_1d(results[f"V{i}_LAT"]) for i in range(4)]).astype(np.float64)
+        lons = np.column_stack([np.atleast_1d(results[f"V{i}_LON"]) for i in range(4)]).astype(np.float64)
+        # Rasterize each footprint once for all ratios, split at the antimeridian and capped at the poles
+        masks = list(self.grid.footprint_masks(*planar_parts(lons, lats), len(lons)))
+
+        added = {}
+        for ratio in RATIOS:
+            if ratio not in results:
+                added[ratio] = 0
+                continue
+            values = np.atleast_1d(results[ratio]).astype(np.float64)
+            uncertainties = np.atleast_1d(results.get(f"{ratio}_uncer", np.zeros_like(values))).astype(np.float64)
+            valid = np.isfinite(values) & ~((values == 0) & (uncertainties == -1))
+            if self.weighting == 'inverse_variance':
+                weights = 1 / np.maximum(np.abs(uncertainties), self.min_uncertainty) ** 2
+            else:
+                weights = np.ones_like(values)
+
+            ratio_sum, ratio_weight, ratio_count = self.sums[ratio], self.weights[ratio], self.counts[ratio]
+            for (rows, cols, mask), value, weight, ok in zip(masks, values, weights, valid):
+                if not ok:
+                    continue
+                ratio_sum[rows, cols][mask] += sign * weight * value
+                ratio_weight[rows, cols][mask] += sign * weight
+                if sign > 0:
+                    ratio_count[rows, cols][mask] += 1
+                else:
+                    ratio_count[rows, cols][mask] -= 1
+                    # No rounding residue where the last footprint was removed
+                    emptied = mask & (ratio_count[rows, cols] == 0)
+                    ratio_sum[rows, cols][emptied] = 0
+                    ratio_weight[rows, cols][emptied] = 0
+            added[ratio] = int(valid.sum())
+        return added
+
+    def add_catalogue(self, csv_path, chunk_size=5000):
+        """
+        Adds the footprints of a ratio catalogue CSV unless that file (same size and mtime) was added before.
+
+        A catalogue added before that has changed since replaces its earlier
+        contribution. Catalogues with a single ratio
+        (Catalogue_*_unoverlaped_*.csv) only add that ratio.
+        Returns True if the catalogue was added.
+        """
+        stat = os.stat(csv_path)
+        key = os.path.abspath(csv_path)
+        signature = [stat.st_size, stat.st_mtime]
+        previous = self.manifest['catalogues'].get(key)
+        if previous is not None and previous['signature'] == signature:
+            return False
+
+        # Only the columns the grids use are kept, read chunk by chunk
+        chunks = [chunk[[column for column in chunk.columns if column in FOOTPRINT_COLUMNS]]
+                  for chunk in pd.read_csv(csv_path, chunksize=chunk_size)]
+        rows = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+        rows_name = f"{hashlib.sha1(key.encode()).hexdigest()}_{stat.st_size}_{stat.st_mtime_ns}.npz"
+        np.savez(os.path.join(self.rows_dir, rows_name), **{column: rows[column].to_numpy() for column in rows.columns})
+
+        self._set_dirty(True)
+        if previous is not None:
+            self._accumulate_rows(self._load_rows(previous['rows']), -1, chunk_size)
+        self._accumulate_rows({column: rows[column].to_numpy() for column in rows.columns}, 1, chunk_size)
+        self.manifest['catalogues'][key] = {'signature': signature, 'rows': rows_name}
+        self.manifest['dirty'] = False
+        self.flush()
+        if previous is not None and previous['rows'] != rows_name:
+            os.remove(os.path.join(self.rows_dir, previous['rows']))
+        return True
+
+    def _accumulate_rows(self, rows, sign, chunk_size=5000):
+        """_accumulate over column arrays, chunk_size footprints at a time."""
+        n_rows = len(next(iter(rows.values()))) if rows else 0
+        for start in range(0, n_rows, chunk_size):
+            self._accumulate({column: values[start:start + chunk_size] for column, values in rows.items()}, sign)
+
+    def _load_rows(self, rows_name):
+        with np.load(os.path.join(self.rows_dir, rows_name), allow_pickle=False) as store:
+            return {column: store[column] for column in store.files}
+
+    def _set_dirty(self, dirty):
+        self.manifest['dirty'] = dirty
+        self._write_manifest()
+
+    def rebuild(self):
+        """Recomputes the grids from scratch from the recorded catalogues."""
+        self._set_dirty(True)
+        for grids in (self.sums, self.weights, self.counts):
+            for grid in grids.values():
+                grid[...] = 0
+        for entry in self.manifest['catalogues'].values():
+            self._accumulate_rows(self._load_rows(entry['rows']), 1)
+        self.manifest['dirty'] = False
+        self.flush()
+        # Rows of an update that never made it into the manifest
+        recorded = {entry['rows'] for entry in self.manifest['catalogues'].values()}
+        for name in os.listdir(self.rows_dir):
+            if name not in recorded:
+                os.remove(os.path.join(self.rows_dir, name))
+
+    def flush(self):
+        """Writes the grids, then the manifest, to disk."""
+        for grids in (self.sums, self.weights, self.counts):
+            for grid in grids.values():
+                grid.flush()
+        self._write_manifest()
+
+    def _write_manifest(self):
+        staging = f"{self.manifest_path}.tmp"
+        with open(staging, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(staging, self.manifest_path)
+
+    def mean(self, ratio):
+        """Weighted mean map of a ratio, NaN where no footprint has been added."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.weights[ratio] > 0, self.sums[ratio] / self.weights[ratio], np.nan)
+
+    def render(self, ratio, output_path, vmin=0, vmax=2):
+        """Writes the mean map of a ratio as a turbo-colored transparent PNG over the full lat/lon range."""
+        raster = EquirectangularRaster(self.grid.width, self.grid.height)
+        raster.rgba[...] = apply_colormap(self.mean(ratio), vmin, vmax, colormap_lut('turbo'))
+        raster.save_png(output_path)
+        return output_path
@@ -0,0 +1,114 @@
+import numpy as np
+
+def gaussian(x, A, mu, sigma):
+    return A * np.exp(-0.5 * ((x - mu) / sigma) ** 2)
+
+def gaussian_jacobian(x, A, mu, sigma):
+    """Analytic derivatives of gaussian with respect to (A, mu, sigma), stacked on the last axis."""
+    z = (x - mu) / sigma
+    e = np.exp(-0.5 * z ** 2)
+    return np.stack([e, A * e * z / sigma, A * e * z ** 2 / sigma], axis=-1)
+
+def _residuals_and_cost(x, y, weights, p):
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        residuals = (y - gaussian(x, p[:, :1], p[:, 1:2], p[:, 2:3])) * weights
+    return residuals, np.sum(residuals ** 2, axis=1)
+
+def fit_gaussians(x, y, p0, mask=None, max_iter=200, ftol=1.49012e-08, xtol=1.49012e-08):
+    """
+    Fits one Gaussian per row of x/y with a vectorized Levenberg-Marquardt.
+
+    All fits advance together: each iteration builds the analytic Jacobian of
+    every window, solves the damped normal equations as one batched 3x3 solve,
+    and accepts or rejects the step per fit. Fits that have converged are frozen.
+
+    Parameters:
+    - x, y (ndarray): (n_fits x window) energies and counts. Shorter windows are padded
+      and excluded through mask.
+    - p0 (ndarray): (n_fits x 3) initial (A, mu, sigma).
+    - mask (ndarray, optional): (n_fits x window) boolean, True for points used in the fit.
+    - max_iter (int): Maximum number of LM iterations.
+    - ftol, xtol (float): Relative tolerances on the cost and on the parameters, as in curve_fit.
+
+    Returns:
+    - params (ndarray): (n_fits x 3) fitted (A, mu, sigma).
+    - converged (ndarray): (n_fits,) True where the fit met a tolerance with finite parameters.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    params = np.array(p0, dtype=np.float64).reshape(-1, 3)
+    weights = np.ones_like(x) if mask is None else np.asarray(mask, dtype=np.float64)
+    n_fits = len(params)
+
+    residuals, cost = _residuals_and_cost(x, y, weights, params)
+    damping = np.full(n_fits, 1e-3)
+    converged = np.zeros(n_fits, dtype=bool)
+    active = np.isfinite(cost)
+
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        idx = np.nonzero(active)[0]
+        p = params[idx]
+        with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+            jac = gaussian_jacobian(x[idx], p[:, :1], p[:, 1:2], p[:, 2:3]) * weights[idx, :, None]
+        jtj = np.einsum('nwi,nwj->nij', jac, jac)
+        jtr = np.einsum('nwi,nw->ni', jac, residuals[idx])
+
+        diag = np.einsum('nii->ni', jtj)
+        damped = jtj + (damping[idx, None] * np.maximum(diag, 1e-12))[:, :, None] * np.eye(3)
+        finite = np.isfinite(damped).all(axis=(1, 2)) & np.isfinite(jtr).all(axis=1)
+        step = np.zeros_like(p)
+        if finite.any():
+            try:
+                step[finite] = np.linalg.solve(damped[finite], jtr[finite][:, :, None])[:, :, 0]
+            except np.linalg.LinAlgError:
+                step[finite] = np.array([np.linalg.lstsq(m, v, rcond=None)[0]
+                                         for m, v in zip(damped[finite], jtr[finite])])
+
+        trial = p + step
+        trial_residuals, trial_cost = _residuals_and_cost(x[idx], y[idx], weights[idx], trial)
+        improved = finite & np.isfinite(trial_cost) & (trial_cost <= cost[idx])
+
+        accepted = idx[improved]
+        old_cost = cost[accepted]
+        params[accepted] = trial[improved]
+        residuals[accepted] = trial_residuals[improved]
+        cost[accepted] = trial_cost[improved]
+        damping[accepted] /= 10
+        damping[idx[~improved]] *= 10
+
+        # Convergence tests on accepted steps, as in MINPACK's ftol/xtol
+        cost_done = (old_cost - cost[accepted]) <= ftol * np.maximum(old_cost, 1e-300)
+        step_done = np.linalg.norm(step[improved], axis=1) <= xtol * (np.linalg.norm(params[accepted], axis=1) + xtol)
+        done = accepted[cost_done | step_done]
+        converged[done] = True
+        active[done] = False
+
+        # Give up on fits whose damping has blown up without any improvement
+        stuck = idx[~improved & (damping[idx] > 1e16)]
+        active[stuck] = False
+
+    converged &= np.isfinite(params).all(axis=1)
+    return params, converged
+
+def peak_windows(energy, counts, peaks, window_size=10):
+    """
+    Cuts [peak - window_size, peak + window_size) windows around each peak into padded arrays.
+
+    Returns (x, y, mask, p0) ready for fit_gaussians, with the initial guess
+    (max of the window, energy at the peak, 0.1) used by Extract_data.
+    """
+    peaks = np.asarray(peaks, dtype=np.int64)
+    offsets = np.arange(-window_size, window_size)
+    positions = peaks[:, None] + offsets[None, :]
+    mask = (positions >= 0) & (positions < len(energy))
+    positions = np.clip(positions, 0, len(energy) - 1)
+    x = energy[positions]
+    y = np.where(mask, counts[positions], 0.0)
+    p0 = np.column_stack([
+        np.max(np.where(mask, y, -np.inf), axis=1),
+        energy[peaks],
+        np.full(len(peaks), 0.1),
+    ])
+    return x, y, mask, p0
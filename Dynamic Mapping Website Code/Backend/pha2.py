@@ -0,0 +1,195 @@
+import os
+import numpy as np
+from datetime import datetime
+from astropy.io import fits
+
+# Per-row keyword columns besides the spectrum itself
+FOOTPRINT_KEYS = ['V0_LAT', 'V1_LAT', 'V2_LAT', 'V3_LAT', 'V0_LON', 'V1_LON', 'V2_LON', 'V3_LON']
+GEOMETRY_KEYS = ['SAT_ALT', 'SOLARANG', 'PHASEANG', 'EMISNANG']
+
+class PHA2Writer:
+    """
+    Collects integrated spectra as rows of a single OGIP PHA type II table.
+
+    Every row has NAME, START_TIME, END_TIME, EXPOSURE, the footprint vertices,
+    the geometry angles and CHANNEL/COUNTS vectors. Missing keyword values are
+    stored as NaN. New rows are appended in place after the rows of an existing
+    file, which is neither read nor rewritten. Rows are written chunk_rows at a
+    time, and NAXIS2 is patched into the header only once they are on disk, so
+    an interrupted write leaves the rows recorded until then readable. close()
+    writes the rows still buffered; leaving the with block does it even on an
+    error, so the rows appended until then are kept.
+
+    Usage:
+        with PHA2Writer('integrated_2020_02.pha') as writer:
+            integrate_fits_files(group_files, output_dir, pha2_writer=writer)
+    """
+
+    def __init__(self, path, n_channels=2048, chunk_rows=256):
+        self.path = path
+        self.n_channels = n_channels
+        self.chunk_rows = chunk_rows
+        self.rows = []
+        self.columns = fits.ColDefs([
+            fits.Column(name='SPEC_NUM', format='J'),
+            fits.Column(name='NAME', format='64A'),
+            fits.Column(name='START_TIME', format='23A'),
+            fits.Column(name='END_TIME', format='23A'),
+            fits.Column(name='CHANNEL', format=f'{n_channels}J'),
+            fits.Column(name='COUNTS', format=f'{n_channels}E', unit='count'),
+            fits.Column(name='EXPOSURE', format='D', unit='s'),
+        ] + [fits.Column(name=key, format='D') for key in FOOTPRINT_KEYS + GEOMETRY_KEYS])
+        # FITS tables are big-endian on disk
+        self.dtype = self.columns.dtype.newbyteorder('>')
+
+        if os.path.exists(path):
+            # Only the headers are read: the rows are appended behind the existing data
+            with fits.open(path) as hdul:
+                index = hdul.index_of('SPECTRUM')
+                table = hdul[index]
+                layout = [(column.name, str(column.format)) for column in table.columns]
+                if layout != [(column.name, str(column.format)) for column in self.columns]:
+                    raise ValueError(f"{path} is not a PHA type II table of {n_channels} channels")
+                info = hdul.fileinfo(index)
+                if index != len(hdul) - 1 or info['datLoc'] + info['datSpan'] != os.path.getsize(path):
+                    raise ValueError(f"Rows cannot be appended to {path}: its SPECTRUM table is not the last HDU")
+                self.header = table.header.copy()
+                if len(self.header.tostring()) != info['datLoc'] - info['hdrLoc']:
+                    raise ValueError(f"Rows cannot be appended to {path}: its SPECTRUM header cannot be rewritten in place")
+                self.header_offset = info['hdrLoc']
+                self.data_offset = info['datLoc']
+                self.n_written = table.header['NAXIS2']
+        else:
+            self.header = fits.BinTableHDU.from_columns(self.columns, nrows=0).header
+            self.header['EXTNAME'] = 'SPECTRUM'
+            self.header['TELESCOP'] = 'CHANDRAYAAN-2'
+            self.header['INSTRUME'] = 'CLASS'
+            self.header['HDUCLASS'] = 'OGIP'
+            self.header['HDUCLAS1'] = 'SPECTRUM'
+            self.header['HDUVERS'] = '1.2.1'
+            self.header['HDUCLAS3'] = 'COUNT'
+            self.header['HDUCLAS4'] = 'TYPE:II'
+            self.header['DETCHANS'] = n_channels
+            self.header['CHANTYPE'] = 'PHA'
+            self.header['POISSERR'] = True
+            self.header['DATE'] = datetime.utcnow().isoformat()
+
+            # The empty table is written under a temporary name and renamed once complete
+            primary = fits.PrimaryHDU().header.tostring().encode('ascii')
+            staging = f"{path}.tmp"
+            with open(staging, 'wb') as f:
+                f.write(primary)
+                # NAXIS2 is 0 for now; the header keeps its length when it is rewritten with the count
+                f.write(self.header.tostring().encode('ascii'))
+            os.replace(staging, path)
+            self.header_offset = len(primary)
+            self.data_offset = len(primary) + len(self.header.tostring())
+            self.n_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Keep what was appended before an error rather than dropping it
+        self.close()
+
+    def append(self, name, counts, exposure, start_time='', end_time='', **keywords):
+        """Appends one spectrum; keywords may hold any of FOOTPRINT_KEYS and GEOMETRY_KEYS. Returns its row index."""
+        if len(counts) != self.n_channels:
+            raise ValueError(f"Spectrum {name} has {len(counts)} channels, expected {self.n_channels}")
+        row = {
+            'NAME': name,
+            'START_TIME': start_time,
+            'END_TIME': end_time,
+            'EXPOSURE': float(exposure),
+            'COUNTS': np.asarray(counts, dtype=np.float32),
+        }
+        for key in FOOTPRINT_KEYS + GEOMETRY_KEYS:
+            value = keywords.get(key)
+            row[key] = float(value) if value is not None else np.nan
+        self.rows.append(row)
+        index = self.n_written + len(self.rows) - 1
+        if len(self.rows) >= self.chunk_rows:
+            self.flush()
+        return index
+
+    def flush(self):
+        """Writes the buffered rows after the rows already in the file and records the new row count."""
+        if not self.rows:
+            return
+        n = len(self.rows)
+        rows = np.zeros(n, dtype=self.dtype)
+        rows['SPEC_NUM'] = np.arange(self.n_written + 1, self.n_written + n + 1)
+        rows['CHANNEL'] = np.arange(self.n_channels)
+        for key in ('NAME', 'START_TIME', 'END_TIME'):
+            rows[key] = [row[key] for row in self.rows]
+        rows['COUNTS'] = [row['COUNTS'] for row in self.rows]
+        for key in ['EXPOSURE'] + FOOTPRINT_KEYS + GEOMETRY_KEYS:
+            rows[key] = [row[key] for row in self.rows]
+
+        n_rows = self.n_written + n
+        with open(self.path, 'r+b') as f:
+            # The new rows overwrite the padding of the previous ones
+            f.seek(self.data_offset + self.n_written * self.dtype.itemsize)
+            f.write(rows.tobytes())
+            # Pad the data to a whole number of FITS blocks
+            f.write(b'\0' * (-n_rows * self.dtype.itemsize % 2880))
+            f.flush()
+            os.fsync(f.fileno())
+
+            # Only now are the rows counted in the header
+            self.header['NAXIS2'] = n_rows
+            if 'DATE' in self.header:
+                self.header['DATE'] = datetime.utcnow().isoformat()
+            f.seek(self.header_offset)
+            f.write(self.header.tostring().encode('ascii'))
+        self.n_written = n_rows
+        self.rows = []
+
+    def close(self):
+        self.flush()
+
+
+def iter_pha2_spectra(path):
+    """
+    Yields the rows of a PHA type II file as dicts, reading the table once.
+
+    The dicts hold NAME, START_TIME, END_TIME, EXPOSURE, CHANNEL, COUNTS and the
+    FOOTPRINT_KEYS and GEOMETRY_KEYS, and can be passed straight to Extract_data.
+    """
+    with fits.open(path) as hdul:
+        data = hdul['SPECTRUM'].data
+        columns = {name: np.array(data[name]) for name in data.columns.names}
+    for i in range(len(columns['SPEC_NUM'])):
+        yield _row_dict(columns, i)
+
+def read_pha2_rows(path, indices):
+    """Returns the rows of a PHA type II file at the given indices as dicts, reading only those rows."""
+    indices = np.asarray(indices, dtype=np.int64)
+    with fits.open(path, memmap=True) as hdul:
+        data = hdul['SPECTRUM'].data
+        columns = {name: np.array(data[name][indices]) for name in data.columns.names}
+    return [_row_dict(columns, i) for i in range(len(indices))]
+
+def read_pha2_index(path):
+    """Returns (NAME, START_TIME) of every row of a PHA type II file without reading the spectra."""
+    with fits.open(path, memmap=True) as hdul:
+        data = hdul['SPECTRUM'].data
+        return [(str(name), str(start_time)) for name, start_time in zip(data['NAME'], data['START_TIME'])]
+
+def is_pha2_file(path):
+    """True if the first extension of a FITS file is a PHA type II spectrum table."""
+    try:
+        header = fits.getheader(path, 1)
+    except (OSError, IndexError):
+        return False
+    return header.get('HDUCLAS1') == 'SPECTRUM' and header.get('HDUCLAS4') == 'TYPE:II'
+
+def _row_dict(columns, i):
+    row = {name: values[i] for name, values in columns.items() if name != 'SPEC_NUM'}
+    for key in ('NAME', 'START_TIME', 'END_TIME'):
+        row[key] = str(row[key])
+    row['EXPOSURE'] = float(row['EXPOSURE'])
+    for key in FOOTPRINT_KEYS + GEOMETRY_KEYS:
+        row[key] = float(row[key])
+    return row
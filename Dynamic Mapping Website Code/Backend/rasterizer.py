@@ -0,0 +1,247 @@
+import numpy as np
+from PIL import Image
+
+# Size of the lon/lat area of the heatmaps get_heatmap used to save through pyplot
+# (the axes of a 10726x5360 figure, cropped by bbox_inches='tight')
+HEATMAP_WIDTH = 8312
+HEATMAP_HEIGHT = 4127
+LON_RANGE = (-180, 180)
+LAT_RANGE = (-90, 90)
+
+NAMED_COLORS = {
+    'white': (255, 255, 255, 255),
+    'red': (255, 0, 0, 255),
+    'green': (0, 128, 0, 255),
+    'blue': (0, 0, 255, 255),
+}
+
+_luts = {}
+
+def colormap_lut(name='turbo', n_colors=256):
+    """(n_colors x 4) uint8 RGBA lookup table of a matplotlib colormap, built once per process."""
+    key = (name, n_colors)
+    if key not in _luts:
+        import matplotlib
+        cmap = matplotlib.colormaps[name].resampled(n_colors)
+        _luts[key] = cmap(np.arange(n_colors), bytes=True)
+    return _luts[key]
+
+def apply_colormap(values, vmin, vmax, lut):
+    """
+    Maps values to RGBA uint8 colors with one table lookup, like cmap(Normalize(vmin, vmax)(values)).
+
+    Values outside [vmin, vmax] take the end colors; NaN values are transparent.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n_colors = len(lut)
+    with np.errstate(invalid='ignore'):
+        scaled = (values - vmin) / (vmax - vmin) * n_colors
+    indices = np.clip(np.nan_to_num(scaled, nan=0.0), 0, n_colors - 1).astype(np.intp)
+    colors = lut[indices]
+    colors[np.isnan(values)] = 0
+    return colors
+
+
+class EquirectangularGrid:
+    """
+    The pixel grid of an equirectangular map covering lon_range x lat_range, north up.
+
+    Pixel (row, col) covers the lon/lat cell whose centre is at
+    lon = lon_min + (col + 0.5) * dlon, lat = lat_max - (row + 0.5) * dlat, so
+    images of the same size line up pixel for pixel with the old pyplot ones.
+    """
+
+    def __init__(self, width=HEATMAP_WIDTH, height=HEATMAP_HEIGHT, lon_range=LON_RANGE, lat_range=LAT_RANGE):
+        self.width = width
+        self.height = height
+        self.lon_range = lon_range
+        self.lat_range = lat_range
+        self.pixels_per_lon = width / (lon_range[1] - lon_range[0])
+        self.pixels_per_lat = height / (lat_range[1] - lat_range[0])
+
+    def to_pixels(self, lon, lat):
+        """Continuous pixel coordinates (x right, y down) of lon/lat."""
+        x = (np.asarray(lon, dtype=np.float64) - self.lon_range[0]) * self.pixels_per_lon
+        y = (self.lat_range[1] - np.asarray(lat, dtype=np.float64)) * self.pixels_per_lat
+        return x, y
+
+    def polygon_masks(self, lons, lats):
+        """
+        Yields (row_slice, col_slice, mask) for every polygon of lons/lats ((n, k) vertex arrays).
+
+        A pixel is inside when its centre is inside the polygon by the even-odd
+        rule, computed for the whole bounding box of the polygon at once.
+        Polygons off the grid yield an empty mask.
+        """
+        xs, ys = self.to_pixels(np.atleast_2d(lons), np.atleast_2d(lats))
+        for x, y in zip(xs, ys):
+            # Padding vertices (repeats of the previous one) add no edges
+            distinct = (x != np.roll(x, 1)) | (y != np.roll(y, 1))
+            if not distinct.all():
+                x, y = x[distinct], y[distinct]
+            row0 = max(int(np.floor(y.min())), 0)
+            row1 = min(int(np.ceil(y.max())), self.height)
+            col0 = max(int(np.floor(x.min())), 0)
+            col1 = min(int(np.ceil(x.max())), self.width)
+            if row0 >= row1 or col0 >= col1:
+                # Keep one item per polygon, so callers can zip the masks with their polygons
+                yield slice(0, 0), slice(0, 0), np.zeros((0, 0), dtype=bool)
+                continue
+            row_centers = np.arange(row0, row1) + 0.5
+
+            # Crossings of every edge with every scanline of the bounding box
+            x_start, y_start = x, y
+            x_end, y_end = np.roll(x, -1), np.roll(y, -1)
+            crosses = (y_start[None, :] <= row_centers[:, None]) != (y_end[None, :] <= row_centers[:, None])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = (row_centers[:, None] - y_start[None, :]) / (y_end - y_start)[None, :]
+                x_cross = np.where(crosses, x_start[None, :] + t * (x_end - x_start)[None, :], np.inf)
+
+            # Even-odd rule: a crossing at x flips every pixel whose centre is right of it,
+            # i.e. columns from floor(x - 0.5) + 1 on; the parity is a running sum of flips
+            n_cols = col1 - col0
+            rows, edges = np.nonzero(crosses)
+            first_col = np.clip(np.floor(x_cross[rows, edges] - 0.5).astype(np.int64) + 1 - col0, 0, n_cols)
+            flips = np.bincount(rows * (n_cols + 1) + first_col, minlength=len(row_centers) * (n_cols + 1))
+            n_left = np.cumsum(flips.reshape(len(row_centers), n_cols + 1)[:, :n_cols], axis=1)
+            yield slice(row0, row1), slice(col0, col1), (n_left % 2) == 1
+
+    def footprint_masks(self, part_lons, part_lats, owners, n_footprints):
+        """
+        Yields (row_slice, col_slice, mask) for every footprint, merging its parts.
+
+        part_lons/part_lats/owners are as returned by footprint_geometry.planar_parts,
+        sorted by owner; footprints without any pixel yield an empty mask.
+        """
+        empty = (slice(0, 0), slice(0, 0), np.zeros((0, 0), dtype=bool))
+        boundaries = np.searchsorted(owners, np.arange(n_footprints + 1))
+        for start, stop in zip(boundaries[:-1], boundaries[1:]):
+            masks = [m for m in self.polygon_masks(part_lons[start:stop], part_lats[start:stop]) if m[2].size]
+            if len(masks) == 1:
+                yield masks[0]
+            elif not masks:
+                yield empty
+            else:
+                rows = slice(min(m[0].start for m in masks), max(m[0].stop for m in masks))
+                cols = slice(min(m[1].start for m in masks), max(m[1].stop for m in masks))
+                merged = np.zeros((rows.stop - rows.start, cols.stop - cols.start), dtype=bool)
+                for mask_rows, mask_cols, mask in masks:
+                    merged[mask_rows.start - rows.start:mask_rows.stop - rows.start,
+                           mask_cols.start - cols.start:mask_cols.stop - cols.start] |= mask
+                yield rows, cols, merged
+
+    def ring_masks(self, lons, lats, radius, line_width):
+        """Yields (row_slice, col_slice, mask) of a circle outline of radius (degrees) and line_width (pixels) per centre."""
+        half_width = line_width / 2
+        for lon, lat in zip(np.atleast_1d(lons), np.atleast_1d(lats)):
+            x, y = self.to_pixels(lon, lat)
+            extent_x = radius * self.pixels_per_lon + half_width
+            extent_y = radius * self.pixels_per_lat + half_width
+            row0, row1 = max(int(y - extent_y), 0), min(int(np.ceil(y + extent_y)), self.height)
+            col0, col1 = max(int(x - extent_x), 0), min(int(np.ceil(x + extent_x)), self.width)
+            if row0 >= row1 or col0 >= col1:
+                continue
+            dy = (np.arange(row0, row1, dtype=np.float32) + 0.5 - np.float32(y))[:, None]
+            dx = (np.arange(col0, col1, dtype=np.float32) + 0.5 - np.float32(x))[None, :]
+            # The circle is an ellipse in pixels. Along the direction of a pixel at
+            # distance d (pixels) and rho (degrees) from the centre the ellipse is at
+            # d * radius / rho pixels, so the pixel is on the outline when
+            # |d * (rho - radius)| <= half_width * rho.
+            distance = np.hypot(dx, dy)
+            rho = np.hypot(dx / np.float32(self.pixels_per_lon), dy / np.float32(self.pixels_per_lat))
+            ring = np.abs(distance * (rho - np.float32(radius))) <= np.float32(half_width) * rho
+            yield slice(row0, row1), slice(col0, col1), ring
+
+
+class EquirectangularRaster(EquirectangularGrid):
+    """A uint8 RGBA image on an EquirectangularGrid."""
+
+    def __init__(self, width=HEATMAP_WIDTH, height=HEATMAP_HEIGHT, lon_range=LON_RANGE, lat_range=LAT_RANGE):
+        super().__init__(width, height, lon_range, lat_range)
+        self.rgba = np.zeros((height, width, 4), dtype=np.uint8)
+
+    def clear(self):
+        self.rgba.fill(0)
+
+    def fill_polygons(self, lons, lats, colors):
+        """Fills polygons in order, later ones over earlier ones; colors is (n, 4) uint8 RGBA."""
+        colors = np.atleast_2d(np.asarray(colors, dtype=np.uint8))
+        for (rows, cols, mask), color in zip(self.polygon_masks(lons, lats), colors):
+            self.rgba[rows, cols][mask] = color
+
+    def draw_rings(self, lons, lats, radius, line_width, color):
+        """Draws circle outlines of radius (degrees) and line_width (pixels) centred on lons/lats."""
+        color = np.asarray(color, dtype=np.uint8)
+        for rows, cols, ring in self.ring_masks(lons, lats, radius, line_width):
+            self.rgba[rows, cols][ring] = color
+
+    def save_png(self, output_path, compress_level=6):
+        """Encodes the image as PNG once, straight from the RGBA array."""
+        Image.fromarray(self.rgba, 'RGBA').save(output_path, format='PNG', compress_level=compress_level)
+
+
+class FootprintCoverage:
+    """
+    Which footprint covers each pixel of an EquirectangularRaster, rasterized once and colored any number of times.
+
+    The polygons (and optional centroid rings) are scan-converted a single time
+    into a label image: 0 where nothing is drawn, i + 1 where footprint i is the
+    topmost one. render() then colors every footprint through one palette
+    lookup over the covered area only, so the ratios of a set of footprints
+    share all of the geometry work.
+
+    Usage:
+        coverage = FootprintCoverage(EquirectangularRaster(), lons, lats)
+        for ratio in ratios:
+            coverage.render(apply_colormap(values[ratio], 0, 2, lut))
+            coverage.raster.save_png(paths[ratio])
+    """
+
+    def __init__(self, raster, lons, lats, ring_lons=None, ring_lats=None, ring_radius=None, ring_width=None,
+                 owners=None):
+        self.raster = raster
+        lons = np.atleast_2d(np.asarray(lons, dtype=np.float64))
+        lats = np.atleast_2d(np.asarray(lats, dtype=np.float64))
+        # Polygons may be parts of footprints (footprint_geometry.planar_parts): part i belongs to footprint owners[i]
+        owners = np.arange(len(lons)) if owners is None else np.asarray(owners)
+        self.n_footprints = int(owners.max()) + 1 if len(owners) else 0
+        polygons = list(raster.polygon_masks(lons, lats))
+        rings = []
+        if ring_lons is not None:
+            rings = list(raster.ring_masks(ring_lons, ring_lats, ring_radius, ring_width))
+
+        # Crop to the area touched by anything, so rendering skips the empty rest of the map
+        regions = [region for region in polygons + rings if region[2].size]
+        if regions:
+            self.rows = slice(min(r.start for r, _, _ in regions), max(r.stop for r, _, _ in regions))
+            self.cols = slice(min(c.start for _, c, _ in regions), max(c.stop for _, c, _ in regions))
+        else:
+            self.rows = self.cols = slice(0, 0)
+        shape = (self.rows.stop - self.rows.start, self.cols.stop - self.cols.start)
+
+        self.labels = np.zeros(shape, dtype=np.int32)
+        self.ring = np.zeros(shape, dtype=bool)
+        for (rows, cols, mask), label in zip(polygons, owners + 1):
+            self.labels[self._local(rows, self.rows), self._local(cols, self.cols)][mask] = label
+        for rows, cols, mask in rings:
+            self.ring[self._local(rows, self.rows), self._local(cols, self.cols)] |= mask
+        raster.clear()
+
+    @staticmethod
+    def _local(region, crop):
+        return slice(region.start - crop.start, region.stop - crop.start)
+
+    def render(self, colors, ring_color=None):
+        """
+        Redraws the raster with footprint i in colors[i] ((n, 4) uint8 RGBA) and the rings in ring_color.
+
+        Only the covered area is written: everything outside it stays as cleared in __init__.
+        """
+        palette = np.zeros((self.n_footprints + 1, 4), dtype=np.uint8)
+        palette[1:] = np.atleast_2d(np.asarray(colors, dtype=np.uint8))
+        # One 32-bit word per RGBA pixel, so the lookup moves whole pixels
+        crop = self.raster.rgba.view(np.uint32)[self.rows, self.cols, 0]
+        crop[...] = palette.view(np.uint32)[self.labels, 0]
+        if ring_color is not None:
+            crop[self.ring] = np.asarray(ring_color, dtype=np.uint8).view(np.uint32)[0]
+        return self.raster.rgba
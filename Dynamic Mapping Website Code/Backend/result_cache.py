@@ -0,0 +1,210 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import numpy as np
+
+def source_digest(source):
+    """SHA-256 hex digest of the bytes of a FITS source: a path or an io.BytesIO (read without moving it)."""
+    digest = hashlib.sha256()
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    else:
+        digest.update(source.getbuffer())
+    return digest.hexdigest()
+
+def directory_signature(directory):
+    """(name, size, mtime) of every file of a directory, which changes whenever one of them does."""
+    signature = []
+    for name in sorted(os.listdir(directory)):
+        stat = os.stat(os.path.join(directory, name))
+        signature.append([name, stat.st_size, stat.st_mtime])
+    return signature
+
+
+class ResultCache:
+    """
+    Content-addressed on-disk cache of workflow results, bounded in size with LRU eviction.
+
+    An entry is keyed by the SHA-256 of the input FITS bytes (with their names,
+    as the first one dates the integrated spectrum), the background (the bytes
+    of an uploaded file, else the signature of the monthly background
+    directory) and the processing parameters. It holds the integrated
+    spectrum (spectrum.npz), the Extract_data ratio dict (result.json) and the
+    rendered heatmaps (Heatmap_*.png) in cache_dir/<key[:2]>/<key>/.
+
+    Reading an entry marks it as recently used (the mtime of its directory);
+    storing one evicts the least recently used entries beyond max_bytes.
+    Entries used in the last min_age seconds are never evicted, so the files
+    of an entry a job has just read or stored stay in place while the job
+    uses them; the cache may exceed max_bytes meanwhile. hits and misses
+    count lookups since the process started.
+
+    Usage:
+        cache = ResultCache('cache')
+        key = cache.key(fits_sources, background_dir, background_file, params)
+        entry = cache.get(key) or cache.put(key, spectrum, result, heatmaps)
+    """
+
+    def __init__(self, cache_dir, max_bytes=1 << 30, min_age=300):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, fits_sources, background_dir, background_file=None, params=None):
+        """The cache key of a workflow run on these inputs."""
+        names = [os.path.basename(source if isinstance(source, (str, os.PathLike)) else source.name)
+                 for source in fits_sources]
+        digests = [source_digest(source) for source in fits_sources]
+        background_digest = source_digest(background_file) if background_file is not None else None
+        return self.key_from_digests(list(zip(names, digests)), background_dir, background_digest, params)
+
+    def key_from_digests(self, files, background_dir, background_digest=None, params=None):
+        """
+        The cache key from (name, SHA-256) pairs of the FITS files, in upload order, and of the background.
+
+        For inputs whose bytes are no longer at hand, e.g. files folded into an
+        upload session as they arrived.
+        """
+        if background_digest is not None:
+            background = ['file', background_digest]
+        else:
+            background = ['monthly', directory_signature(background_dir)]
+        description = {
+            'first': files[0][0] if files else None,
+            'files': sorted(files),
+            'background': background,
+            'params': params or {},
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        """The entry of key ({'spectrum', 'result', 'heatmaps'}), or None. Counts a hit or a miss."""
+        entry_dir = self._entry_dir(key)
+        with self.lock:
+            if not os.path.isdir(entry_dir):
+                self.misses += 1
+                return None
+            self.hits += 1
+            os.utime(entry_dir)
+            return self._read(entry_dir)
+
+    def heatmap(self, key, ratio):
+        """
+        The stored heatmap PNG of ratio in the entry of key, opened for reading, or None.
+
+        For serving the images of a result on their own; unlike get() it reads
+        only the index of the entry and does not count as a lookup. The file is
+        opened under the lock, so evicting the entry afterwards does not cut
+        short a reader of it.
+        """
+        if len(key) != 64 or any(c not in '0123456789abcdef' for c in key):
+            return None
+        entry_dir = self._entry_dir(key)
+        with self.lock:
+            try:
+                with open(os.path.join(entry_dir, 'heatmaps.json')) as f:
+                    name = json.load(f).get(ratio)
+                if name is None:
+                    return None
+                image = open(os.path.join(entry_dir, name), 'rb')
+            except FileNotFoundError:
+                return None
+            os.utime(entry_dir)
+            return image
+
+    def key_of(self, path):
+        """The key of the entry holding path, a file returned in an entry's heatmaps. Raises ValueError for other paths."""
+        entry_dir = os.path.dirname(os.path.abspath(path))
+        key = os.path.basename(entry_dir)
+        if len(key) != 64 or entry_dir != os.path.abspath(self._entry_dir(key)):
+            raise ValueError(f"{path} is not in the result cache")
+        return key
+
+    def put(self, key, spectrum, result, heatmaps):
+        """Stores a workflow result; heatmaps maps ratios to PNG paths, which are copied. Returns the entry."""
+        entry_dir = self._entry_dir(key)
+        os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+        # Build the entry next to its final place and move it there in one step
+        staging = tempfile.mkdtemp(dir=os.path.dirname(entry_dir))
+        np.savez(os.path.join(staging, 'spectrum.npz'), **spectrum)
+        with open(os.path.join(staging, 'result.json'), 'w') as f:
+            json.dump(result, f, default=lambda value: value.item() if hasattr(value, 'item') else str(value))
+        index = {}
+        for ratio, path in heatmaps.items():
+            name = os.path.basename(path)
+            shutil.copyfile(path, os.path.join(staging, name))
+            index[ratio] = name
+        with open(os.path.join(staging, 'heatmaps.json'), 'w') as f:
+            json.dump(index, f)
+
+        with self.lock:
+            if os.path.isdir(entry_dir):
+                # Stored meanwhile by a concurrent job with the same inputs
+                shutil.rmtree(staging, ignore_errors=True)
+            else:
+                os.rename(staging, entry_dir)
+            self._evict()
+            return self._read(entry_dir)
+
+    def _read(self, entry_dir):
+        with np.load(os.path.join(entry_dir, 'spectrum.npz')) as store:
+            spectrum = {name: store[name].item() if store[name].ndim == 0 else store[name] for name in store.files}
+        with open(os.path.join(entry_dir, 'result.json')) as f:
+            result = json.load(f)
+        with open(os.path.join(entry_dir, 'heatmaps.json')) as f:
+            heatmaps = {ratio: os.path.join(entry_dir, name) for ratio, name in json.load(f).items()}
+        return {'spectrum': spectrum, 'result': result, 'heatmaps': heatmaps}
+
+    def _entries(self):
+        """(last use, bytes, path) of every entry."""
+        entries = []
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, key)
+                if len(key) != 64:
+                    continue  # an entry being staged
+                size = sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
+                entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        # Always keep the most recent entry, even if it alone exceeds max_bytes,
+        # and any entry recent enough that a job may still be reading it
+        in_use_since = time.time() - self.min_age
+        for last_use, size, entry_dir in entries[:-1]:
+            if total <= self.max_bytes or last_use >= in_use_since:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+    def stats(self):
+        """Hit/miss counts and the current size of the cache."""
+        with self.lock:
+            entries = self._entries()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None,
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+            'max_bytes': self.max_bytes,
+        }
@@ -0,0 +1,245 @@
+import io
+import os
+import threading
+import numpy as np
+from PIL import Image
+from rasterizer import EquirectangularRaster, FootprintCoverage, apply_colormap, colormap_lut
+from footprint_geometry import planar_parts, part_bounds
+
+RATIOS = ["Na/Si", "Al/Si", "Mg/Si", "Ca/Si"]
+RATIO_RANGE = (0, 2)
+TILE_SIZE = 256
+
+def tile_bounds(z, x, y):
+    """
+    (lon_range, lat_range) of tile z/x/y of the equirectangular lunar CRS.
+
+    Zoom z has 2**(z + 1) x 2**z square tiles: x counts east from lon -180 and
+    y counts south from lat 90, as in Leaflet's CRS.EPSG4326 tiling.
+    """
+    tile_degrees = 180 / 2 ** z
+    lon_min = -180 + x * tile_degrees
+    lat_max = 90 - y * tile_degrees
+    return (lon_min, lon_min + tile_degrees), (lat_max - tile_degrees, lat_max)
+
+def tiles_covering(lon_min, lon_max, lat_min, lat_max, z):
+    """Returns the (x, y) index ranges of the tiles of zoom z that overlap a lon/lat box."""
+    tile_degrees = 180 / 2 ** z
+    n_x, n_y = 2 ** (z + 1), 2 ** z
+    x0 = np.clip(np.floor((np.asarray(lon_min) + 180) / tile_degrees), 0, n_x - 1).astype(int)
+    x1 = np.clip(np.floor((np.asarray(lon_max) + 180) / tile_degrees), 0, n_x - 1).astype(int)
+    y0 = np.clip(np.floor((90 - np.asarray(lat_max)) / tile_degrees), 0, n_y - 1).astype(int)
+    y1 = np.clip(np.floor((90 - np.asarray(lat_min)) / tile_degrees), 0, n_y - 1).astype(int)
+    return x0, x1, y0, y1
+
+def downsample_rgba(rgba):
+    """Halves an RGBA image by averaging 2x2 blocks, weighting the colors by their alpha."""
+    height, width = rgba.shape[0] // 2, rgba.shape[1] // 2
+    blocks = rgba.reshape(height, 2, width, 2, 4).astype(np.float64)
+    alpha = blocks[..., 3].sum(axis=(1, 3))
+    rgb = (blocks[..., :3] * blocks[..., 3:]).sum(axis=(1, 3))
+    out = np.zeros((height, width, 4), dtype=np.uint8)
+    covered = alpha > 0
+    out[covered, :3] = np.round(rgb[covered] / alpha[covered, None])
+    out[..., 3] = np.round(alpha / 4)
+    return out
+
+def _concatenate_parts(a, b):
+    """Stacks two (m, k) part vertex arrays, padding the narrower one by repeating its last vertex as planar_parts does."""
+    width = max(a.shape[1], b.shape[1])
+    return np.concatenate([np.pad(parts, ((0, 0), (0, width - parts.shape[1])), mode='edge') for parts in (a, b)])
+
+
+class TilePyramid:
+    """
+    z/x/y tile pyramid of the ratio footprints, stored as root_dir/<Na_Si>/<z>/<x>/<y>.png.
+
+    The footprints (V0..V3 LAT/LON and the four ratios) are kept in
+    root_dir/footprints.npz. add_footprints() appends new ones and returns the
+    tiles they touch at every zoom; regenerate() re-renders just those tiles.
+    Only the tiles of max_zoom are rasterized, from the footprints of a tile
+    once for all four ratios; every tile below is downsampled from its four
+    children, so its cost does not grow with the number of footprints. Tiles
+    nothing falls on are not written.
+
+    Usage:
+        pyramid = TilePyramid('tiles')
+        pyramid.update(Extract_data(spectrum, background_dir))
+    """
+
+    def __init__(self, root_dir, max_zoom=6, image_format='png'):
+        if image_format not in ('png', 'webp'):
+            raise ValueError(f"Unknown tile format: {image_format}")
+        self.root_dir = root_dir
+        self.max_zoom = max_zoom
+        self.image_format = image_format
+        self.store_path = os.path.join(root_dir, 'footprints.npz')
+        # Serializes updates from concurrent upload jobs
+        self.lock = threading.RLock()
+        os.makedirs(root_dir, exist_ok=True)
+        if os.path.exists(self.store_path):
+            with np.load(self.store_path) as store:
+                self.lons, self.lats = store['lons'], store['lats']
+                self.values = {ratio: store[ratio.replace('/', '_')] for ratio in RATIOS}
+        else:
+            self.lons = np.zeros((0, 4))
+            self.lats = np.zeros((0, 4))
+            self.values = {ratio: np.zeros(0) for ratio in RATIOS}
+        self._update_parts()
+
+    def _update_parts(self):
+        # Flat-map polygons of the footprints (split at the antimeridian, capped at the poles), drawn by the tiles
+        self.part_lons, self.part_lats, self.part_owners = planar_parts(self.lons, self.lats)
+        self.part_bounds = part_bounds(self.part_lons, self.part_lats)
+
+    def _append_parts(self, lons, lats):
+        # Only the new footprints are split; their parts go after those of the stored ones
+        part_lons, part_lats, part_owners = planar_parts(lons, lats)
+        self.part_lons = _concatenate_parts(self.part_lons, part_lons)
+        self.part_lats = _concatenate_parts(self.part_lats, part_lats)
+        self.part_owners = np.concatenate([self.part_owners, part_owners + len(self.lons)])
+        self.part_bounds = tuple(np.concatenate([stored, new]) for stored, new
+                                 in zip(self.part_bounds, part_bounds(part_lons, part_lats)))
+
+    def __len__(self):
+        return len(self.lons)
+
+    def tile_path(self, ratio, z, x, y):
+        return os.path.join(self.root_dir, ratio.replace('/', '_'), str(z), str(x), f'{y}.{self.image_format}')
+
+    def add_footprints(self, results):
+        """
+        Appends footprints and returns the set of dirty (z, x, y) tiles.
+
+        results is one Extract_data result, a list of them, or a mapping of
+        array-valued columns with the same keys (e.g. a catalogue DataFrame).
+        """
+        if isinstance(results, list):
+            if not results:
+                return set()
+            results = {key: [result[key] for result in results] for key in results[0]}
+        lats = np.column_stack([np.atleast_1d(results[f"V{i}_LAT"]) for i in range(4)]).astype(np.float64)
+        lons = np.column_stack([np.atleast_1d(results[f"V{i}_LON"]) for i in range(4)]).astype(np.float64)
+
+        values = {ratio: np.concatenate([self.values[ratio], np.atleast_1d(results[ratio]).astype(np.float64)])
+                  for ratio in RATIOS}
+        all_lons, all_lats = np.concatenate([self.lons, lons]), np.concatenate([self.lats, lats])
+        # Written under a temporary name and renamed once complete, so a crash never leaves a truncated store
+        staging = f"{self.store_path[:-len('.npz')]}.{os.getpid()}.tmp.npz"
+        try:
+            np.savez(staging, lons=all_lons, lats=all_lats,
+                     **{ratio.replace('/', '_'): values[ratio] for ratio in RATIOS})
+            os.replace(staging, self.store_path)
+        except BaseException:
+            if os.path.exists(staging):
+                os.remove(staging)
+            raise
+        self._append_parts(lons, lats)
+        self.lons, self.lats, self.values = all_lons, all_lats, values
+        return self.dirty_tiles(lons, lats)
+
+    def update(self, results):
+        """Adds footprints and re-renders the tiles they touch, one update at a time. Returns the number rendered."""
+        with self.lock:
+            return self.regenerate(self.add_footprints(results))
+
+    def dirty_tiles(self, lons, lats):
+        """The (z, x, y) tiles of every zoom overlapped by the bounding boxes of the flat-map parts of footprints."""
+        dirty = set()
+        bounds = part_bounds(*planar_parts(lons, lats)[:2])
+        for z in range(self.max_zoom + 1):
+            x0, x1, y0, y1 = tiles_covering(*bounds, z)
+            for xa, xb, ya, yb in zip(x0, x1, y0, y1):
+                dirty.update((z, x, y) for x in range(xa, xb + 1) for y in range(ya, yb + 1))
+        return dirty
+
+    def render_tile(self, z, x, y):
+        """
+        Renders tile z/x/y of every ratio. Returns the paths written.
+
+        Tiles of max_zoom are rasterized from the footprints overlapping them,
+        the others are downsampled from their four children, which therefore
+        have to be rendered first (regenerate() goes from max_zoom down).
+        """
+        if z < self.max_zoom:
+            return self._merge_children(z, x, y)
+        lon_range, lat_range = tile_bounds(z, x, y)
+        lon_min, lon_max, lat_min, lat_max = self.part_bounds
+        overlapping = ((lon_max >= lon_range[0]) & (lon_min <= lon_range[1]) &
+                       (lat_max >= lat_range[0]) & (lat_min <= lat_range[1]))
+        parts = np.nonzero(overlapping)[0]
+        written = []
+        if len(parts) == 0:
+            for ratio in RATIOS:
+                if os.path.exists(self.tile_path(ratio, z, x, y)):
+                    os.remove(self.tile_path(ratio, z, x, y))
+            return written
+
+        raster = EquirectangularRaster(TILE_SIZE, TILE_SIZE, lon_range, lat_range)
+        # Number the footprints of the tile 0..n-1 for the coverage labels
+        indices, owners = np.unique(self.part_owners[parts], return_inverse=True)
+        coverage = FootprintCoverage(raster, self.part_lons[parts], self.part_lats[parts], owners=owners)
+        lut = colormap_lut('turbo')
+        for ratio in RATIOS:
+            coverage.render(apply_colormap(self.values[ratio][indices], *RATIO_RANGE, lut))
+            path = self.tile_path(ratio, z, x, y)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._save(raster.rgba, path)
+            written.append(path)
+        return written
+
+    def _merge_children(self, z, x, y):
+        written = []
+        for ratio in RATIOS:
+            path = self.tile_path(ratio, z, x, y)
+            mosaic = np.zeros((2 * TILE_SIZE, 2 * TILE_SIZE, 4), dtype=np.uint8)
+            found = False
+            # x counts east and y south, so child (2x + dx, 2y + dy) is the quarter at column dx, row dy
+            for dx in (0, 1):
+                for dy in (0, 1):
+                    child = self.tile_path(ratio, z + 1, 2 * x + dx, 2 * y + dy)
+                    if os.path.exists(child):
+                        with Image.open(child) as image:
+                            mosaic[dy * TILE_SIZE:(dy + 1) * TILE_SIZE,
+                                   dx * TILE_SIZE:(dx + 1) * TILE_SIZE] = np.asarray(image.convert('RGBA'))
+                        found = True
+            if not found:
+                if os.path.exists(path):
+                    os.remove(path)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._save(downsample_rgba(mosaic), path)
+            written.append(path)
+        return written
+
+    def _save(self, rgba, output):
+        """Encodes rgba into output, a buffer or a path; a path is replaced in one step once fully written."""
+        image_format = 'WEBP' if self.image_format == 'webp' else 'PNG'
+        options = {'lossless': True} if image_format == 'WEBP' else {}
+        if not isinstance(output, (str, os.PathLike)):
+            Image.fromarray(rgba, 'RGBA').save(output, format=image_format, **options)
+            return
+        # Tiles are served while they are re-rendered: never let a reader see a half-written one
+        staging = f"{output}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            Image.fromarray(rgba, 'RGBA').save(staging, format=image_format, **options)
+            os.replace(staging, output)
+        except BaseException:
+            if os.path.exists(staging):
+                os.remove(staging)
+            raise
+
+    def empty_tile(self):
+        """Encoded fully transparent tile, for tiles no footprint falls on."""
+        buffer = io.BytesIO()
+        self._save(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8), buffer)
+        return buffer.getvalue()
+
+    def regenerate(self, tiles=None):
+        """Renders the given (z, x, y) tiles, or the whole pyramid if tiles is None. Returns the number rendered."""
+        if tiles is None:
+            tiles = self.dirty_tiles(self.lons, self.lats) if len(self) else set()
+        # Children before parents: the tiles below max_zoom are built from the ones above
+        for z, x, y in sorted(tiles, key=lambda tile: (-tile[0], tile[1], tile[2])):
+            self.render_tile(z, x, y)
+        return len(tiles)
@@ -0,0 +1,250 @@
+import hashlib
+import io
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+import numpy as np
+from astropy.io import fits
+
+
+class UnreadableUpload(ValueError):
+    """Raised by UploadSession.append when a completed FITS file cannot be integrated; resending it will not help."""
+
+
+class UploadTooLarge(ValueError):
+    """Raised by UploadSession when a declared file is larger than the per-file limit."""
+
+
+class SpectrumAccumulator:
+    """
+    Running integration of CLASS L1 FITS files, one file at a time.
+
+    Holds the summed counts, the total exposure and the per-vertex footprint
+    bounds of the files added so far. spectrum() gives the same dict as
+    integrate_fits_files(files, None), without keeping the files themselves.
+    """
+
+    def __init__(self):
+        self.channels = None
+        self.summed_counts = None
+        self.exposure = 0
+        self.n_files = 0
+        self.min_lat = np.full(4, np.inf)
+        self.max_lat = np.full(4, -np.inf)
+        self.min_lon = np.full(4, np.inf)
+        self.max_lon = np.full(4, -np.inf)
+
+    def add(self, source):
+        """Folds one FITS file (a path or a file object) into the sums."""
+        with fits.open(source) as hdul:
+            data = hdul[1].data
+            header = hdul[1].header
+            if data is None:
+                return
+            channels = np.array(data['CHANNEL'])
+            counts = np.array(data['COUNTS'], dtype=np.float64)
+            exposure = header.get('EXPOSURE', 0)
+            lats = np.array([header.get(f'V{i}_LAT') for i in range(4)], dtype=np.float64)
+            lons = np.array([header.get(f'V{i}_LON') for i in range(4)], dtype=np.float64)
+
+        # Everything is read before anything is summed, so a bad file leaves the sums untouched
+        if self.channels is None:
+            self.channels = channels
+            self.summed_counts = np.zeros(len(channels), dtype=np.float64)
+        elif len(channels) != len(self.channels):
+            raise ValueError(f"{getattr(source, 'name', source)} has {len(channels)} channels, "
+                             f"expected {len(self.channels)}")
+        self.summed_counts += counts
+        self.exposure += exposure
+        self.min_lat, self.max_lat = np.minimum(self.min_lat, lats), np.maximum(self.max_lat, lats)
+        self.min_lon, self.max_lon = np.minimum(self.min_lon, lons), np.maximum(self.max_lon, lons)
+        self.n_files += 1
+
+    def spectrum(self, first_file_name):
+        """The integrated spectrum dict, dated by first_file_name as integrate_fits_files dates it by its first file."""
+        start_time_str = os.path.basename(first_file_name).split('.')[0].split('_')[3]
+        start_time = datetime.strptime(start_time_str, '%Y%m%dT%H%M%S%f')
+        if self.channels is None:
+            channels, summed_counts = np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+        else:
+            channels, summed_counts = self.channels, self.summed_counts
+        return {
+            'NAME': f"integrated_fits_{start_time.strftime('%Y%m%dT%H%M%S')}",
+            'START_TIME': start_time.isoformat(timespec='milliseconds'),
+            'CHANNEL': channels,
+            'COUNTS': summed_counts.astype(np.float32),
+            'EXPOSURE': self.exposure,
+            'V0_LAT': float(self.max_lat[0]), 'V1_LAT': float(self.min_lat[1]),
+            'V2_LAT': float(self.min_lat[2]), 'V3_LAT': float(self.max_lat[3]),
+            'V0_LON': float(self.max_lon[0]), 'V1_LON': float(self.min_lon[1]),
+            'V2_LON': float(self.min_lon[2]), 'V3_LON': float(self.max_lon[3]),
+        }
+
+
+class UploadFile:
+    """One declared file of a session: its bytes so far, until it is complete."""
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.buffer = io.BytesIO()
+        self.received = 0
+        self.digest = None
+
+    @property
+    def complete(self):
+        return self.digest is not None
+
+    def to_dict(self):
+        return {"name": self.name, "size": self.size, "received": self.received, "complete": self.complete}
+
+
+class UploadSession:
+    """
+    A chunked upload: declared FITS files (and optionally a background file) sent in chunks.
+
+    Chunks of a file must arrive in order, each at the offset the session has
+    received so far, so a client that lost its connection asks status() and
+    resumes from there. A FITS file is folded into the SpectrumAccumulator as
+    soon as its last chunk arrives and its bytes are dropped; only its SHA-256
+    is kept, for the result cache key. The background file is kept in memory
+    until finalize. Files declared larger than max_file_bytes raise
+    UploadTooLarge, since every byte is held in memory until the file completes.
+    """
+
+    def __init__(self, files, background=None, max_file_bytes=None):
+        self.id = uuid.uuid4().hex
+        self.files = {}
+        for name, size in files + ([background] if background is not None else []):
+            if size <= 0:
+                raise ValueError(f"{name} is empty")
+            if max_file_bytes is not None and size > max_file_bytes:
+                raise UploadTooLarge(f"{name}: {size} bytes exceed the limit of {max_file_bytes} per file")
+        for name, size in files:
+            if name in self.files:
+                raise ValueError(f"{name} is declared twice")
+            self.files[name] = UploadFile(name, size)
+        self.order = [name for name, _ in files]
+        self.background = UploadFile(*background) if background is not None else None
+        self.accumulator = SpectrumAccumulator()
+        self.lock = threading.Lock()
+        self.touched = time.time()
+
+    def _file(self, name, background=False):
+        upload = self.background if background else self.files.get(name)
+        if upload is None or upload.name != name:
+            raise KeyError(name)
+        return upload
+
+    def append(self, name, offset, chunk, background=False):
+        """
+        Appends a chunk at offset to a declared file; the last chunk completes it.
+
+        Raises KeyError for undeclared files and ValueError when offset is not
+        the number of bytes received so far or the chunk overruns the size.
+        A FITS file that cannot be integrated once complete raises
+        UnreadableUpload and is started over. Returns the state of the file.
+        """
+        with self.lock:
+            self.touched = time.time()
+            upload = self._file(name, background)
+            if upload.complete:
+                raise ValueError(f"{name} is already complete")
+            if offset != upload.received:
+                raise ValueError(f"{name}: expected offset {upload.received}, got {offset}")
+            if upload.received + len(chunk) > upload.size:
+                raise ValueError(f"{name}: {upload.received + len(chunk)} bytes exceed the declared {upload.size}")
+            upload.buffer.write(chunk)
+            upload.received += len(chunk)
+            if upload.received == upload.size:
+                digest = hashlib.sha256(upload.buffer.getbuffer()).hexdigest()
+                if not background:
+                    # Integrate the file right away; only its digest is kept
+                    upload.buffer.seek(0)
+                    upload.buffer.name = name
+                    try:
+                        self.accumulator.add(upload.buffer)
+                    except Exception as e:
+                        # Not a readable L1 file: start it over rather than poison the session
+                        upload.buffer, upload.received = io.BytesIO(), 0
+                        raise UnreadableUpload(f"{name} could not be integrated: {e}")
+                    upload.buffer = None
+                upload.digest = digest
+            return upload.to_dict()
+
+    @property
+    def complete(self):
+        uploads = list(self.files.values()) + ([self.background] if self.background is not None else [])
+        return all(upload.complete for upload in uploads)
+
+    def status(self):
+        with self.lock:
+            return {
+                "id": self.id,
+                "files": [self.files[name].to_dict() for name in self.order],
+                "background": self.background.to_dict() if self.background is not None else None,
+                "integrated": self.accumulator.n_files,
+                "complete": self.complete,
+            }
+
+    def finalize(self):
+        """
+        (spectrum, background source or None, (name, digest) pairs, background digest) of a complete session.
+
+        Raises ValueError while a declared file is incomplete.
+        """
+        with self.lock:
+            if not self.complete:
+                missing = [name for name in self.order if not self.files[name].complete]
+                raise ValueError(f"Incomplete files: {', '.join(missing) or self.background.name}")
+            background = None
+            if self.background is not None:
+                background = self.background.buffer
+                background.seek(0)
+                background.name = self.background.name
+            digests = [(name, self.files[name].digest) for name in self.order]
+            return (self.accumulator.spectrum(self.order[0]), background, digests,
+                    self.background.digest if self.background is not None else None)
+
+
+class UploadSessions:
+    """
+    The open upload sessions of the server, forgotten after max_idle seconds without a chunk.
+
+    At most max_sessions may be open at once; create() raises RuntimeError beyond that.
+    Each declared file may be at most max_file_bytes long (None for no limit).
+    """
+
+    def __init__(self, max_sessions=16, max_idle=3600, max_file_bytes=64 << 20):
+        self.max_sessions = max_sessions
+        self.max_idle = max_idle
+        self.max_file_bytes = max_file_bytes
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def create(self, files, background=None):
+        """Opens a session for files ((name, size) pairs, in order) and an optional (name, size) background."""
+        if not files:
+            raise ValueError("No files declared")
+        session = UploadSession(files, background, self.max_file_bytes)
+        with self.lock:
+            self._forget_idle()
+            if len(self.sessions) >= self.max_sessions:
+                raise RuntimeError(f"{len(self.sessions)} upload sessions are already open")
+            self.sessions[session.id] = session
+        return session
+
+    def _forget_idle(self):
+        now = time.time()
+        for session_id in [key for key, session in self.sessions.items() if now - session.touched > self.max_idle]:
+            del self.sessions[session_id]
+
+    def get(self, session_id):
+        with self.lock:
+            return self.sessions.get(session_id)
+
+    def close(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
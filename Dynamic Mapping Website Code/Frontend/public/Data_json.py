@@ -1,6 +1,5 @@
 import os
 import numpy as np
-import matplotlib.pyplot as plt
 from astropy.io import fits
 from scipy.signal import find_peaks
 from scipy.optimize import curve_fit
@@ -12,7 +11,28 @@ import json
 
 
 
-def Extract_data(spectrum_file):
+def plot_fit_record(record, output_path=None):
+    """Plots one diagnostics record of Extract_data on its own Figure, saving it to output_path if given."""
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(10, 6))
+    ax = fig.add_subplot()
+    ax.plot(record['energy'], record['corrected_counts'])
+    for energy_window, fitted_curve, mu in record['fits']:
+        ax.plot(energy_window, fitted_curve,
+                label=f'Peak at {mu:.2f} keV',
+                linestyle='--')
+        ax.axvline(mu, color='red', linestyle=':', alpha=0.7)
+    ax.set_title(os.path.basename(str(record['fits_file'])))
+    ax.legend()
+    if output_path is not None:
+        fig.savefig(output_path)
+    return fig
+
+
+def Extract_data(spectrum_file, diagnostics=None):
+    # Nothing is plotted here. Pass a list as diagnostics to get one record of
+    # the spectrum and its fitted peaks appended to it, for plot_fit_record.
     background_file = r"C:/Users/CSE IIT BHILAI/HP4/background_2020/background_month/output_2020_10.fits"
     k_alpha_lines = {
         8: 0.525,   # Oxygen
@@ -49,7 +69,6 @@ def Extract_data(spectrum_file):
             background_counts = background_data['MEAN_COUNTS'] 
             background_counts = background_counts[37:251]
             corrected_counts =counts - background_counts
-        plt.plot(energy,corrected_counts)
         return energy, corrected_counts, counts, background_counts
 
     def identify_peaks(energy, counts, smoothing_sigma=2, prominence_factor=0.75):
@@ -65,6 +84,7 @@ def Extract_data(spectrum_file):
         )
         
         peaks_info = []
+        fitted_curves = []
         
         for peak in peaks:
             window_size = 10
@@ -91,15 +111,15 @@ def Extract_data(spectrum_file):
                 A, mu, sigma = popt
                 peaks_info.append((mu, sigma, A))
                 
-                fitted_curve = gaussian(energy_window, *popt)
-                plt.plot(energy_window, fitted_curve, 
-                         label=f'Peak at {mu:.2f} keV', 
-                         linestyle='--')
-                plt.axvline(mu, color='red', linestyle=':', alpha=0.7)
+                if diagnostics is not None:
+                    fitted_curves.append((energy_window, gaussian(energy_window, *popt), mu))
             
             except RuntimeError:
                 print(f"Fitting failed for peak at {energy[peak]} keV")
         
+        if diagnostics is not None:
+            diagnostics.append({'fits_file': spectrum_file, 'energy': energy,
+                                'corrected_counts': counts, 'fits': fitted_curves})
         return peaks_info
 
     def match_peaks_to_elements(peaks_info, k_alpha_lines, tolerance=0.2):
@@ -5,6 +5,46 @@ import { useHeatmapContext } from '../context/HeatmapContext';
 import UploadComponent from './UploadPage';
 import { image } from 'd3';
 
+const API_URL = 'http://10.10.75.173:5000';
+const CHUNK_SIZE = 1024 * 1024;
+
+// Sends one file of an upload session in CHUNK_SIZE pieces, under the name the
+// server gave it. The server integrates each FITS file as soon as its last chunk
+// arrives; after a failed chunk the upload resumes from the bytes it reports as received,
+// giving up after 5 failures, or at once on a file the server cannot read (422).
+const sendFile = async (sessionId, file, name, background = false) => {
+  let offset = 0;
+  let failures = 0;
+  do {
+    const url = `${API_URL}/uploads/${sessionId}/files/${encodeURIComponent(name)}` +
+      `?offset=${offset}${background ? '&background=1' : ''}`;
+    let response = null;
+    try {
+      response = await fetch(url, { method: 'PUT', body: file.slice(offset, offset + CHUNK_SIZE) });
+    } catch (error) {
+      // Network error: retried like a refused chunk
+    }
+    if (response?.ok) {
+      const state = await response.json();
+      offset = state.received;
+      if (state.complete) return;
+      continue;
+    }
+    if (response?.status === 422) {
+      const { error } = await response.json();
+      throw new Error(error || `${file.name} is not a readable FITS file.`);
+    }
+    if (++failures > 5) {
+      throw new Error(`Failed to upload ${file.name}.`);
+    }
+    // Ask the server how far it got and go on from there
+    const status = await (await fetch(`${API_URL}/uploads/${sessionId}`)).json();
+    const entry = background ? status.background : status.files.find((f) => f.name === name);
+    if (entry.complete) return;
+    offset = entry.received;
+  } while (true);
+};
+
 const Sidebar = ({ onFilterApply, setImages }) => {
   const { customHeatmaps } = useHeatmapContext();
   const [elements, setElements] = useState([]);
@@ -54,33 +94,54 @@ const Sidebar = ({ onFilterApply, setImages }) => {
     setIsLoading(true);
 
     try {
-        console.log('hellopwpeioiwh')
-      const formData = new FormData();
-      files.forEach((file) => {
-        formData.append('files', file);
+      // Chunked upload: declare the files, send each one, then finalize
+      const init = await fetch(`${API_URL}/uploads`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+          files: files.map((file) => ({ name: file.name, size: file.size })),
+          background: backgroundFile ? { name: backgroundFile.name, size: backgroundFile.size } : null,
+        }),
       });
-
+      if (!init.ok) {
+        throw new Error('Failed to start the upload.');
+      }
+      const session = await init.json();
+      for (const [index, file] of files.entries()) {
+        await sendFile(session.session_id, file, session.files[index]);
+      }
       if (backgroundFile) {
-        formData.append('backgroundFile', backgroundFile);
+        await sendFile(session.session_id, backgroundFile, session.background, true);
       }
 
-      // API request to upload files
-      const response = await fetch('http://10.10.75.173:5000/upload', {
-        method: 'POST',
-        body: formData,
-      });
+      const response = await fetch(`${API_URL}/uploads/${session.session_id}/finalize`, { method: 'POST' });
 
       if (!response.ok) {
         throw new Error('Failed to upload files.');
       }
 
-      const result = await response.json();
+      // The upload is processed as a background job: poll it until it finishes
+      const { status_url } = await response.json();
+      // Cached results are ready almost at once, so poll quickly first and back off
+      let job;
+      let delay = 100;
+      do {
+        await new Promise((resolve) => setTimeout(resolve, delay));
+        delay = Math.min(delay * 2, 2000);
+        job = await (await fetch(`${API_URL}${status_url}`)).json();
+        console.log(`job ${job.id}: ${job.status} (${job.stage})`);
+      } while (job.status === 'queued' || job.status === 'running');
+
+      if (job.status !== 'done') {
+        throw new Error(job.error || 'Failed to process files.');
+      }
+      const result = job.result;
       console.log('result:', result);
 
       if (result?.heatmap_images.length>0 && Object.keys(result?.heatmap_images[0]).length > 0) {
         // Convert heatmap_images object into an array of { key, src }
-        const imageArray = Object.entries(result.heatmap_images[0]).map(([key, base64String]) => ({
-            [key]: `data:image/png;base64,${base64String}`,  // Create a key-value pair where the key is the original key and the value is the Base64 string
+        const imageArray = Object.entries(result.heatmap_images[0]).map(([key, url]) => ({
+            [key]: `${API_URL}${url}`,  // The image is fetched (and cached by the browser) from its own URL
           }));
           
         console.log(imageArray)
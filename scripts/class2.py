@@ -4,6 +4,9 @@ import numpy as np
 from datetime import datetime
 from pathlib import Path
 
+# Geometry keys averaged into the SPICE header values of every summed window
+SPICE_KEYS = ['SAT_ALT', 'SOLARANG', 'PHASEANG', 'EMISNANG']
+
 def convert_time_str_format(time_str):
     """Convert time string from YYYYMMDDTHHMMSSMMM to YYYY-MM-DDTHH:MM:SS.MMM format."""
     return f"{time_str[:4]}-{time_str[4:6]}-{time_str[6:8]}T{time_str[9:11]}:{time_str[11:13]}:{time_str[13:15]}.{time_str[15:]}"
@@ -13,8 +16,18 @@ def utc_to_seconds(utc_time):
     utc_datetime = datetime.strptime(utc_time, '%Y-%m-%dT%H:%M:%S.%f')
     return int(utc_datetime.timestamp())
 
-def write_summed_fits(output_filename, summed_data, input_filename, expotime, starttime, endtime, spice_values):
-    """Write summed data to a FITS file with metadata headers."""
+def write_summed_fits(output_filename, summed_data, input_filename, expotime, starttime, endtime, spice_values,
+                      pha2_writer=None):
+    """
+    Write summed data to a FITS file with metadata headers.
+
+    If a PHA2Writer (Backend/pha2.py) is given, the spectrum is appended to it as one
+    row instead, named after output_filename.
+    """
+    if pha2_writer is not None:
+        return pha2_writer.append(Path(output_filename).stem, summed_data, expotime,
+                                  start_time=starttime, end_time=endtime, **spice_values)
+
     hdu = fits.PrimaryHDU()
     hdu.header['DATE'] = datetime.utcnow().isoformat()
     hdu.header['EXPOSURE'] = expotime
@@ -24,7 +37,7 @@ def write_summed_fits(output_filename, summed_data, input_filename, expotime, st
     hdu.header['INSTRUME'] = 'CLASS'
     hdu.header['PROGRAM'] = 'CLASS_add_scds_time'
 
-    # SPICE parameters (example placeholders)
+    # SPICE parameters: mean geometry of the summed files
     for key, value in spice_values.items():
         hdu.header[key] = value
 
@@ -36,41 +49,76 @@ def write_summed_fits(output_filename, summed_data, input_filename, expotime, st
     hdul = fits.HDUList([hdu, hdu_bt])
     hdul.writeto(output_filename, overwrite=True)
 
-def add_l1_files_time(input_dir, start_utc, end_utc, output_dir):
+def mean_spice_values(values):
+    """Mean of each SPICE_KEYS list of values, ignoring missing ones; keys without any value are left out."""
+    spice_values = {}
+    for key in SPICE_KEYS:
+        present = np.array([v for v in values.get(key, []) if v is not None], dtype=np.float64)
+        present = present[~np.isnan(present)]
+        if len(present):
+            spice_values[key] = round(float(present.mean()), 3)
+    return spice_values
+
+def add_l1_files_time(input_dir, start_utc, end_utc, output_dir, header_index=None, cube=None):
+    """
+    Sums the COUNTS of every L1 file in input_dir that lies inside [start_utc, end_utc].
+
+    The EXPOSURE written is the sum of the summed spectra's EXPOSURE, as in
+    CoaddEngine, and a window without any spectrum raises ValueError.
+
+    If a FitsHeaderIndex already holding input_dir is given (see
+    FitsHeaderIndex.update_directory), the files of the window are found with
+    one index query and their SPICE angles are taken from it, so only those
+    files are opened. If a SpectralCube is given, the window is sliced out of
+    the cube and input_dir is not read at all. The SPICE header values are
+    the means of SAT_ALT, SOLARANG, PHASEANG and EMISNANG over the summed files.
+    """
     # Ensure output directory exists
     output_path = Path(output_dir)
     output_path.mkdir(parents=True, exist_ok=True)
     
-    # Convert input start and end UTC to seconds
-    start_utc_secs = utc_to_seconds(start_utc)
-    end_utc_secs = utc_to_seconds(end_utc)
-    
     # Read input files and select based on timestamp
-    file_list = sorted(Path(input_dir).glob("*.fits"))
-    summed_data = np.zeros(2048, dtype=np.float64)  # Array to store summed data
-    
-    selected_files = []
-    for file in file_list:
-        filename = file.name
-        start_time_str = filename[11:29]
-        end_time_str = filename[30:48]
-        
-        start_time_secs = utc_to_seconds(convert_time_str_format(start_time_str))
-        end_time_secs = utc_to_seconds(convert_time_str_format(end_time_str))
+    if cube is not None:
+        window = cube.time_slice(start_utc, end_utc)
+        summed_data = window.summed_counts()
+        selected_files = window.filenames
+        exposure = float(window.meta['EXPOSURE'].sum())
+        spice_values = mean_spice_values({key: window.meta[key].tolist() for key in SPICE_KEYS})
+    else:
+        if header_index is not None:
+            # Times are compared at one-second resolution: YYYY-MM-DDTHH:MM:SS sorts before any
+            # time of that second, and YYYY-MM-DDTHH:MM:SS.999 after any of them
+            rows = header_index.query(input_dir, start_utc[:19], end_utc[:19] + '.999')
+            window_files = [(Path(row['path']), row) for row in sorted(rows, key=lambda row: row['filename'])]
+        else:
+            # Convert input start and end UTC to seconds
+            start_utc_secs = utc_to_seconds(start_utc)
+            end_utc_secs = utc_to_seconds(end_utc)
+            window_files = []
+            for file in sorted(Path(input_dir).glob("*.fits")):
+                start_time_secs = utc_to_seconds(convert_time_str_format(file.name[11:29]))
+                end_time_secs = utc_to_seconds(convert_time_str_format(file.name[30:48]))
+                if start_time_secs >= start_utc_secs and end_time_secs <= end_utc_secs:
+                    window_files.append((file, None))
+        summed_data = np.zeros(2048, dtype=np.float64)  # Array to store summed data
 
-        if start_time_secs >= start_utc_secs and end_time_secs <= end_utc_secs:
+        selected_files = []
+        exposure = 0.0
+        angles = {key: [] for key in SPICE_KEYS}
+        for file, row in window_files:
             with fits.open(file) as hdul:
                 data = hdul[1].data['COUNTS']  # Assuming the counts are stored in the 1st extension
                 summed_data += data
-            selected_files.append(filename)
-    
-    # Calculate mean SPICE values (placeholders)
-    spice_values = {
-        'SAT_ALT': 100.0,  # Example values
-        'SOLARANG': 10.0,
-        'PHASEANG': 20.0,
-        'EMISNANG': 30.0,
-    }
+                # Index rows of files changed since they were indexed give way to the header
+                header = row if row is not None and header_index.is_current(row) else hdul[1].header
+                exposure += header['EXPOSURE']
+                for key in SPICE_KEYS:
+                    angles[key].append(header.get(key))
+            selected_files.append(file.name)
+        spice_values = mean_spice_values(angles)
+
+    if not selected_files:
+        raise ValueError(f"No L1 files in {input_dir} between {start_utc} and {end_utc}")
     
     # Prepare output filename (remove colons from timestamps)
     clean_start = start_utc.replace(":", "-")
@@ -82,7 +130,7 @@ def add_l1_files_time(input_dir, start_utc, end_utc, output_dir):
         output_filename=output_filename,
         summed_data=summed_data,
         input_filename=", ".join(selected_files),
-        expotime=(end_utc_secs - start_utc_secs),
+        expotime=exposure,
         starttime=start_utc,
         endtime=end_utc,
         spice_values=spice_values
@@ -90,8 +138,9 @@ def add_l1_files_time(input_dir, start_utc, end_utc, output_dir):
     print(f"Summed FITS file written to {output_filename}")
 
 # Usage example
-input_dir = 'FITS_FILES'
-output_dir = r'C:/Users/chand/OneDrive/Desktop/New/Inter_IIT/Output/L1_ADDED_FILES_TIME'
-start_utc = '2020-02-01T00:00:00.114'
-end_utc = '2020-02-01T00:45:12.114'
-add_l1_files_time(input_dir, start_utc, end_utc, output_dir)
+if __name__ == "__main__":
+    input_dir = 'FITS_FILES'
+    output_dir = r'C:/Users/chand/OneDrive/Desktop/New/Inter_IIT/Output/L1_ADDED_FILES_TIME'
+    start_utc = '2020-02-01T00:00:00.114'
+    end_utc = '2020-02-01T00:45:12.114'
+    add_l1_files_time(input_dir, start_utc, end_utc, output_dir)
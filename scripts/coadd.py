@@ -0,0 +1,151 @@
+import os
+import numpy as np
+from pathlib import Path
+from class2 import SPICE_KEYS, write_summed_fits
+
+class CoaddEngine:
+    """
+    Co-adds arbitrary UTC windows of a SpectralCube from prefix sums.
+
+    Per-channel cumulative counts, cumulative EXPOSURE and cumulative geometry
+    angles are built once over the time-ordered spectra, so each window costs
+    two binary searches and one subtraction over the channels, independent of
+    how many spectra it covers.
+
+    Usage:
+        engine = CoaddEngine(SpectralCube('cube_2020_02'))
+        engine.coadd_windows([('2020-02-01T00:00:00.114', '2020-02-01T00:45:12.114')], 'L1_ADDED_FILES_TIME')
+    """
+
+    def __init__(self, cube):
+        self.cube = cube
+        n_spectra, n_channels = cube.counts.shape
+
+        # Cumulative counts are cached next to the cube so they are only computed once
+        cumsum_path = os.path.join(cube.cube_dir, 'cumsum.npy') if cube.cube_dir is not None else None
+        counts_path = os.path.join(cube.cube_dir, 'counts.npy') if cube.cube_dir is not None else None
+        self.cum_counts = None
+        if cumsum_path is not None and os.path.exists(cumsum_path) \
+                and os.path.getmtime(cumsum_path) >= os.path.getmtime(counts_path):
+            try:
+                cum_counts = np.load(cumsum_path, mmap_mode='r')
+            except (OSError, ValueError):
+                cum_counts = None
+            if cum_counts is not None and cum_counts.shape == (n_spectra + 1, n_channels):
+                self.cum_counts = cum_counts
+        if self.cum_counts is None:
+            if cumsum_path is not None:
+                # Built under a temporary name and renamed once complete, so an
+                # interrupted build never leaves partial sums behind as cumsum.npy
+                staging = f"{cumsum_path[:-len('.npy')]}.{os.getpid()}.tmp.npy"
+                cum_counts = np.lib.format.open_memmap(staging, mode='w+', dtype=np.float64,
+                                                       shape=(n_spectra + 1, n_channels))
+                cum_counts[0] = 0
+                np.cumsum(cube.counts, axis=0, dtype=np.float64, out=cum_counts[1:])
+                cum_counts.flush()
+                del cum_counts
+                os.replace(staging, cumsum_path)
+                self.cum_counts = np.load(cumsum_path, mmap_mode='r')
+            else:
+                self.cum_counts = np.empty((n_spectra + 1, n_channels), dtype=np.float64)
+                self.cum_counts[0] = 0
+                np.cumsum(cube.counts, axis=0, dtype=np.float64, out=self.cum_counts[1:])
+
+        self.cum_exposure = np.concatenate([[0.0], np.cumsum(cube.meta['EXPOSURE'])])
+        self.cum_spice = {}
+        self.cum_spice_valid = {}
+        for key in SPICE_KEYS:
+            values = np.asarray(cube.meta[key], dtype=np.float64)
+            valid = ~np.isnan(values)
+            self.cum_spice[key] = np.concatenate([[0.0], np.cumsum(np.where(valid, values, 0.0))])
+            self.cum_spice_valid[key] = np.concatenate([[0], np.cumsum(valid)])
+
+        # Window bounds are compared at one-second resolution, like add_l1_files_time
+        self.start_secs = cube.meta['start_time'].astype('datetime64[s]')
+        self.end_secs = cube.meta['end_time'].astype('datetime64[s]')
+
+    def window_bounds(self, start_utcs, end_utcs):
+        """Returns the [first, last) spectrum rows of each window."""
+        starts = np.array(start_utcs, dtype='datetime64[ms]').astype('datetime64[s]')
+        ends = np.array(end_utcs, dtype='datetime64[ms]').astype('datetime64[s]')
+        first = np.searchsorted(self.start_secs, starts, side='left')
+        last = np.maximum(first, np.searchsorted(self.end_secs, ends, side='right'))
+        return first, last
+
+    def coadd(self, windows):
+        """
+        Co-adds a batch of windows.
+
+        Parameters:
+        - windows (list of (start_utc, end_utc)): Bounds as YYYY-MM-DDTHH:MM:SS.MMM strings.
+
+        Returns:
+        - summed (ndarray): (n_windows x channels) summed counts.
+        - exposure (ndarray): Summed EXPOSURE of the spectra in each window.
+        - n_spectra (ndarray): Number of spectra in each window.
+        - spice_values (list of dict): Mean SAT_ALT, SOLARANG, PHASEANG and EMISNANG per window.
+        """
+        first, last = self.window_bounds([start for start, _ in windows], [end for _, end in windows])
+        return self._coadd_rows(first, last)
+
+    def _coadd_rows(self, first, last):
+        summed = self.cum_counts[last] - self.cum_counts[first]
+        exposure = self.cum_exposure[last] - self.cum_exposure[first]
+
+        spice_values = [{} for _ in first]
+        for key in SPICE_KEYS:
+            totals = self.cum_spice[key][last] - self.cum_spice[key][first]
+            counts = self.cum_spice_valid[key][last] - self.cum_spice_valid[key][first]
+            for i in np.nonzero(counts)[0]:
+                spice_values[i][key] = round(float(totals[i] / counts[i]), 3)
+
+        return summed, exposure, last - first, spice_values
+
+    def coadd_windows(self, windows, output_dir, pha2_writer=None):
+        """
+        Co-adds a batch of windows and writes each one through write_summed_fits. Returns the output filenames.
+
+        With a PHA2Writer, every window becomes one row of its type II table instead of a separate file.
+        Windows without any spectrum are reported and skipped, as add_l1_files_time refuses them.
+        """
+        output_path = Path(output_dir)
+        output_path.mkdir(parents=True, exist_ok=True)
+
+        first, last = self.window_bounds([start for start, _ in windows], [end for _, end in windows])
+        summed, exposure, n_spectra, spice_values = self._coadd_rows(first, last)
+
+        output_filenames = []
+        for i, (start_utc, end_utc) in enumerate(windows):
+            if n_spectra[i] == 0:
+                print(f"Skipping {start_utc} - {end_utc}: no spectra in the window")
+                continue
+            clean_start = start_utc.replace(":", "-")
+            clean_end = end_utc.replace(":", "-")
+            output_filename = output_path / f"added_{clean_start}_{clean_end}.fits"
+            write_summed_fits(
+                output_filename=output_filename,
+                summed_data=summed[i],
+                input_filename=", ".join(self.cube[first[i]:last[i]].filenames),
+                expotime=float(exposure[i]),
+                starttime=start_utc,
+                endtime=end_utc,
+                spice_values=spice_values[i],
+                pha2_writer=pha2_writer
+            )
+            output_filenames.append(output_filename)
+        return output_filenames
+
+
+# Usage example
+if __name__ == "__main__":
+    from spectral_cube import SpectralCube
+
+    cube_dir = 'C:/Users/hp/Desktop/INTER IIT TECH MEET HP-4/cube_2020_02'
+    output_dir = r'C:/Users/chand/OneDrive/Desktop/New/Inter_IIT/Output/L1_ADDED_FILES_TIME'
+    windows = [
+        ('2020-02-01T00:00:00.114', '2020-02-01T00:45:12.114'),
+        ('2020-02-01T00:45:12.114', '2020-02-01T01:30:24.114'),
+    ]
+    engine = CoaddEngine(SpectralCube(cube_dir))
+    for output_filename in engine.coadd_windows(windows, output_dir):
+        print(f"Summed FITS file written to {output_filename}")
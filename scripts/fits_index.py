@@ -0,0 +1,168 @@
+import os
+import sqlite3
+from datetime import datetime
+from astropy.io import fits
+
+# Header keys stored for every CLASS L1 file
+INDEX_KEYS = [
+    'EXPOSURE',
+    'V0_LAT', 'V1_LAT', 'V2_LAT', 'V3_LAT',
+    'V0_LON', 'V1_LON', 'V2_LON', 'V3_LON',
+    'SAT_ALT', 'SOLARANG', 'PHASEANG', 'EMISNANG',
+]
+
+def parse_file_times(filename):
+    """Extracts the start and end timestamps (YYYY-MM-DDTHH:MM:SS.MMM) from a CLASS L1 filename."""
+    core_name = os.path.splitext(os.path.basename(filename))[0]
+    start_str, end_str = core_name.split('_')[-2:]
+    times = []
+    for time_str in (start_str, end_str):
+        timestamp = datetime.strptime(time_str, '%Y%m%dT%H%M%S%f')
+        times.append(timestamp.strftime('%Y-%m-%dT%H:%M:%S.') + f"{timestamp.microsecond // 1000:03d}")
+    return times[0], times[1]
+
+
+class FitsHeaderIndex:
+    """
+    On-disk SQLite index of per-file CLASS L1 header metadata.
+
+    Rows are keyed by absolute path and are only refreshed when the file's
+    mtime or size changes, so a directory is read once and afterwards each
+    update costs a single stat per file.
+
+    Usage:
+        with FitsHeaderIndex('fits_index.sqlite') as index:
+            index.update_directory('calibrated/2020/02/01')
+            rows = index.query('calibrated/2020/02/01')
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.conn = sqlite3.connect(index_path)
+        self.conn.row_factory = sqlite3.Row
+        key_columns = ", ".join(f"{key} REAL" for key in INDEX_KEYS)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS headers ("
+            "path TEXT PRIMARY KEY, directory TEXT, filename TEXT, "
+            "mtime REAL, size INTEGER, start_time TEXT, end_time TEXT, "
+            f"{key_columns})"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS headers_dir_time ON headers (directory, start_time)")
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def _read_entry(self, path, stat):
+        header = fits.getheader(path, 1)
+        start_time, end_time = parse_file_times(path)
+        values = []
+        for key in INDEX_KEYS:
+            value = header.get(key)
+            values.append(float(value) if value is not None else None)
+        return [path, os.path.dirname(path), os.path.basename(path),
+                stat.st_mtime, stat.st_size, start_time, end_time] + values
+
+    def update(self, fits_filepaths):
+        """
+        Indexes the given files, re-reading headers only for new or modified files. Returns the number re-read.
+
+        Files whose header or name cannot be read are reported and skipped.
+        """
+        paths = [os.path.abspath(p) for p in fits_filepaths]
+        known = {}
+        for chunk_start in range(0, len(paths), 500):
+            chunk = paths[chunk_start:chunk_start + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            for row in self.conn.execute(f"SELECT path, mtime, size FROM headers WHERE path IN ({placeholders})", chunk):
+                known[row['path']] = (row['mtime'], row['size'])
+
+        entries = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                if known.get(path) == (stat.st_mtime, stat.st_size):
+                    continue
+                entries.append(self._read_entry(path, stat))
+            except Exception as e:
+                # A corrupt or misnamed file is left out; the rest of the update goes on
+                print(f"Skipping {path}: {type(e).__name__}: {e}")
+
+        if entries:
+            placeholders = ", ".join("?" * len(entries[0]))
+            self.conn.executemany(f"INSERT OR REPLACE INTO headers VALUES ({placeholders})", entries)
+            self.conn.commit()
+        return len(entries)
+
+    def update_directory(self, directory, recursive=False):
+        """Indexes every .fits file in a directory and drops rows for files that no longer exist."""
+        directory = os.path.abspath(directory)
+        if recursive:
+            fits_filepaths = [os.path.join(root, f) for root, _, files in os.walk(directory)
+                              for f in files if f.endswith('.fits')]
+        else:
+            fits_filepaths = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.fits')]
+
+        existing = set(fits_filepaths)
+        if recursive:
+            # Literal prefix match: '_' and '%' in the path must not act as LIKE wildcards
+            prefix = os.path.join(directory, '')
+            rows = self.conn.execute("SELECT path FROM headers WHERE directory = ? OR substr(directory, 1, ?) = ?",
+                                     (directory, len(prefix), prefix))
+        else:
+            rows = self.conn.execute("SELECT path FROM headers WHERE directory = ?", (directory,))
+        stale = [(row['path'],) for row in rows if row['path'] not in existing]
+        if stale:
+            self.conn.executemany("DELETE FROM headers WHERE path = ?", stale)
+            self.conn.commit()
+        return self.update(fits_filepaths)
+
+    def get(self, path):
+        """
+        Returns the indexed metadata of a single file as a dict, or None if it is not indexed.
+
+        A row whose file has changed (or gone) since it was indexed is not returned
+        either, so callers fall back to the header of the file itself.
+        """
+        row = self.conn.execute("SELECT * FROM headers WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        if row is None or not self.is_current(row):
+            return None
+        return dict(row)
+
+    @staticmethod
+    def is_current(row):
+        """True if the file of an indexed row still has the mtime and size it was indexed with."""
+        try:
+            stat = os.stat(row['path'])
+        except OSError:
+            return False
+        return (row['mtime'], row['size']) == (stat.st_mtime, stat.st_size)
+
+    def query(self, directory=None, start_time=None, end_time=None):
+        """
+        Returns indexed rows sorted by start time.
+
+        Parameters:
+        - directory (str, optional): Restrict to files directly inside this directory.
+        - start_time, end_time (str, optional): YYYY-MM-DDTHH:MM:SS.MMM bounds; a file is
+          returned when it starts at or after start_time and ends at or before end_time.
+        """
+        clauses, params = [], []
+        if directory is not None:
+            clauses.append("directory = ?")
+            params.append(os.path.abspath(directory))
+        if start_time is not None:
+            clauses.append("start_time >= ?")
+            params.append(start_time)
+        if end_time is not None:
+            clauses.append("end_time <= ?")
+            params.append(end_time)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self.conn.execute(f"SELECT * FROM headers{where} ORDER BY start_time, path", params)
+        return [dict(row) for row in rows]
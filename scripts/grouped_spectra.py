@@ -0,0 +1,108 @@
+import numpy as np
+from datetime import datetime
+from astropy.io import fits
+
+# Averaged geometry columns of every group, stored as NaN when a group has no value
+GEOMETRY_KEYS = ['SAT_ALT', 'SOLARANG', 'PHASEANG', 'EMISNANG']
+
+# keV per channel, as used for the Energy column of the grouping CSV
+ENERGY_PER_CHANNEL = 0.0135
+
+def _format_time(timestamp):
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%S.') + f"{timestamp.microsecond // 1000:03d}"
+
+def write_grouped_spectra(groups, output_path, n_channels=2048, chunk_size=1024):
+    """
+    Writes grouped spectra as a multi-row FITS binary table, one row per group.
+
+    Each row holds START_TIME/END_TIME (ISO strings), the bounding box
+    (MIN_LON, MAX_LON, MIN_LAT, MAX_LAT), N_FILES, the averaged geometry
+    angles and a fixed-length COUNTS vector of n_channels elements. The
+    channel-to-energy slope is stored once in the header instead of per row.
+
+    Rows are streamed to the file chunk_size groups at a time, so memory does
+    not grow with the number of groups; the row count is filled into the
+    header once the last group is written. No groups give an empty table.
+
+    Parameters:
+    - groups (iterable of dict): Groups as produced by iter_groups.
+    - output_path (str): Path of the FITS file to write.
+
+    Returns the number of groups written.
+    """
+    columns = fits.ColDefs(
+        [fits.Column(name='START_TIME', format='23A'), fits.Column(name='END_TIME', format='23A')]
+        + [fits.Column(name=name, format='D') for name in ('MIN_LON', 'MAX_LON', 'MIN_LAT', 'MAX_LAT')]
+        + [fits.Column(name='N_FILES', format='J')]
+        + [fits.Column(name=key, format='D') for key in GEOMETRY_KEYS]
+        + [fits.Column(name='COUNTS', format=f'{n_channels}E')]
+    )
+    header = fits.BinTableHDU.from_columns(columns, nrows=0).header
+    header['EXTNAME'] = 'GROUPS'
+    header['DETCHANS'] = n_channels
+    header['E_SLOPE'] = (ENERGY_PER_CHANNEL, 'keV per channel')
+    header['DATE'] = datetime.utcnow().isoformat()
+    # FITS tables are big-endian on disk
+    rows = np.zeros(chunk_size, dtype=columns.dtype.newbyteorder('>'))
+
+    n_groups = 0
+    with open(output_path, 'wb') as f:
+        f.write(fits.PrimaryHDU().header.tostring().encode('ascii'))
+        header_offset = f.tell()
+        # NAXIS2 is 0 for now; the header keeps its length when it is rewritten with the count
+        f.write(header.tostring().encode('ascii'))
+        n = 0
+        for group in groups:
+            rows['START_TIME'][n] = _format_time(group['start_time'])
+            rows['END_TIME'][n] = _format_time(group['end_time'])
+            for key in ('min_lon', 'max_lon', 'min_lat', 'max_lat'):
+                rows[key.upper()][n] = group[key]
+            rows['N_FILES'][n] = len(group['files'])
+            for key in GEOMETRY_KEYS:
+                rows[key][n] = group[key] if group[key] is not None else np.nan
+            summed_counts = group['summed_counts']
+            rows['COUNTS'][n, :len(summed_counts)] = summed_counts
+            rows['COUNTS'][n, len(summed_counts):] = 0
+            n += 1
+            if n == chunk_size:
+                f.write(rows.tobytes())
+                n_groups += n
+                n = 0
+        f.write(rows[:n].tobytes())
+        n_groups += n
+
+        # Pad the data to a whole number of FITS blocks, then record the row count
+        f.write(b'\0' * (-n_groups * rows.dtype.itemsize % 2880))
+        header['NAXIS2'] = n_groups
+        f.seek(header_offset)
+        f.write(header.tostring().encode('ascii'))
+    return n_groups
+
+def read_grouped_spectra(path):
+    """
+    Loads a file written by write_grouped_spectra in a single read.
+
+    Returns a dict of column arrays: start_time and end_time as datetime64[ms],
+    min_lon, max_lon, min_lat, max_lat, n_files, the GEOMETRY_KEYS, an
+    (n_groups x channels) counts array, and the shared channels and energy axes.
+    """
+    with fits.open(path) as hdul:
+        table = hdul['GROUPS']
+        data = table.data
+        n_channels = table.header['DETCHANS']
+        energy_per_channel = table.header['E_SLOPE']
+        spectra = {
+            'start_time': np.array(data['START_TIME'], dtype='datetime64[ms]'),
+            'end_time': np.array(data['END_TIME'], dtype='datetime64[ms]'),
+            'min_lon': np.array(data['MIN_LON']),
+            'max_lon': np.array(data['MAX_LON']),
+            'min_lat': np.array(data['MIN_LAT']),
+            'max_lat': np.array(data['MAX_LAT']),
+            'n_files': np.array(data['N_FILES']),
+            'counts': np.array(data['COUNTS']).reshape(len(data), n_channels),
+        }
+        for key in GEOMETRY_KEYS:
+            spectra[key] = np.array(data[key])
+    spectra['channels'] = np.arange(n_channels)
+    spectra['energy'] = spectra['channels'] * energy_per_channel
+    return spectra
@@ -3,25 +3,13 @@ import csv
 import numpy as np
 from datetime import datetime, timedelta
 from astropy.io import fits
-from collections import defaultdict
+from grouped_spectra import write_grouped_spectra
 
-# Directory containing your FITS files
-source_dir = 'C:/Users/hp/Desktop/FITS FILE/POST_OD/isda_archive/ch2_bundle/cho_bundle/nop/cla_collection/cla/data/calibrated/2020/02/01/'
-output_csv = 'C:/Users/hp/Desktop/INTER IIT TECH MEET HP-4/output.csv'
+# Header keys averaged over every group
+AVERAGED_KEYS = ['SAT_ALT', 'SOLARANG', 'PHASEANG', 'EMISNANG']
 
-# 96-second interval
-interval = timedelta(seconds=96)
-current_time_window = timedelta(seconds=96)
-
-# Initialize variables
-grouped_files = []
-group_start_time = None
-group_end_time = None
-group_count = 0
-
-# Initialize variables to track the least and highest values for latitude and longitude
-min_lat, max_lat = float('inf'), float('-inf')
-min_lon, max_lon = float('inf'), float('-inf')
+CSV_HEADER = ['Group Start Time', 'Group End Time', 'V0 Lon', 'V1 Lon', 'V0 Lat', 'V1 Lat', 'Summed Counts',
+              'Channels', 'Energy', 'Avg SAT_ALT', 'Avg SOLARANG', 'Avg PHASEANG', 'Avg EMISNANG']
 
 def parse_start_timestamp(filename):
     """Extracts the start timestamp from the FITS filename."""
@@ -36,146 +24,148 @@ def get_interval_start(timestamp, interval):
     interval_start = epoch + (elapsed // interval) * interval
     return interval_start
 
-def calculate_average_of_key(grouped_files, key):
-    """Calculates the average of a given key (e.g., SAT_ALT, SOLARANG, PHASEANG, EMISNANG) across grouped FITS files."""
-    values = []
-    for fits_file in grouped_files:
+
+class GroupAggregator:
+    """
+    Streams time-ordered L1 files into groups of at most max_files files
+    starting within window of the first file of the group.
+
+    Each file is opened exactly once: its counts, footprint bounds and the
+    AVERAGED_KEYS values are folded into the current group in that single pass.
+    """
+
+    def __init__(self, window=timedelta(seconds=96), max_files=12):
+        self.window = window
+        self.max_files = max_files
+        self._reset(None)
+
+    def _reset(self, start_time):
+        self.group_start_time = start_time
+        self.group_end_time = start_time + self.window if start_time is not None else None
+        self.group_files = []
+        self.summed_counts = None
+        self.min_lat, self.max_lat = float('inf'), float('-inf')
+        self.min_lon, self.max_lon = float('inf'), float('-inf')
+        self.key_values = {key: [] for key in AVERAGED_KEYS}
+
+    def add(self, fits_file):
+        """Adds a file to the current group. Returns the completed previous group, if this file started a new one."""
+        start_time = parse_start_timestamp(os.path.basename(fits_file))
+        completed = None
+        if self.group_start_time is None:
+            self._reset(start_time)
+        elif len(self.group_files) >= self.max_files or start_time > self.group_end_time:
+            completed = self.flush()
+            self._reset(start_time)
+
+        self.group_files.append(fits_file)
         with fits.open(fits_file) as hdul:
+            data = hdul[1].data
             header = hdul[1].header
-            value = header.get(key)
-            if value is not None:
-                values.append(float(value))  # Convert to native float immediately
-    if values:
-        return round(np.mean(values), 3)
-    return None
-
-fits_files = sorted([os.path.join(source_dir, f) for f in os.listdir(source_dir) if f.endswith('.fits')], 
-                    key=lambda f: parse_start_timestamp(os.path.basename(f)))
-
-# Open CSV file for output
-with open(output_csv, mode='w', newline='') as csvfile:
-    csv_writer = csv.writer(csvfile)
-    csv_writer.writerow(['Group Start Time', 'Group End Time', 'V0 Lon', 'V1 Lon', 'V0 Lat', 'V1 Lat', 'Summed Counts', 
-                         'Channels', 'Energy', 'Avg SAT_ALT', 'Avg SOLARANG', 'Avg PHASEANG', 'Avg EMISNANG'])
-
+            for key in AVERAGED_KEYS:
+                value = header.get(key)
+                if value is not None:
+                    self.key_values[key].append(float(value))  # Convert to native float immediately
+
+            if data is not None:
+                if self.summed_counts is None:
+                    self.summed_counts = np.zeros(len(data['CHANNEL']), dtype=np.float64)
+                self.summed_counts += data['COUNTS']
+
+                latitudes = [float(header.get(f'V{i}_LAT')) for i in range(4)]
+                longitudes = [float(header.get(f'V{i}_LON')) for i in range(4)]
+                self.min_lat = min(self.min_lat, *latitudes)
+                self.max_lat = max(self.max_lat, *latitudes)
+                self.min_lon = min(self.min_lon, *longitudes)
+                self.max_lon = max(self.max_lon, *longitudes)
+        return completed
+
+    def flush(self):
+        """Returns the current group as a dict and starts an empty one, or returns None if there is no group."""
+        if not self.group_files:
+            return None
+        summed_counts = self.summed_counts if self.summed_counts is not None else np.array([], dtype=np.float64)
+        group = {
+            'start_time': self.group_start_time,
+            'end_time': self.group_end_time,
+            'files': self.group_files,
+            'min_lon': self.min_lon, 'max_lon': self.max_lon,
+            'min_lat': self.min_lat, 'max_lat': self.max_lat,
+            'summed_counts': summed_counts,
+        }
+        for key in AVERAGED_KEYS:
+            values = self.key_values[key]
+            group[key] = round(np.mean(values), 3) if values else None
+        self._reset(None)
+        return group
+
+
+def list_fits_files(source_dir):
+    """Returns the .fits files of a directory sorted by the start timestamp in their filename."""
+    return sorted([os.path.join(source_dir, f) for f in os.listdir(source_dir) if f.endswith('.fits')],
+                  key=lambda f: parse_start_timestamp(os.path.basename(f)))
+
+def iter_groups(fits_files, window=timedelta(seconds=96), max_files=12):
+    """Yields the groups of a time-ordered sequence of L1 files, one dict per group."""
+    aggregator = GroupAggregator(window, max_files)
     for fits_file in fits_files:
-        filename = os.path.basename(fits_file)
-        start_time = parse_start_timestamp(filename)
-        
-        # Initialize the first group
-        if group_count == 0:
-            group_start_time = start_time
-            group_end_time = start_time + current_time_window
-
-        if group_count < 12 and start_time <= group_end_time:
-            grouped_files.append(fits_file)
-            group_count += 1
-        else:
-            # Calculate averages for SAT_ALT, SOLARANG, PHASEANG, EMISNANG
-            avg_sat_alt = calculate_average_of_key(grouped_files, 'SAT_ALT')
-            avg_solarang = calculate_average_of_key(grouped_files, 'SOLARANG')
-            avg_phaseang = calculate_average_of_key(grouped_files, 'PHASEANG')
-            avg_emisnang = calculate_average_of_key(grouped_files, 'EMISNANG')
-            
-            # Sum counts for each channel in the group
-            total_counts_by_channel = defaultdict(float)
-            
-            for fits_file_in_group in grouped_files:
-                with fits.open(fits_file_in_group) as hdul:
-                    data = hdul[1].data
-                    if data is not None:
-                        counts_data = data['COUNTS']
-                        channel_data = data['CHANNEL']
-                        for channel, count in zip(channel_data, counts_data):
-                            total_counts_by_channel[channel] += float(count)
-
-                        # Collect latitudes and longitudes for bounding box calculation
-                        latitudes = [
-                            hdul[1].header.get('V0_LAT'),
-                            hdul[1].header.get('V1_LAT'),
-                            hdul[1].header.get('V2_LAT'),
-                            hdul[1].header.get('V3_LAT')
-                        ]
-                        longitudes = [
-                            hdul[1].header.get('V0_LON'),
-                            hdul[1].header.get('V1_LON'),
-                            hdul[1].header.get('V2_LON'),
-                            hdul[1].header.get('V3_LON')
-                        ]
-                        min_lat = min(min_lat, *map(float, latitudes))
-                        max_lat = max(max_lat, *map(float, latitudes))
-                        min_lon = min(min_lon, *map(float, longitudes))
-                        max_lon = max(max_lon, *map(float, longitudes))
-            
-            # Convert accumulated counts to a list to store in CSV
-            summed_counts_list = list(map(float, total_counts_by_channel.values()))
-            channels = list(range(len(summed_counts_list)))
-
-            # Calculate energy for each channel by multiplying channel value by 0.0135
-            energy_list = [channel * 0.0135 for channel in channels]
-
-            # Write group data to CSV
-            csv_writer.writerow([
-                group_start_time.strftime('%Y-%m-%dT%H:%M:%S'),
-                group_end_time.strftime('%Y-%m-%dT%H:%M:%S'),
-                float(min_lon), float(max_lon), float(min_lat), float(max_lat),
-                summed_counts_list, channels, energy_list,
-                avg_sat_alt, avg_solarang, avg_phaseang, avg_emisnang
-            ])
-
-            # Reset counters and data for the next group
-            grouped_files = [fits_file]
-            group_start_time = start_time
-            group_end_time = start_time + current_time_window
-            group_count = 1
-            min_lat, max_lat = float('inf'), float('-inf')
-            min_lon, max_lon = float('inf'), float('-inf')
-
-    # Process remaining files in the last group
-    if grouped_files:
-        avg_sat_alt = calculate_average_of_key(grouped_files, 'SAT_ALT')
-        avg_solarang = calculate_average_of_key(grouped_files, 'SOLARANG')
-        avg_phaseang = calculate_average_of_key(grouped_files, 'PHASEANG')
-        avg_emisnang = calculate_average_of_key(grouped_files, 'EMISNANG')
-
-        total_counts_by_channel = defaultdict(float)
-        
-        for fits_file_in_group in grouped_files:
-            with fits.open(fits_file_in_group) as hdul:
-                data = hdul[1].data
-                if data is not None:
-                    counts_data = data['COUNTS']
-                    channel_data = data['CHANNEL']
-                    for channel, count in zip(channel_data, counts_data):
-                        total_counts_by_channel[channel] += float(count)
-
-                    latitudes = [
-                        hdul[1].header.get('V0_LAT'),
-                        hdul[1].header.get('V1_LAT'),
-                        hdul[1].header.get('V2_LAT'),
-                        hdul[1].header.get('V3_LAT')
-                    ]
-                    longitudes = [
-                        hdul[1].header.get('V0_LON'),
-                        hdul[1].header.get('V1_LON'),
-                        hdul[1].header.get('V2_LON'),
-                        hdul[1].header.get('V3_LON')
-                    ]
-                    min_lat = min(min_lat, *map(float, latitudes))
-                    max_lat = max(max_lat, *map(float, latitudes))
-                    min_lon = min(min_lon, *map(float, longitudes))
-                    max_lon = max(max_lon, *map(float, longitudes))
-
-        summed_counts_list = list(map(float, total_counts_by_channel.values()))
-        channels = list(range(len(summed_counts_list)))
-        energy_list = [channel * 0.0135 for channel in channels]
-
-        csv_writer.writerow([
-            group_start_time.strftime('%Y-%m-%dT%H:%M:%S'),
-            group_end_time.strftime('%Y-%m-%dT%H:%M:%S'),
-            float(min_lon), float(max_lon), float(min_lat), float(max_lat),
-            summed_counts_list, channels, energy_list,
-            avg_sat_alt, avg_solarang, avg_phaseang, avg_emisnang
-        ])
-
-print("Processing complete. Group data with cumulative counts and averages saved to CSV.")
+        completed = aggregator.add(fits_file)
+        if completed is not None:
+            yield completed
+    last_group = aggregator.flush()
+    if last_group is not None:
+        yield last_group
+
+def group_to_csv_row(group):
+    """Formats a group dict as a row of the grouping CSV."""
+    summed_counts_list = group['summed_counts'].tolist()
+    channels = list(range(len(summed_counts_list)))
+
+    # Calculate energy for each channel by multiplying channel value by 0.0135
+    energy_list = [channel * 0.0135 for channel in channels]
+
+    return [
+        group['start_time'].strftime('%Y-%m-%dT%H:%M:%S'),
+        group['end_time'].strftime('%Y-%m-%dT%H:%M:%S'),
+        float(group['min_lon']), float(group['max_lon']), float(group['min_lat']), float(group['max_lat']),
+        summed_counts_list, channels, energy_list,
+        group['SAT_ALT'], group['SOLARANG'], group['PHASEANG'], group['EMISNANG']
+    ]
+
+def group_fits_directory(source_dir, output_path, window=timedelta(seconds=96), max_files=12, output_format='csv'):
+    """
+    Groups the L1 files of source_dir into window-long groups and writes one row per group.
+
+    Parameters:
+    - source_dir (str): Directory containing the L1 FITS files of one day.
+    - output_path (str): Path of the CSV or FITS file to write.
+    - window (timedelta): Maximum time between the first file of a group and any other file in it.
+    - max_files (int): Maximum number of files in a group.
+    - output_format (str): 'csv' for the legacy CSV with list-valued cells, or 'fits' for
+      the columnar table of grouped_spectra.write_grouped_spectra.
+
+    Returns the number of groups written.
+    """
+    groups = iter_groups(list_fits_files(source_dir), window, max_files)
+    if output_format == 'fits':
+        return write_grouped_spectra(groups, output_path)
+    if output_format != 'csv':
+        raise ValueError(f"Unknown output format: {output_format}")
+
+    n_groups = 0
+    with open(output_path, mode='w', newline='') as csvfile:
+        csv_writer = csv.writer(csvfile)
+        csv_writer.writerow(CSV_HEADER)
+        for group in groups:
+            csv_writer.writerow(group_to_csv_row(group))
+            n_groups += 1
+    return n_groups
+
+
+if __name__ == "__main__":
+    # Directory containing your FITS files
+    source_dir = 'C:/Users/hp/Desktop/FITS FILE/POST_OD/isda_archive/ch2_bundle/cho_bundle/nop/cla_collection/cla/data/calibrated/2020/02/01/'
+    output_csv = 'C:/Users/hp/Desktop/INTER IIT TECH MEET HP-4/output.csv'
+
+    group_fits_directory(source_dir, output_csv)
+    print("Processing complete. Group data with cumulative counts and averages saved to CSV.")
@@ -0,0 +1,94 @@
+import os
+import csv
+from datetime import timedelta
+from itertools import groupby
+from concurrent.futures import ProcessPoolExecutor
+from imp_grouping_csv_imp_sat_alt_sol_ang_phase_ang import (
+    CSV_HEADER, GroupAggregator, group_to_csv_row, list_fits_files, parse_start_timestamp,
+)
+from grouped_spectra import write_grouped_spectra
+
+def list_day_directories(calibrated_root):
+    """Returns every directory below calibrated_root (e.g. calibrated/YYYY/MM/DD) that contains .fits files, in path order."""
+    day_dirs = [root for root, _, files in os.walk(calibrated_root) if any(f.endswith('.fits') for f in files)]
+    return sorted(day_dirs)
+
+def plan_groups(fits_files, window=timedelta(seconds=96), max_files=12):
+    """
+    Splits time-ordered L1 files into groups using only their filename timestamps.
+
+    Uses the same rule as GroupAggregator, so planning a whole archive up front
+    gives the same groups as streaming it serially, including groups that start
+    before midnight and continue into the next day directory.
+    """
+    groups = []
+    group_end_time = None
+    for fits_file in fits_files:
+        start_time = parse_start_timestamp(os.path.basename(fits_file))
+        if not groups or len(groups[-1]) >= max_files or start_time > group_end_time:
+            groups.append([])
+            group_end_time = start_time + window
+        groups[-1].append(fits_file)
+    return groups
+
+def _aggregate_groups(groups, window, max_files):
+    """Worker: aggregates a list of planned groups and returns the group dicts."""
+    aggregated = []
+    for group_files in groups:
+        aggregator = GroupAggregator(window, max_files)
+        for fits_file in group_files:
+            aggregator.add(fits_file)
+        aggregated.append(aggregator.flush())
+    return aggregated
+
+def group_archive(calibrated_root, output_path, processes=None, window=timedelta(seconds=96), max_files=12,
+                  output_format='csv'):
+    """
+    Groups every day directory below calibrated_root on a process pool and writes one file in time order.
+
+    Group boundaries are planned serially from the filenames of the whole
+    archive; the groups are then fanned out to the pool one day (of the group
+    start time) per task, and the results are written back in submission order.
+
+    Parameters:
+    - calibrated_root (str): Root of the ISDA calibrated/YYYY/MM/DD tree (or any sub-tree of it).
+    - output_path (str): Path of the merged CSV or FITS file.
+    - processes (int, optional): Number of worker processes, defaults to the number of cores.
+    - output_format (str): 'csv' or 'fits', as in group_fits_directory.
+
+    Returns the number of groups written.
+    """
+    fits_files = []
+    for day_dir in list_day_directories(calibrated_root):
+        fits_files.extend(list_fits_files(day_dir))
+    fits_files.sort(key=lambda f: parse_start_timestamp(os.path.basename(f)))
+
+    groups = plan_groups(fits_files, window, max_files)
+    day_tasks = [list(day_groups) for _, day_groups in
+                 groupby(groups, key=lambda g: parse_start_timestamp(os.path.basename(g[0])).date())]
+
+    if output_format not in ('csv', 'fits'):
+        raise ValueError(f"Unknown output format: {output_format}")
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        day_results = executor.map(_aggregate_groups, day_tasks,
+                                   [window] * len(day_tasks), [max_files] * len(day_tasks))
+        if output_format == 'fits':
+            return write_grouped_spectra((group for day_groups in day_results for group in day_groups), output_path)
+
+        n_groups = 0
+        with open(output_path, mode='w', newline='') as csvfile:
+            csv_writer = csv.writer(csvfile)
+            csv_writer.writerow(CSV_HEADER)
+            for day_groups in day_results:
+                csv_writer.writerows(group_to_csv_row(group) for group in day_groups)
+                n_groups += len(day_groups)
+    return n_groups
+
+
+if __name__ == "__main__":
+    calibrated_root = 'C:/Users/hp/Desktop/FITS FILE/POST_OD/isda_archive/ch2_bundle/cho_bundle/nop/cla_collection/cla/data/calibrated/2020/'
+    output_path = 'C:/Users/hp/Desktop/INTER IIT TECH MEET HP-4/grouped_2020.fits'
+
+    n_groups = group_archive(calibrated_root, output_path, output_format='fits')
+    print(f"Processing complete. {n_groups} groups saved to {output_path}.")
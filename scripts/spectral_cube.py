@@ -0,0 +1,132 @@
+import os
+import numpy as np
+from astropy.io import fits
+from fits_index import INDEX_KEYS, parse_file_times
+
+N_CHANNELS = 2048
+
+# Aligned per-spectrum metadata stored next to the counts cube
+META_DTYPE = np.dtype(
+    [('filename', 'S64'), ('start_time', 'datetime64[ms]'), ('end_time', 'datetime64[ms]')]
+    + [(key, 'f8') for key in INDEX_KEYS]
+)
+
+def _find_fits_files(source_dir):
+    """Returns every .fits file below source_dir sorted by the start time in its filename."""
+    fits_filepaths = [os.path.join(root, f) for root, _, files in os.walk(source_dir)
+                      for f in files if f.endswith('.fits')]
+    return sorted(fits_filepaths, key=lambda f: (parse_file_times(f)[0], os.path.basename(f)))
+
+def build_spectral_cube(source_dir, cube_dir, dtype=np.uint16, header_index=None):
+    """
+    Converts a directory tree of CLASS L1 FITS files into a memory-mappable spectral cube.
+
+    Writes cube_dir/counts.npy (n_spectra x 2048 counts, time-ordered) and
+    cube_dir/meta.npy (structured array of filename, start/end time, EXPOSURE,
+    footprint vertices and geometry angles, one row per spectrum).
+
+    Parameters:
+    - source_dir (str): Root of the L1 tree (e.g. calibrated/2020/02).
+    - cube_dir (str): Output directory for the cube.
+    - dtype: Storage type of the counts. L1 counts are integers, so uint16 is exact;
+      a ValueError is raised if a spectrum cannot be stored losslessly.
+    - header_index (FitsHeaderIndex, optional): Source of the metadata instead of the file headers;
+      a file it does not hold falls back to its own header.
+    """
+    os.makedirs(cube_dir, exist_ok=True)
+    fits_filepaths = _find_fits_files(source_dir)
+    if header_index is not None:
+        header_index.update(fits_filepaths)
+
+    counts = np.lib.format.open_memmap(os.path.join(cube_dir, 'counts.npy'), mode='w+',
+                                       dtype=dtype, shape=(len(fits_filepaths), N_CHANNELS))
+    meta = np.zeros(len(fits_filepaths), dtype=META_DTYPE)
+
+    for row, fits_file in enumerate(fits_filepaths):
+        with fits.open(fits_file) as hdul:
+            spectrum = hdul[1].data['COUNTS']
+            header = header_index.get(fits_file) if header_index is not None else None
+            if header is None:
+                header = hdul[1].header
+            stored = np.asarray(spectrum).astype(dtype)
+            if not np.array_equal(stored, spectrum):
+                raise ValueError(f"{fits_file} cannot be stored as {np.dtype(dtype).name} without loss")
+            counts[row] = stored
+
+            start_time, end_time = parse_file_times(fits_file)
+            meta['filename'][row] = os.path.basename(fits_file)
+            meta['start_time'][row] = np.datetime64(start_time, 'ms')
+            meta['end_time'][row] = np.datetime64(end_time, 'ms')
+            for key in INDEX_KEYS:
+                value = header.get(key)
+                meta[key][row] = float(value) if value is not None else np.nan
+
+    counts.flush()
+    del counts
+    np.save(os.path.join(cube_dir, 'meta.npy'), meta)
+    return SpectralCube(cube_dir)
+
+
+class SpectralCube:
+    """
+    Read-only view of a cube written by build_spectral_cube.
+
+    counts and meta are memory-mapped, and time_slice returns another
+    SpectralCube over a contiguous row range without copying any data.
+    """
+
+    def __init__(self, cube_dir=None, counts=None, meta=None):
+        self.cube_dir = cube_dir
+        if cube_dir is not None:
+            counts = np.load(os.path.join(cube_dir, 'counts.npy'), mmap_mode='r')
+            meta = np.load(os.path.join(cube_dir, 'meta.npy'), mmap_mode='r')
+        self.counts = counts
+        self.meta = meta
+
+    def __len__(self):
+        return len(self.meta)
+
+    def __getitem__(self, rows):
+        """Returns a SpectralCube over a row slice, or over the single row of an integer index."""
+        if not isinstance(rows, slice):
+            row = int(rows)
+            if row < 0:
+                row += len(self)
+            if not 0 <= row < len(self):
+                raise IndexError(f"Row {rows} is out of range for a cube of {len(self)} spectra")
+            rows = slice(row, row + 1)
+        return SpectralCube(counts=self.counts[rows], meta=self.meta[rows])
+
+    def time_slice(self, start_utc, end_utc):
+        """
+        Returns the spectra that start at or after start_utc and end at or before end_utc.
+
+        Times are compared at one-second resolution, like add_l1_files_time does.
+        """
+        start_secs = self.meta['start_time'].astype('datetime64[s]')
+        end_secs = self.meta['end_time'].astype('datetime64[s]')
+        first = np.searchsorted(start_secs, np.datetime64(start_utc).astype('datetime64[s]'), side='left')
+        last = np.searchsorted(end_secs, np.datetime64(end_utc).astype('datetime64[s]'), side='right')
+        return self[first:max(first, last)]
+
+    @property
+    def filenames(self):
+        return [name.decode() for name in self.meta['filename']]
+
+    def footprints(self):
+        """Returns (latitudes, longitudes) arrays of shape (n_spectra, 4) for V0..V3."""
+        latitudes = np.stack([self.meta[f'V{i}_LAT'] for i in range(4)], axis=1)
+        longitudes = np.stack([self.meta[f'V{i}_LON'] for i in range(4)], axis=1)
+        return latitudes, longitudes
+
+    def summed_counts(self):
+        """Sums all spectra in the cube into a float64 spectrum."""
+        return self.counts.sum(axis=0, dtype=np.float64)
+
+
+# Usage example
+if __name__ == "__main__":
+    source_dir = 'C:/Users/hp/Desktop/FITS FILE/POST_OD/isda_archive/ch2_bundle/cho_bundle/nop/cla_collection/cla/data/calibrated/2020/02/'
+    cube_dir = 'C:/Users/hp/Desktop/INTER IIT TECH MEET HP-4/cube_2020_02'
+    cube = build_spectral_cube(source_dir, cube_dir)
+    print(f"Spectral cube with {len(cube)} spectra written to {cube_dir}")